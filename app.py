@@ -1,14 +1,21 @@
 import os
+import click
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
 from flask_migrate import Migrate
-from models import db, EmailMessage, EmailSettings
+from models import db, ContactStats, EmailMessage, EmailSettings, SEARCH_BACKFILL_BATCH_SIZE
 import traceback
-from email_handler import EmailHandler
+from email_handler import EmailHandler, CONTACTS_SINCE_DAYS, SYNC_PARALLEL_FOLDERS
+from idle_worker import start_idle_listener
+from utils.connection_pool import connection_pool, parse_server_limits, \
+    PoolTimeoutError, POOL_REQUEST_ACQUIRE_TIMEOUT
+from utils.bulk_writer import write_messages
+from utils.rate_control import get_all_stats as get_rate_control_stats
+from utils.pagination import decode_cursor, estimate_count
+from utils.text_search import normalize_query, query_terms, use_full_text
+from utils.highlight import SNIPPET_SOURCE_LENGTH, highlight, highlight_terms, snippet
 from database import session_scope
 from flask_caching import Cache
-from sqlalchemy import text, or_, and_, case, func
-import re
-import unicodedata
+from sqlalchemy import text, or_, case, func
 import time
 from functools import wraps
 import threading
@@ -40,6 +47,17 @@ def create_app():
         database_url = database_url.replace("postgres://", "postgresql://", 1)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_url
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # 0より大きい場合、同期時は本文の先頭だけ取得し、全文は表示時に取得する
+    app.config["SYNC_PREVIEW_BYTES"] = int(os.environ.get("SYNC_PREVIEW_BYTES", "0")) or None
+    # IMAPから連絡先を集める期間（日）
+    app.config["CONTACTS_SINCE_DAYS"] = int(os.environ.get("CONTACTS_SINCE_DAYS", CONTACTS_SINCE_DAYS))
+    # 同期で同時に使うIMAP接続数と、サーバーごとの同時接続数の上限（例: imap.gmail.com=15）
+    app.config["SYNC_PARALLEL_FOLDERS"] = int(os.environ.get("SYNC_PARALLEL_FOLDERS", SYNC_PARALLEL_FOLDERS))
+    app.config["IMAP_SERVER_CONNECTION_LIMITS"] = parse_server_limits(os.environ.get("IMAP_SERVER_CONNECTION_LIMITS"))
+    default_server_limit = os.environ.get("IMAP_DEFAULT_SERVER_CONNECTION_LIMIT")
+    app.config["IMAP_DEFAULT_SERVER_CONNECTION_LIMIT"] = int(default_server_limit) if default_server_limit else None
+    connection_pool.configure(app.config["IMAP_SERVER_CONNECTION_LIMITS"],
+                              app.config["IMAP_DEFAULT_SERVER_CONNECTION_LIMIT"])
     cache.init_app(app)
     db.init_app(app)
     migrate = Migrate(app, db)
@@ -47,49 +65,8 @@ def create_app():
 
 app = create_app()
 
-def highlight(text, search_query):
-    """検索キーワードをハイライト表示するフィルター（改善版）"""
-    if not text or not search_query:
-        return text if text else ""
-    
-    try:
-        text = str(text)
-        terms = [term.strip() for term in search_query.split() if term.strip()]
-        
-        # テキストを正規化（全角・半角の違いを無視）
-        normalized_text = unicodedata.normalize('NFKC', text)
-        original_positions = []
-        current_pos = 0
-        
-        for term in terms:
-            try:
-                normalized_term = unicodedata.normalize('NFKC', term)
-                pattern = re.compile(f'({re.escape(normalized_term)})', re.IGNORECASE | re.UNICODE | re.MULTILINE)
-                
-                # 元のテキストでの位置を保持しながらハイライト
-                matches = list(pattern.finditer(normalized_text))
-                for match in matches:
-                    start, end = match.span()
-                    original_text = text[start:end]
-                    highlighted = f'<mark class="search-highlight" data-term="{term}">{original_text}</mark>'
-                    original_positions.append((start + current_pos, end + current_pos, highlighted))
-                    current_pos += len(highlighted) - len(original_text)
-                
-            except Exception as e:
-                print(f"単語のハイライト処理エラー: {term}, {str(e)}")
-                continue
-        
-        # 位置情報を使って元のテキストを変更
-        result = text
-        for start, end, highlighted in sorted(original_positions, reverse=True):
-            result = result[:start] + highlighted + result[end:]
-            
-        return result
-    except Exception as e:
-        print(f"ハイライト処理エラー: {str(e)}")
-        return text
-
 app.jinja_env.filters['highlight'] = highlight
+app.jinja_env.filters['snippet'] = snippet
 
 # アプリケーションレベルの接続制御を追加
 app_lock = threading.Lock()
@@ -118,62 +95,155 @@ def with_connection_control(func):
 
     return wrapper
 
-def sync_emails_background(email_address, password, imap_server):
-    """バックグラウンドでメールを同期する"""
+def save_parsed_messages(session, parsed_messages):
+    """パース済みメッセージのバッチを複数行INSERTでまとめて保存する"""
+    stats = write_messages(session, parsed_messages)
+    app_logger.debug(f"Saved batch of new emails: {stats}")
+    return stats
+
+# ロックが取れずに保留した同期要求（アカウント単位）。実行中の同期が終わったらもう一度同期する
+_pending_syncs = set()
+_pending_syncs_lock = threading.Lock()
+
+def sync_emails_background(email_address, password, imap_server, handler=None):
+    """バックグラウンドでメールを同期する
+
+    handlerを渡した場合はその接続を再利用し、切断もしない（IDLEリスナー用）。
+    同期が既に実行中なら要求を保留して False を返す。同じプロセスで実行中の同期は、
+    終わった後に保留された要求の分をもう一度同期する。
+    """
     from utils.process_lock import ProcessLock  # ProcessLockをインポート
 
     with app.app_context():
         # ユーザーごとのユニークなロック名を作成
         lock_name = f"email_sync_{email_address}"
-        lock = ProcessLock(lock_name)
 
-        # ロックの取得を試みる
-        if not lock.acquire():
-            app_logger.info(f"同期プロセスは既に実行中です: {email_address}")
-            return
+        while True:
+            lock = ProcessLock(lock_name)
 
-        try:
-            background_handler = EmailHandler(
-                email_address=email_address,
-                password=password,
-                imap_server=imap_server
-            )
-            background_handler.connect()
-            app_logger.debug("Background handler connected")
+            # ロックの取得を試みる
+            if not lock.acquire():
+                with _pending_syncs_lock:
+                    _pending_syncs.add(email_address)
+                # 保留を記録する前に実行中の同期が終わっていた場合に備えて、もう一度だけ試す
+                if not lock.acquire():
+                    app_logger.info(f"同期プロセスは既に実行中のため、同期要求を保留します: {email_address}")
+                    return False
 
-            try:
-                with session_scope() as session:
-                    new_emails = background_handler.check_new_emails(session=session)
-                    app_logger.debug(f"Found {len(new_emails) if new_emails else 0} new emails")
-
-                    for parsed_msg in new_emails:
-                        new_email = EmailMessage(
-                            message_id=parsed_msg['message_id'],
-                            from_address=parsed_msg['from'],
-                            to_address=parsed_msg['to'],
-                            subject=parsed_msg['subject'],
-                            body=parsed_msg['body'],
-                            date=parsed_msg['date'],
-                            is_sent=parsed_msg.get('is_sent', False),
-                            folder=parsed_msg.get('folder', '')
-                        )
-                        session.add(new_email)
-                    
-                    session.commit()
-                    app_logger.debug(f"Successfully saved {len(new_emails)} new emails")
+            with _pending_syncs_lock:
+                _pending_syncs.discard(email_address)
 
-            except Exception as e:
-                app_logger.error(f"Background sync error: {str(e)}", exc_info=True)
-                raise
+            try:
+                _sync_emails_locked(email_address, password, imap_server, handler)
             finally:
-                background_handler.disconnect()
-                app_logger.debug("Background handler disconnected")
+                # 必ずロックを解放
+                lock.release()
+
+            # 同期中に届いた要求があれば、その分をもう一度同期する
+            with _pending_syncs_lock:
+                if email_address not in _pending_syncs:
+                    return True
+            app_logger.info(f"同期中に保留された同期要求があるため、もう一度同期します: {email_address}")
+
+def _sync_emails_locked(email_address, password, imap_server, handler):
+    """同期ロックを取得した状態で、新着メールを1回同期する"""
+    try:
+        owns_handler = handler is None
+        background_handler = handler or connection_pool.acquire(email_address, password, imap_server)
+        if owns_handler:
+            app_logger.debug("Background handler acquired from pool")
+        sync_failed = False
+
+        try:
+            with session_scope() as session:
+                # 取得・パースと並行して、パース済みのバッチから順に保存する
+                background_handler.check_new_emails(
+                    session=session,
+                    writer=lambda batch: save_parsed_messages(session, batch),
+                    parallel_folders=app.config.get("SYNC_PARALLEL_FOLDERS", SYNC_PARALLEL_FOLDERS),
+                    preview_bytes=app.config.get("SYNC_PREVIEW_BYTES")
+                )
+                session.commit()
 
         except Exception as e:
-            app_logger.error(f"Background handler error: {str(e)}", exc_info=True)
+            sync_failed = True
+            app_logger.error(f"Background sync error: {str(e)}", exc_info=True)
+            raise
         finally:
-            # 必ずロックを解放
-            lock.release()
+            if owns_handler:
+                connection_pool.release(background_handler, discard=sync_failed)
+                app_logger.debug("Background handler returned to pool")
+
+    except Exception as e:
+        app_logger.error(f"Background handler error: {str(e)}", exc_info=True)
+
+def build_message_query(db_session, contact=None, search_query=None):
+    """メッセージ一覧の絞り込みクエリを作る
+
+    単語の検索は body_tsv の全文検索（ts_rankの関連度順）で行い、
+    CJKやアドレスの一部のような部分一致のクエリはILIKEで検索する
+    （CJKの語は search_ngrams のbigramインデックスで候補を絞ってから確かめる）。
+    検索時は本文全体を読まず、一致箇所の周辺だけを snippet_source に読む。
+
+    Returns:
+        tuple: (クエリ, 検索の関連度の式 または None)
+    """
+    messages_query = db_session.query(EmailMessage)
+
+    if contact:
+        messages_query = messages_query.filter(
+            or_(
+                EmailMessage.from_address == contact,
+                EmailMessage.to_address == contact
+            )
+        )
+
+    search_terms = query_terms(search_query)
+    if not search_terms:
+        return messages_query, None
+    messages_query = messages_query.options(*EmailMessage.snippet_options(highlight_terms(search_query)))
+
+    if use_full_text(search_query):
+        tsquery = EmailMessage.search_tsquery(normalize_query(search_query))
+        messages_query = messages_query.filter(EmailMessage.body_tsv.op('@@')(tsquery))
+        return messages_query, func.ts_rank(EmailMessage.body_tsv, tsquery)
+
+    for term in search_terms:
+        messages_query = messages_query.filter(EmailMessage.substring_condition(term))
+    rank = case(
+        (EmailMessage.subject.icontains(search_terms[0], autoescape=True), 3),
+        (EmailMessage.body.icontains(search_terms[0], autoescape=True), 2),
+        else_=1
+    )
+    return messages_query, rank
+
+def message_summary(msg, search_query=None):
+    """一覧表示用のメッセージの辞書
+
+    検索結果（build_message_queryで本文を読まなかったもの）では、本文の代わりに一致箇所の
+    前後だけのスニペット（ハイライト済みのHTML）を入れ、本文全体は「続きを表示」で
+    /api/messages/<id>/body から取得する。
+    """
+    summary = {
+        'id': msg.id,
+        'subject': msg.subject,
+        'date': msg.date,
+        'is_sent': msg.is_sent,
+        'from_address': msg.from_address,
+        'to_address': msg.to_address,
+        'body_loaded': msg.body_loaded
+    }
+    if not query_terms(search_query):
+        summary['body'] = msg.body
+        return summary
+    source = msg.snippet_source or ''
+    summary['body'] = None
+    summary['snippet'] = str(snippet(
+        source[:SNIPPET_SOURCE_LENGTH], search_query,
+        head_truncated=(msg.snippet_start or 1) > 1,
+        tail_truncated=len(source) > SNIPPET_SOURCE_LENGTH
+    ))
+    return summary
 
 @app.route('/')
 @with_connection_control
@@ -195,7 +265,8 @@ def index():
                 .filter_by(email=session['email'])\
                 .first()
 
-            if email_settings and email_settings.is_syncing:
+            # リースが切れたis_syncingは中断された同期とみなし、再開させる
+            if email_settings and email_settings.sync_in_progress:
                 app_logger.debug("Sync already in progress")
                 flash("メールの同期が進行中です", "info")
             else:
@@ -213,7 +284,6 @@ def index():
         app_logger.error(f"同期状態確認エラー: {str(e)}")
         flash(f"エラーが発生しました: {str(e)}", "error")
 
-    page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 20, type=int)
     
     # Validate per_page value
@@ -221,130 +291,65 @@ def index():
     if per_page not in allowed_page_sizes:
         per_page = 20
 
-    # Get distinct contact count from database
-    try:
-        sort_by = request.args.get('sort_by', 'name_asc')
-        
-        # サブクエリを使用して最適化されたクエリを作成
-        base_query = db.session.query(
-            EmailMessage.from_address,
-            func.max(EmailMessage.date).label('last_message_date')
-        ).group_by(EmailMessage.from_address)
-
-        # 並び替えの適用
-        if sort_by == 'name_desc':
-            base_query = base_query.order_by(EmailMessage.from_address.desc())
-        elif sort_by == 'date_desc':
-            base_query = base_query.order_by(func.max(EmailMessage.date).desc())
-        elif sort_by == 'date_asc':
-            base_query = base_query.order_by(func.max(EmailMessage.date).asc())
-        else:  # name_asc (デフォルト)
-            base_query = base_query.order_by(EmailMessage.from_address.asc())
-
-        contacts_subquery = base_query.subquery()
-
-        # 総件数を取得
-        distinct_contacts = db.session.query(func.count(contacts_subquery.c.from_address)).scalar()
-
-        # ページネーション用のクエリ
-        contacts_query = db.session.query(contacts_subquery.c.from_address)
-    except Exception as e:
-        app_logger.error(f"連絡先取得エラー: {str(e)}")
-        distinct_contacts = 0
-        flash("連絡先の取得に失敗しました。", "error")
+    sort_by = request.args.get('sort_by', 'name_asc')
+    contacts_cursor = request.args.get('contacts_cursor')
+    exact_total = request.args.get('total') == 'exact'
 
-    # Get paginated contacts
+    # 連絡先ごとの集計は同期時に contact_stats に書き込まれている
+    # （並び順ごとのインデックスをキーセットで辿るため、GROUP BYもOFFSETも使わない）
     try:
-        
-        contacts_pagination = contacts_query.paginate(
-            page=page,
-            per_page=per_page,
-            error_out=False
-        )
-        contacts = [contact[0] for contact in contacts_pagination.items if contact[0]]
+        contact_rows, contacts_next_cursor = ContactStats.page(db.session, sort_by, contacts_cursor, per_page)
+        contacts = [row.address for row in contact_rows]
+        contacts_query = ContactStats.sorted_query(db.session, sort_by)[0]
+        distinct_contacts = contacts_query.count() if exact_total else estimate_count(db.session, contacts_query)
     except Exception as e:
         app_logger.error(f"連絡先取得エラー: {str(e)}")
         contacts = []
-        contacts_pagination = None
+        contacts_next_cursor = None
+        distinct_contacts = 0
         flash("連絡先の取得に失敗しました。", "error")
 
     # Initialize messages dictionary with default values
     messages_dict = {
         'message_list': [],
         'total': 0,
+        'total_is_estimate': False,
         'has_next': False,
-        'next_page': None,
+        'next_cursor': None,
         'error': None
     }
 
     selected_contact = request.args.get('contact')
     search_query = request.args.get('search')
+    cursor = request.args.get('cursor')
 
     if selected_contact or search_query:
         try:
-            cache_key = f'messages:{selected_contact}:{search_query}:{page}'
+            cache_key = f'messages:{selected_contact}:{search_query}:{cursor}:{per_page}:{exact_total}'
             messages_dict = cache.get(cache_key)
 
             if messages_dict is None:
                 # セッションを管理するために session_scope を使用
                 with session_scope() as scoped_session:
-                    messages_query = scoped_session.query(EmailMessage)
-
-                    if selected_contact:
-                        messages_query = messages_query.filter(
-                            or_(
-                                EmailMessage.from_address == selected_contact,
-                                EmailMessage.to_address == selected_contact
-                            )
-                        )
-
-                    if search_query:
-                        search_terms = [term.strip() for term in search_query.split() if term.strip()]
-                        search_conditions = []
-
-                        for term in search_terms:
-                            normalized_term = unicodedata.normalize('NFKC', term)
-                            condition = or_(
-                                EmailMessage.subject.ilike(f'%{normalized_term}%'),
-                                EmailMessage.body.ilike(f'%{normalized_term}%'),
-                                EmailMessage.from_address.ilike(f'%{normalized_term}%'),
-                                EmailMessage.to_address.ilike(f'%{normalized_term}%')
-                            )
-                            search_conditions.append(condition)
-
-                        if search_conditions:
-                            messages_query = messages_query.filter(and_(*search_conditions))
-                            messages_query = messages_query.order_by(
-                                case(
-                                    (EmailMessage.subject.ilike(f'%{search_terms[0]}%'), 3),
-                                    (EmailMessage.body.ilike(f'%{search_terms[0]}%'), 2),
-                                    else_=1
-                                ).desc(),
-                                EmailMessage.date.desc()
-                            )
-                    else:
-                        messages_query = messages_query.order_by(EmailMessage.date.desc())
-
+                    messages_query, rank = build_message_query(scoped_session, selected_contact, search_query)
                     app_logger.debug(f"SQL Query: {messages_query}")
-                    total = messages_query.count()
-                    app_logger.debug(f"Total messages found: {total}")
 
-                    current_messages = messages_query.offset((page - 1) * per_page).limit(per_page).all()
+                    if selected_contact and rank is None:
+                        # 連絡先とのやり取りは送信側・受信側のインデックスを別々に辿ってマージする
+                        current_messages, next_cursor = EmailMessage.conversation(
+                            scoped_session, selected_contact, cursor=decode_cursor(cursor), limit=per_page
+                        )
+                    else:
+                        current_messages, next_cursor = EmailMessage.page(messages_query, cursor, per_page, rank=rank)
                     app_logger.debug(f"Retrieved {len(current_messages)} messages for current page")
 
+                    total = messages_query.count() if exact_total else estimate_count(scoped_session, messages_query)
                     messages_dict = {
-                        'message_list': [{
-                            'id': msg.id,
-                            'subject': msg.subject,
-                            'body': msg.body,
-                            'date': msg.date,
-                            'is_sent': msg.is_sent,
-                            'from_address': msg.from_address,
-                            'to_address': msg.to_address
-                        } for msg in current_messages],
-                        'total': total,
-                        'has_next': (page * per_page) < total,
-                        'next_page': page + 1 if (page * per_page) < total else None
+                        'message_list': [message_summary(msg, search_query) for msg in current_messages],
+                        'total': total or 0,
+                        'total_is_estimate': not exact_total,
+                        'has_next': next_cursor is not None,
+                        'next_cursor': next_cursor
                     }
 
                     cache.set(cache_key, messages_dict, timeout=600)
@@ -355,18 +360,32 @@ def index():
             messages_dict = {
                 'message_list': [],
                 'total': 0,
+                'total_is_estimate': False,
                 'has_next': False,
-                'next_page': None,
+                'next_cursor': None,
                 'error': str(e)
             }
 
+    # 無限スクロールからの続きの読み込みにはJSONで返す
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({
+            'messages': [dict(msg, date=msg['date'].isoformat() if msg['date'] else None)
+                         for msg in messages_dict['message_list']],
+            'has_next': messages_dict['has_next'],
+            'next_cursor': messages_dict['next_cursor'],
+            'total': messages_dict['total'],
+            'total_is_estimate': messages_dict['total_is_estimate'],
+            'error': messages_dict.get('error')
+        })
+
     return render_template(
         'index.html',
         messages=messages_dict,
         contacts=contacts,
         contacts_total=distinct_contacts,
-        contacts_pagination=contacts_pagination,
-        current_page=page,
+        contacts_total_is_estimate=not exact_total,
+        contacts_cursor=contacts_cursor,
+        contacts_next_cursor=contacts_next_cursor,
         search_query=search_query,
         per_page=per_page,
         sort_by=sort_by
@@ -382,12 +401,26 @@ def settings():
         app_logger.debug(f'Attempting connection to {imap_server} with email {email}')
 
         try:
-            handler = EmailHandler(email, request.form.get('password'), imap_server)
-            if handler.test_connection():
+            # プールから認証済み接続を借りられれば接続テスト成功とみなす
+            try:
+                with connection_pool.connection(email, request.form.get('password'), imap_server,
+                                                timeout=POOL_REQUEST_ACQUIRE_TIMEOUT) as handler:
+                    connected = handler.verify_connection_state(['AUTH', 'SELECTED'], allow_reconnect=False)
+            except ConnectionError as e:
+                app_logger.debug(f'Connection test failed: {str(e)}')
+                connected = False
+            except PoolTimeoutError as e:
+                # 同期などで接続数の上限まで使われている
+                app_logger.warning(f'Connection test timed out waiting for the pool: {str(e)}')
+                flash("IMAP接続が混み合っています。しばらくしてから再度お試しください。", "error")
+                return render_template('settings.html')
+
+            if connected:
                 app_logger.debug('Connection test successful')
                 session['email'] = email
                 session['password'] = request.form.get('password')
                 session['imap_server'] = imap_server
+                start_idle_listener(email, request.form.get('password'), imap_server)
                 flash("接続に成功しました！", "success")
                 return redirect(url_for('index'))
             else:
@@ -445,52 +478,106 @@ def search_contacts():
 
 @app.route('/api/search_messages')
 def search_messages():
+    """メッセージを関連度順に検索する。続きは next_cursor を cursor に渡して取得する
+
+    件数は実行計画の見積もりを返し、total=exact の場合だけ正確に数える。
+    """
     if 'email' not in session:
-        return jsonify({'messages': [], 'total': 0})
+        return jsonify({'messages': [], 'total': 0, 'next_cursor': None})
         
     query = request.args.get('q', '')
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
+    exact_total = request.args.get('total') == 'exact'
     per_page = 20
     
     try:
-        messages_query = EmailMessage.query
-        
-        if query:
-            search_terms = query.split()
-            for term in search_terms:
-                messages_query = messages_query.filter(
-                    or_(
-                        EmailMessage.subject.ilike(f'%{term}%'),
-                        EmailMessage.body.ilike(f'%{term}%'),
-                        EmailMessage.from_address.ilike(f'%{term}%'),
-                        EmailMessage.to_address.ilike(f'%{term}%')
-                    )
-                )
-        
-        total = messages_query.count()
-        messages = messages_query.order_by(EmailMessage.date.desc())\
-            .offset((page - 1) * per_page)\
-            .limit(per_page)\
-            .all()
-            
-        return jsonify({
-            'messages': [{
-                'id': msg.id,
-                'subject': msg.subject,
-                'body': msg.body,
-                'date': msg.date.isoformat(),
-                'from_address': msg.from_address,
-                'to_address': msg.to_address,
-                'is_sent': msg.is_sent
-            } for msg in messages],
-            'total': total,
-            'has_next': (page * per_page) < total,
-            'next_page': page + 1 if (page * per_page) < total else None
-        })
+        with session_scope() as db_session:
+            messages_query, rank = build_message_query(db_session, search_query=query)
+            messages, next_cursor = EmailMessage.page(messages_query, cursor, per_page, rank=rank)
+            total = messages_query.count() if exact_total else estimate_count(db_session, messages_query)
+
+            return jsonify({
+                'messages': [
+                    dict(message_summary(msg, query), date=msg.date.isoformat() if msg.date else None)
+                    for msg in messages
+                ],
+                'total': total,
+                'total_is_estimate': not exact_total,
+                'has_next': next_cursor is not None,
+                'next_cursor': next_cursor
+            })
     except Exception as e:
         print(f"メッセージ検索エラー: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/messages/<int:message_id>/body')
+def get_message_body(message_id):
+    """本文全体を返す。プレビューしか保存していない場合はIMAPから取得してDBに保存する"""
+    if 'email' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        with session_scope() as db_session:
+            message = db_session.get(EmailMessage, message_id)
+            if message is None:
+                return jsonify({'error': 'Not found'}), 404
+
+            if not message.body_loaded:
+                # リクエストのワーカーを長く塞がないよう、接続が空くのは短時間だけ待つ
+                with connection_pool.connection(session['email'], session['password'], session['imap_server'],
+                                                timeout=POOL_REQUEST_ACQUIRE_TIMEOUT) as handler:
+                    parsed_msg = handler.fetch_full_body(message.imap_folder or message.folder, message.imap_uid,
+                                                         message.message_id, gm_msgid=message.gm_msgid)
+                if parsed_msg is None:
+                    return jsonify({'error': 'メッセージがサーバー上に見つかりません'}), 404
+                message.hydrate_body(parsed_msg['body'])
+                message.imap_uid = parsed_msg['uid']
+                app_logger.debug(f"Hydrated full body for message {message_id}")
+
+            return jsonify({
+                'id': message.id,
+                'body': message.body,
+                'body_loaded': message.body_loaded
+            })
+
+    except PoolTimeoutError as e:
+        app_logger.warning(f"本文取得で接続待ちがタイムアウトしました: {str(e)}")
+        response = jsonify({'error': 'IMAP接続が混み合っています。しばらくしてから再度お試しください。'})
+        response.headers['Retry-After'] = str(POOL_REQUEST_ACQUIRE_TIMEOUT)
+        return response, 503
+    except Exception as e:
+        app_logger.error(f"本文取得エラー: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/connection_pool_stats')
+def connection_pool_stats():
+    """IMAP接続プールの統計（ヒット/ミス/待機）とサーバーごとのレート制御の状態を返す"""
+    if 'email' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    metrics = connection_pool.get_metrics()
+    metrics['rate_control'] = get_rate_control_stats()
+    return jsonify(metrics)
+
+@app.cli.command('backfill-search-vectors')
+@click.option('--all', 'rebuild_all', is_flag=True, help='作成済みのものも含めて作り直す')
+@click.option('--batch-size', default=SEARCH_BACKFILL_BATCH_SIZE, show_default=True)
+def backfill_search_vectors(rebuild_all, batch_size):
+    """既存メッセージの検索用の列（body_tsvとCJKのsearch_ngrams）をバッチごとに作成する"""
+    with session_scope() as db_session:
+        updated = EmailMessage.backfill_search_vectors(db_session, only_missing=not rebuild_all,
+                                                       batch_size=batch_size)
+        ngrams_updated = EmailMessage.backfill_search_ngrams(db_session, only_missing=not rebuild_all,
+                                                             batch_size=batch_size)
+    print(f"body_tsvを作成しました: {updated}件")
+    print(f"search_ngramsを作成しました: {ngrams_updated}件")
+
+@app.cli.command('rebuild-contact-stats')
+def rebuild_contact_stats():
+    """email_messageからサイドバーの連絡先集計（contact_stats）を作り直す"""
+    with session_scope() as db_session:
+        rebuilt = ContactStats.rebuild(db_session)
+    print(f"連絡先集計を再作成しました: {rebuilt}件")
+
 @app.route('/logout')
 def logout():
     session.clear()
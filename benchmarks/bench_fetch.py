@@ -0,0 +1,84 @@
+"""
+1件ずつのFETCHとパイプライン化した UID FETCH のスループット比較
+
+使い方:
+    python -m benchmarks.bench_fetch --messages 500 --latency 0.005
+"""
+import argparse
+import imaplib
+import time
+from email.message import EmailMessage as EmailMsg
+
+from benchmarks.fake_imap_server import FakeIMAPServer, FakeMailbox
+from utils.imap_fetch import stream_uid_fetch
+
+
+def build_mailbox(count: int, body_size: int) -> FakeMailbox:
+    mailbox = FakeMailbox()
+    for i in range(count):
+        msg = EmailMsg()
+        msg['Subject'] = f'ベンチマーク {i}'
+        msg['From'] = f'sender{i % 20}@example.com'
+        msg['To'] = 'me@example.com'
+        msg['Message-ID'] = f'<bench{i}@example.com>'
+        msg['Date'] = 'Thu, 1 Dec 2024 10:00:00 +0900'
+        msg.set_content('本文テキスト ' * (body_size // 20))
+        mailbox.add_message('INBOX', msg.as_bytes())
+    return mailbox
+
+
+def _connect(server: FakeIMAPServer) -> imaplib.IMAP4:
+    conn = imaplib.IMAP4('127.0.0.1', server.port)
+    conn.login('bench@example.com', 'password')
+    conn.select('INBOX')
+    return conn
+
+
+def run_sequential(server: FakeIMAPServer, uids) -> int:
+    """従来方式: 1メッセージにつき1往復"""
+    conn = _connect(server)
+    received = 0
+    for uid in uids:
+        status, data = conn.uid('FETCH', str(uid), '(RFC822)')
+        if status == 'OK' and data and data[0]:
+            received += len(data[0][1])
+    conn.logout()
+    return received
+
+
+def run_pipelined(server: FakeIMAPServer, uids, batch_size: int) -> int:
+    """バッチ単位の UID FETCH をストリーミングで受信"""
+    conn = _connect(server)
+    received = 0
+    for i in range(0, len(uids), batch_size):
+        for record in stream_uid_fetch(conn, uids[i:i + batch_size], '(UID RFC822)'):
+            received += len(record.get('RFC822') or b'')
+    conn.logout()
+    return received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.005, help='コマンドごとの応答遅延（秒）')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--body-size', type=int, default=2000)
+    args = parser.parse_args()
+
+    mailbox = build_mailbox(args.messages, args.body_size)
+    uids = [uid for uid, _ in mailbox.messages('INBOX')]
+
+    with FakeIMAPServer(mailbox, latency=args.latency) as server:
+        for label, runner in (
+            ('sequential', lambda: run_sequential(server, uids)),
+            ('pipelined', lambda: run_pipelined(server, uids, args.batch_size)),
+        ):
+            start = time.perf_counter()
+            received = runner()
+            elapsed = time.perf_counter() - start
+            print(f"{label:<11} {len(uids) / elapsed:10.1f} msg/s  "
+                  f"{received / len(uids):8.0f} bytes/msg  {elapsed:7.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+check_new_emails と Celeryの sync_emails タスクのエンドツーエンド計測
+
+合成メールボックスを入れたFakeIMAPServerに対して同期を実行し、
+msg/s・bytes/msg（サーバーが送信したバイト数÷保存件数）・ピークRSSを表示する。
+シナリオごとに別プロセスで実行するため、ピークRSSはシナリオ単位の値になる
+（パース用ワーカープロセスの分は children として別に表示する）。
+
+保存先には BENCH_DATABASE_URL のPostgreSQLを使う。実行のたびにメール関連の
+テーブルを空にするので、必ず計測専用のデータベースを指定すること。
+
+使い方:
+    BENCH_DATABASE_URL=postgresql://localhost/mailchat_bench \\
+        python -m benchmarks.bench_sync --messages 2000 --latency 0.002 --throttle-every 25
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from typing import Any, Dict
+
+from benchmarks.fake_imap_server import FakeIMAPServer
+from benchmarks.mailbox_generator import build_mailbox, describe
+
+BENCH_EMAIL = 'bench@example.com'
+TARGETS = ('check_new_emails', 'sync_emails')
+
+
+def _reset_database() -> None:
+    from database import db
+    from models import Contact, ContactStats, EmailAttachment, EmailMessage, EmailSettings, FolderSyncState
+
+    db.create_all()
+    for model in (EmailAttachment, EmailMessage, Contact, ContactStats, FolderSyncState, EmailSettings):
+        db.session.query(model).delete()
+    db.session.commit()
+
+
+def _run_target(target: str, port: int, options: Dict[str, Any], queue) -> None:
+    """子プロセスで1シナリオを実行し、結果をキューに返す"""
+    os.environ['DATABASE_URL'] = options['database_url']
+    from app import app, save_parsed_messages
+    from database import db, session_scope
+    from email_handler import EmailHandler
+    from models import EmailMessage
+
+    with app.app_context():
+        _reset_database()
+        start = time.perf_counter()
+        if target == 'check_new_emails':
+            handler = EmailHandler(BENCH_EMAIL, 'password', '127.0.0.1', imap_port=port, use_ssl=False)
+            if not handler.connect():
+                raise ConnectionError(handler.last_error)
+            with session_scope() as session:
+                handler.check_new_emails(
+                    session=session,
+                    writer=lambda batch: save_parsed_messages(session, batch),
+                    parallel_folders=options['parallel_folders'],
+                    preview_bytes=options['preview_bytes'],
+                )
+            handler.disconnect()
+        else:
+            from celery_worker import sync_emails
+            sync_emails.run(BENCH_EMAIL, 'password', '127.0.0.1', imap_port=port, use_ssl=False)
+        elapsed = time.perf_counter() - start
+        saved = db.session.query(EmailMessage).count()
+
+    queue.put({
+        'elapsed': elapsed,
+        'saved': saved,
+        # Linuxでは KiB 単位
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_rss_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    })
+
+
+def run_target(server: FakeIMAPServer, target: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    for name in server.stats:
+        server.stats[name] = 0
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_target, args=(target, server.port, options, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{target} の実行に失敗しました (exit code {process.exitcode})")
+    result = queue.get()
+    result.update(server.stats)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--body-size', type=int, default=2000)
+    parser.add_argument('--attachment-ratio', type=float, default=0.2)
+    parser.add_argument('--latency', type=float, default=0.0, help='コマンドごとの応答遅延（秒）')
+    parser.add_argument('--throttle-every', type=int, default=0, help='N回目ごとのFETCHをスロットリングする')
+    parser.add_argument('--disconnect-every', type=int, default=0, help='N回目ごとのFETCHで切断する')
+    parser.add_argument('--parallel-folders', type=int, default=2)
+    parser.add_argument('--preview-bytes', type=int, default=0)
+    parser.add_argument('--target', choices=TARGETS, action='append', help='計測対象（省略時は両方）')
+    args = parser.parse_args()
+
+    database_url = os.environ.get('BENCH_DATABASE_URL')
+    if not database_url:
+        sys.exit('BENCH_DATABASE_URL に計測専用のデータベースを指定してください')
+
+    mailbox = build_mailbox(args.messages, seed=args.seed, body_size=args.body_size,
+                            attachment_ratio=args.attachment_ratio)
+    print(f"mailbox: {describe(mailbox)}")
+    options = {
+        'database_url': database_url,
+        'parallel_folders': args.parallel_folders,
+        'preview_bytes': args.preview_bytes or None,
+    }
+
+    with FakeIMAPServer(mailbox, latency=args.latency, throttle_every=args.throttle_every,
+                        disconnect_every=args.disconnect_every) as server:
+        for target in args.target or TARGETS:
+            result = run_target(server, target, options)
+            saved = result['saved'] or 1
+            print(f"{target:<17} {result['saved'] / result['elapsed']:9.1f} msg/s  "
+                  f"{result['bytes_sent'] / saved:9.0f} bytes/msg  "
+                  f"peak RSS {result['peak_rss_kib'] / 1024:7.1f} MiB "
+                  f"(children {result['children_rss_kib'] / 1024:.1f} MiB)  "
+                  f"saved {result['saved']}  {result['elapsed']:.2f}s  "
+                  f"fetches {result['fetches']} throttled {result['throttled']} "
+                  f"disconnects {result['disconnects']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,513 @@
+"""
+ベンチマーク・テスト用のインプロセスIMAP4サーバー
+
+実サーバーの代わりにローカルで起動し、コマンドごとの応答遅延と、
+スロットリング（NO [THROTTLED]）・切断の注入を設定できる。
+EmailHandlerやFETCH層のスループット計測に使う。
+"""
+import email
+import email.utils
+import hashlib
+import re
+import select
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class FakeMailbox:
+    """フォルダーごとのメッセージ（UID, RFC822バイト列）を保持する"""
+
+    def __init__(self, uidvalidity: int = 1):
+        self.uidvalidity = uidvalidity
+        self.folders: Dict[str, List[Tuple[int, bytes]]] = {'INBOX': []}
+        # Gmail拡張用のラベル（(フォルダー, UID) → ラベルのリスト）
+        self.labels: Dict[Tuple[str, int], List[str]] = {}
+        # CONDSTORE/QRESYNC用のフラグとMODSEQ（(フォルダー, UID) → 値）
+        self.flags: Dict[Tuple[str, int], List[str]] = {}
+        self.modseqs: Dict[Tuple[str, int], int] = {}
+        self.vanished: Dict[str, List[Tuple[int, int]]] = {}  # フォルダー → [(UID, 削除時のMODSEQ)]
+        self.highest_modseq = 1
+        self.next_uids: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def add_message(self, folder: str, raw: bytes, labels: Optional[List[str]] = None) -> int:
+        with self.lock:
+            messages = self.folders.setdefault(folder, [])
+            uid = self.next_uids.get(folder, messages[-1][0] + 1 if messages else 1)
+            self.next_uids[folder] = uid + 1
+            messages.append((uid, raw))
+            if labels is not None:
+                self.labels[(folder, uid)] = list(labels)
+            self.modseqs[(folder, uid)] = self._bump_modseq()
+            return uid
+
+    def set_flags(self, folder: str, uid: int, flags: List[str]) -> None:
+        """フラグを変更する（STOREに相当し、MODSEQが進む）"""
+        with self.lock:
+            self.flags[(folder, uid)] = list(flags)
+            self.modseqs[(folder, uid)] = self._bump_modseq()
+
+    def expunge(self, folder: str, uid: int) -> None:
+        """メッセージを削除し、VANISHED応答用に記録する"""
+        with self.lock:
+            self.folders[folder] = [message for message in self.folders[folder] if message[0] != uid]
+            self.modseqs.pop((folder, uid), None)
+            self.vanished.setdefault(folder, []).append((uid, self._bump_modseq()))
+
+    def _bump_modseq(self) -> int:
+        self.highest_modseq += 1
+        return self.highest_modseq
+
+    def uidnext(self, folder: str) -> int:
+        with self.lock:
+            messages = self.folders.get(folder, [])
+            return self.next_uids.get(folder, messages[-1][0] + 1 if messages else 1)
+
+    def messages(self, folder: str) -> List[Tuple[int, bytes]]:
+        with self.lock:
+            return list(self.folders.get(folder, []))
+
+
+# FETCH項目名（BODY.PEEK[HEADER.FIELDS (FROM TO)] のような括弧入りも1項目）
+_FETCH_ITEM = re.compile(r'[^\s()\[\]]+(?:\[[^\]]*\](?:<[\d.]+>)?)?')
+# UID FETCHの修飾子 (CHANGEDSINCE 12 VANISHED)
+_CHANGEDSINCE = re.compile(r'\s*\(CHANGEDSINCE (\d+)( VANISHED)?\)\s*$', re.IGNORECASE)
+
+
+def _header_fields(raw: bytes, fields) -> bytes:
+    """指定されたヘッダーだけを取り出す"""
+    msg = email.message_from_bytes(raw)
+    wanted = {f.lower() for f in fields}
+    lines = [f'{name}: {value}' for name, value in msg.items() if name.lower() in wanted]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+
+def _quote(value) -> str:
+    if value is None:
+        return 'NIL'
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+
+def gmail_ids(raw: bytes) -> Tuple[int, int]:
+    """Message-ID（スレッドはReferencesの先頭）から決まるX-GM-MSGID / X-GM-THRIDを返す"""
+    msg = email.message_from_bytes(raw)
+    # Message-IDがなくてもメッセージごとに別のIDにする
+    message_id = (msg['message-id'] or '').strip() or hashlib.md5(raw).hexdigest()
+    root = ((msg['references'] or '').split() or [message_id])[0]
+
+    def to_id(value: str) -> int:
+        return int(hashlib.md5(value.encode()).hexdigest()[:15], 16)
+
+    return to_id(message_id), to_id(root)
+
+
+def _encoded_payload(part) -> bytes:
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, bytes):
+        return payload
+    return str(payload).encode('utf-8', errors='surrogateescape')
+
+
+def _bodystructure(part) -> str:
+    """email.message.Message からBODYSTRUCTUREの文字列を組み立てる"""
+    if part.is_multipart():
+        children = ''.join(_bodystructure(child) for child in part.get_payload())
+        return f'({children} {_quote(part.get_content_subtype().upper())})'
+
+    params = [(k, email.utils.collapse_rfc2231_value(v)) for k, v in part.get_params()[1:]] \
+        if part.get_params() else []
+    params_str = '(' + ' '.join(f'{_quote(k.upper())} {_quote(v)}' for k, v in params) + ')' if params else 'NIL'
+    encoding = part.get('Content-Transfer-Encoding', '7BIT').upper()
+    payload = _encoded_payload(part)
+
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_param('filename', header='content-disposition')
+        dsp_params = f'({_quote("FILENAME")} {_quote(email.utils.collapse_rfc2231_value(filename))})' \
+            if filename else 'NIL'
+        dsp = f'({_quote(disposition.upper())} {dsp_params})'
+    else:
+        dsp = 'NIL'
+
+    fields = (f'{_quote(part.get_content_maintype().upper())} {_quote(part.get_content_subtype().upper())} '
+              f'{params_str} NIL NIL {_quote(encoding)} {len(payload)}')
+    if part.get_content_maintype() == 'text':
+        lines = payload.count(b'\n') + 1
+        return f'({fields} {lines} NIL {dsp} NIL NIL)'
+    return f'({fields} NIL {dsp} NIL NIL)'
+
+
+def _section_payload(raw: bytes, section: str) -> bytes:
+    """BODY[1.2] のようなセクション番号のパート本文（エンコードされたまま）を返す"""
+    part = email.message_from_bytes(raw)
+    for number in section.split('.'):
+        index = int(number)
+        if part.is_multipart():
+            part = part.get_payload()[index - 1]
+        elif index != 1:
+            return b''
+    return _encoded_payload(part)
+
+
+def _parse_sequence_set(spec: str, max_value: int) -> List[Tuple[int, int]]:
+    ranges = []
+    for part in spec.split(','):
+        if ':' in part:
+            start, end = part.split(':', 1)
+        else:
+            start = end = part
+        start_value = max_value if start == '*' else int(start)
+        end_value = max_value if end == '*' else int(end)
+        ranges.append((min(start_value, end_value), max(start_value, end_value)))
+    return ranges
+
+
+def _format_uid_set(uids: List[int]) -> str:
+    """[1, 2, 3, 7] → '1:3,7'"""
+    parts = []
+    for uid in sorted(uids):
+        if parts and parts[-1][1] == uid - 1:
+            parts[-1][1] = uid
+        else:
+            parts.append([uid, uid])
+    return ','.join(str(start) if start == end else f'{start}:{end}' for start, end in parts)
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """1接続分のIMAPセッションを処理する"""
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.selected: Optional[str] = None
+        self.qresync = False
+
+    def send_line(self, line: str) -> None:
+        self.send_bytes(line.encode('utf-8') + b'\r\n')
+
+    def send_bytes(self, data: bytes) -> None:
+        self.server.count('bytes_sent', len(data))
+        self.wfile.write(data)
+
+    def handle(self):
+        self.send_line('* OK FakeIMAP ready')
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.decode('utf-8', errors='replace').rstrip('\r\n')
+            if not line:
+                continue
+            tag, _, rest = line.partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+
+            latency = self.server.latency
+            if latency:
+                time.sleep(latency)
+
+            fault = self.server.next_fault(command, args)
+            if fault == 'disconnect':
+                # 応答せずに切断する（サーバー側のタイムアウトや再起動に相当）
+                break
+            if fault == 'throttle':
+                self.send_line(f'{tag} NO [THROTTLED] Too many commands, try again later')
+                self.wfile.flush()
+                continue
+
+            handler = getattr(self, f'cmd_{command.lower()}', None)
+            if handler is None:
+                self.send_line(f'{tag} BAD unknown command {command}')
+                self.wfile.flush()
+                continue
+            if handler(tag, args) is False:
+                break
+            self.wfile.flush()
+
+    # --- 認証・状態管理 -------------------------------------------------
+
+    def cmd_capability(self, tag, args):
+        self.send_line('* CAPABILITY ' + ' '.join(self.server.capabilities))
+        self.send_line(f'{tag} OK CAPABILITY completed')
+
+    def cmd_login(self, tag, args):
+        self.send_line(f'{tag} OK LOGIN completed')
+
+    def cmd_enable(self, tag, args):
+        enabled = [name for name in args.upper().split() if name in self.server.capabilities]
+        self.qresync = self.qresync or 'QRESYNC' in enabled
+        self.send_line(f'* ENABLED {" ".join(enabled)}'.rstrip())
+        self.send_line(f'{tag} OK ENABLE completed')
+
+    def cmd_noop(self, tag, args):
+        # 選択中のフォルダーの現在のメッセージ数を通知する（IDLE非対応時のポーリング用）
+        if self.selected:
+            self.send_line(f'* {len(self.server.mailbox.messages(self.selected))} EXISTS')
+        self.send_line(f'{tag} OK NOOP completed')
+
+    def cmd_logout(self, tag, args):
+        self.send_line('* BYE logging out')
+        self.send_line(f'{tag} OK LOGOUT completed')
+        self.wfile.flush()
+        return False
+
+    def cmd_list(self, tag, args):
+        special = {'[Gmail]/All Mail': ' \\All', '[Gmail]/Sent Mail': ' \\Sent'}
+        for folder in self.server.mailbox.folders:
+            self.send_line(f'* LIST (\\HasNoChildren{special.get(folder, "")}) "/" "{folder}"')
+        self.send_line(f'{tag} OK LIST completed')
+
+    def cmd_select(self, tag, args):
+        folder = args.strip().strip('"')
+        if folder not in self.server.mailbox.folders:
+            self.send_line(f'{tag} NO no such mailbox')
+            return
+        self.selected = folder
+        messages = self.server.mailbox.messages(folder)
+        uidnext = self.server.mailbox.uidnext(folder)
+        self.send_line(f'* {len(messages)} EXISTS')
+        self.send_line('* 0 RECENT')
+        self.send_line(f'* OK [UIDVALIDITY {self.server.mailbox.uidvalidity}] UIDs valid')
+        self.send_line(f'* OK [UIDNEXT {uidnext}] Predicted next UID')
+        if 'CONDSTORE' in self.server.capabilities:
+            self.send_line(f'* OK [HIGHESTMODSEQ {self.server.mailbox.highest_modseq}] Highest')
+        self.send_line(f'{tag} OK [READ-WRITE] SELECT completed')
+
+    cmd_examine = cmd_select
+
+    def cmd_idle(self, tag, args):
+        """DONEを受け取るまで待機し、メッセージの増減をEXISTSとEXPUNGE（QRESYNC有効時はVANISHED）で通知する"""
+        self.send_line('+ idling')
+        self.wfile.flush()
+        known = [uid for uid, _ in self.server.mailbox.messages(self.selected)]
+        while True:
+            readable, _, _ = select.select([self.request], [], [], 0.05)
+            if readable:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b'DONE':
+                    break
+                continue
+            current = [uid for uid, _ in self.server.mailbox.messages(self.selected)]
+            if current == known:
+                continue
+            remaining = set(current)
+            removed = [uid for uid in known if uid not in remaining]
+            if removed and self.qresync:
+                self.send_line(f'* VANISHED {_format_uid_set(removed)}')
+            else:
+                # 後ろから通知すれば、前のメッセージのシーケンス番号はずれない
+                for uid in reversed(removed):
+                    self.send_line(f'* {known.index(uid) + 1} EXPUNGE')
+            if len(current) > len(known) - len(removed):
+                self.send_line(f'* {len(current)} EXISTS')
+            known = current
+            self.wfile.flush()
+        self.send_line(f'{tag} OK IDLE terminated')
+
+    def cmd_close(self, tag, args):
+        self.selected = None
+        self.send_line(f'{tag} OK CLOSE completed')
+
+    # --- 検索・取得 -------------------------------------------------------
+
+    def cmd_search(self, tag, args):
+        messages = self.server.mailbox.messages(self.selected)
+        numbers = ' '.join(str(i) for i in range(1, len(messages) + 1))
+        self.send_line(f'* SEARCH {numbers}'.rstrip())
+        self.send_line(f'{tag} OK SEARCH completed')
+
+    def cmd_fetch(self, tag, args):
+        spec, _, items = args.partition(' ')
+        messages = self.server.mailbox.messages(self.selected)
+        selected = []
+        for start, end in _parse_sequence_set(spec, len(messages)):
+            for seq in range(start, end + 1):
+                if 1 <= seq <= len(messages):
+                    selected.append((seq, messages[seq - 1]))
+        self._send_fetch(selected, items, include_uid=False)
+        self.send_line(f'{tag} OK FETCH completed')
+
+    def cmd_uid(self, tag, args):
+        subcommand, _, rest = args.partition(' ')
+        subcommand = subcommand.upper()
+        messages = self.server.mailbox.messages(self.selected)
+        max_uid = messages[-1][0] if messages else 0
+
+        if subcommand == 'SEARCH':
+            criteria = rest.strip()
+            match = re.search(r'UID (\S+)', criteria, re.IGNORECASE)
+            header = re.search(r'HEADER (\S+) "?([^"]*)"?', criteria, re.IGNORECASE)
+            gm_msgid = re.search(r'X-GM-MSGID (\d+)', criteria, re.IGNORECASE)
+            if gm_msgid:
+                uids = [uid for uid, raw in messages if gmail_ids(raw)[0] == int(gm_msgid.group(1))]
+            elif header:
+                name, value = header.group(1), header.group(2)
+                uids = [uid for uid, raw in messages
+                        if value in (email.message_from_bytes(raw).get(name) or '')]
+            elif match:
+                ranges = _parse_sequence_set(match.group(1), max_uid)
+                uids = [uid for uid, _ in messages if any(s <= uid <= e for s, e in ranges)]
+            else:
+                uids = [uid for uid, _ in messages]
+            self.send_line(f'* SEARCH {" ".join(map(str, uids))}'.rstrip())
+            self.send_line(f'{tag} OK UID SEARCH completed')
+            return
+
+        if subcommand == 'FETCH':
+            spec, _, items = rest.partition(' ')
+            ranges = _parse_sequence_set(spec, max_uid)
+            selected = [
+                (seq, message) for seq, message in enumerate(messages, start=1)
+                if any(start <= message[0] <= end for start, end in ranges)
+            ]
+            changed_since = _CHANGEDSINCE.search(items)
+            if changed_since:
+                # CONDSTORE: 指定MODSEQより後に変わったものだけを返す
+                items = items[:changed_since.start()].rstrip()
+                modseq = int(changed_since.group(1))
+                modseqs = self.server.mailbox.modseqs
+                selected = [(seq, message) for seq, message in selected
+                            if modseqs.get((self.selected, message[0]), 0) > modseq]
+                if changed_since.group(2) and self.qresync:
+                    vanished = [uid for uid, removed_at in self.server.mailbox.vanished.get(self.selected, [])
+                                if removed_at > modseq and any(s <= uid <= e for s, e in ranges)]
+                    if vanished:
+                        self.send_line(f'* VANISHED (EARLIER) {_format_uid_set(vanished)}')
+                items = items[:-1] + ' MODSEQ)' if items.endswith(')') else items + ' MODSEQ'
+            self._send_fetch(selected, items, include_uid=True)
+            self.send_line(f'{tag} OK UID FETCH completed')
+            return
+
+        self.send_line(f'{tag} BAD unsupported UID command')
+
+    def _fetch_item(self, name: str, raw: bytes, uid: int = 0) -> Tuple[str, Optional[bytes]]:
+        """FETCH項目1つ分の (応答テキスト, リテラル) を返す"""
+        upper = name.upper()
+        if upper == 'X-GM-MSGID':
+            return f'X-GM-MSGID {gmail_ids(raw)[0]}', None
+        if upper == 'X-GM-THRID':
+            return f'X-GM-THRID {gmail_ids(raw)[1]}', None
+        if upper == 'X-GM-LABELS':
+            labels = self.server.mailbox.labels.get((self.selected, uid), [])
+            quoted = [label if re.fullmatch(r'[^\s()"]+', label) else _quote(label) for label in labels]
+            return f'X-GM-LABELS ({" ".join(quoted)})', None
+        if upper == 'RFC822.SIZE':
+            return f'RFC822.SIZE {len(raw)}', None
+        if upper == 'FLAGS':
+            return f'FLAGS ({" ".join(self.server.mailbox.flags.get((self.selected, uid), []))})', None
+        if upper == 'MODSEQ':
+            return f'MODSEQ ({self.server.mailbox.modseqs.get((self.selected, uid), 0)})', None
+        if upper == 'BODYSTRUCTURE':
+            return f'BODYSTRUCTURE {_bodystructure(email.message_from_bytes(raw))}', None
+        if upper in ('RFC822', 'BODY[]', 'BODY.PEEK[]'):
+            label = 'RFC822' if upper == 'RFC822' else 'BODY[]'
+            return label, raw
+
+        match = re.match(r'BODY(?:\.PEEK)?\[(?P<section>[^\]]*)\](?:<(?P<start>\d+)\.(?P<length>\d+)>)?',
+                         name, re.IGNORECASE)
+        if match:
+            section = match.group('section')
+            label = f'BODY[{section}]'
+            if match.group('start') is not None and re.fullmatch(r'[\d.]+', section):
+                # 部分取得 (BODY[1]<0.8192>) は開始位置付きのラベルで返す
+                start, length = int(match.group('start')), int(match.group('length'))
+                return f'{label}<{start}>', _section_payload(raw, section)[start:start + length]
+            fields = re.match(r'HEADER\.FIELDS \(([^)]*)\)', section, re.IGNORECASE)
+            if fields:
+                return label, _header_fields(raw, fields.group(1).split())
+            if section.upper() == 'HEADER':
+                header = re.split(rb'\r?\n\r?\n', raw, maxsplit=1)[0]
+                return label, header + b'\r\n\r\n'
+            if re.fullmatch(r'[\d.]+', section):
+                return label, _section_payload(raw, section)
+        return '', None
+
+    def _send_fetch(self, selected, items: str, include_uid: bool) -> None:
+        names = _FETCH_ITEM.findall(items)
+        for seq, (uid, raw) in selected:
+            parts = []
+            if include_uid or any(n.upper() == 'UID' for n in names):
+                parts.append((f'UID {uid}', None))
+            for name in names:
+                if name.upper() == 'UID':
+                    continue
+                text, literal = self._fetch_item(name, raw, uid)
+                if text:
+                    parts.append((text, literal))
+
+            out = f'* {seq} FETCH ('.encode()
+            for index, (text, literal) in enumerate(parts):
+                if index:
+                    out += b' '
+                out += text.encode()
+                if literal is not None:
+                    out += f' {{{len(literal)}}}\r\n'.encode() + literal
+            out += b')\r\n'
+            self.send_bytes(out)
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """バックグラウンドスレッドで動くIMAPサーバー"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: Optional[FakeMailbox] = None, latency: float = 0.0,
+                 host: str = '127.0.0.1', port: int = 0, throttle_every: int = 0, disconnect_every: int = 0):
+        """
+        Args:
+            latency: コマンドごとの応答遅延（秒）
+            throttle_every: N回目ごとのFETCHを NO [THROTTLED] で拒否する（0なら無効）
+            disconnect_every: N回目ごとのFETCHで応答せずに切断する（0なら無効）
+        """
+        super().__init__((host, port), FakeIMAPHandler)
+        self.mailbox = mailbox or FakeMailbox()
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.disconnect_every = disconnect_every
+        self.capabilities = ['IMAP4rev1', 'UIDPLUS', 'IDLE']
+        self.stats = {'fetches': 0, 'throttled': 0, 'disconnects': 0, 'bytes_sent': 0}
+        self._stats_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def count(self, name: str, amount: int = 1) -> int:
+        with self._stats_lock:
+            self.stats[name] += amount
+            return self.stats[name]
+
+    def next_fault(self, command: str, args: str) -> Optional[str]:
+        """このコマンドに注入する障害（'throttle' / 'disconnect' / None）を返す"""
+        is_fetch = command == 'FETCH' or (command == 'UID' and args.upper().startswith('FETCH'))
+        if not is_fetch:
+            return None
+        fetches = self.count('fetches')
+        if self.disconnect_every and fetches % self.disconnect_every == 0:
+            self.count('disconnects')
+            return 'disconnect'
+        if self.throttle_every and fetches % self.throttle_every == 0:
+            self.count('throttled')
+            return 'throttle'
+        return None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> 'FakeIMAPServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,106 @@
+"""
+ベンチマーク用の合成メールボックス
+
+日本語・英語・中国語・韓国語・ロシア語などの本文、ISO-2022-JPなどの文字コード、
+multipart/alternative（HTML付き）、添付ファイル、スレッド（References）を
+シード値から決定的に生成する。
+"""
+import random
+from email.message import EmailMessage as EmailMsg
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+from benchmarks.fake_imap_server import FakeMailbox
+
+# (言語, 文字コード, 件名, 本文の1文)
+LANGUAGES: Sequence[Tuple[str, str, str, str]] = (
+    ('ja', 'iso-2022-jp', '打ち合わせの件', '来週の打ち合わせの日程についてご確認をお願いいたします。'),
+    ('ja', 'utf-8', '請求書の送付', 'ご請求書を添付いたしましたので、ご査収のほどよろしくお願いいたします。'),
+    ('en', 'us-ascii', 'Quarterly report', 'Please find the quarterly numbers and the open action items below.'),
+    ('zh', 'utf-8', '项目进度更新', '本周项目进展顺利，请查看附件中的详细报告。'),
+    ('ko', 'utf-8', '회의 일정 안내', '다음 주 회의 일정을 확인해 주시기 바랍니다.'),
+    ('ru', 'koi8-r', 'Отчёт за неделю', 'Пожалуйста, ознакомьтесь с отчётом и подтвердите получение.'),
+    ('de', 'iso-8859-1', 'Besprechung am Montag', 'Könnten Sie bitte die Unterlagen für die Besprechung vorbereiten?'),
+    ('mixed', 'utf-8', 'Re: 資料 / slides 🚀', '資料を更新しました。Updated the slides — 确认一下 👍'),
+)
+
+ATTACHMENTS = (
+    ('application', 'pdf', 'report.pdf'),
+    ('image', 'png', 'screenshot.png'),
+    ('application', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet', '売上データ.xlsx'),
+)
+
+
+def _body(sentence: str, rng: random.Random, body_size: int) -> str:
+    lines = []
+    size = 0
+    while size < body_size:
+        lines.append(sentence if rng.random() < 0.7 else f'{sentence} ({rng.randint(1, 9999)})')
+        size += len(lines[-1].encode('utf-8')) + 1
+    return '\n'.join(lines) + '\n'
+
+
+def generate_message(index: int, rng: random.Random, body_size: int = 2000, html_ratio: float = 0.5,
+                     attachment_ratio: float = 0.2, attachment_size: int = 50_000,
+                     contacts: int = 50, thread_ratio: float = 0.3,
+                     owner: str = 'me@example.com', sent: bool = False) -> bytes:
+    """1通分のRFC822バイト列を生成する"""
+    lang, charset, subject, sentence = LANGUAGES[rng.randrange(len(LANGUAGES))]
+    contact = f'"{lang}-contact{index % contacts}" <contact{index % contacts}@{lang}.example.com>'
+
+    msg = EmailMsg()
+    msg['Subject'] = f'{subject} #{index}'
+    msg['From'] = owner if sent else contact
+    msg['To'] = contact if sent else owner
+    msg['Message-ID'] = f'<synthetic{index}@example.com>'
+    date = datetime(2024, 1, 1, tzinfo=timezone(timedelta(hours=9))) + timedelta(minutes=17 * index)
+    msg['Date'] = format_datetime(date)
+    if index and rng.random() < thread_ratio:
+        root = rng.randrange(index)
+        msg['In-Reply-To'] = f'<synthetic{root}@example.com>'
+        msg['References'] = f'<synthetic{root}@example.com>'
+
+    text = _body(sentence, rng, body_size)
+    try:
+        text.encode(charset)
+    except UnicodeEncodeError:
+        charset = 'utf-8'
+    msg.set_content(text, charset=charset)
+    if rng.random() < html_ratio:
+        paragraphs = ''.join(f'<p>{line}</p>' for line in text.splitlines())
+        msg.add_alternative(f'<html><body>{paragraphs}</body></html>', subtype='html', charset='utf-8')
+    if rng.random() < attachment_ratio:
+        maintype, subtype, filename = ATTACHMENTS[rng.randrange(len(ATTACHMENTS))]
+        payload = rng.randbytes(attachment_size) if hasattr(rng, 'randbytes') \
+            else bytes(rng.getrandbits(8) for _ in range(attachment_size))
+        msg.add_attachment(payload, maintype=maintype, subtype=subtype, filename=filename)
+    return msg.as_bytes()
+
+
+def generate_messages(count: int, seed: int = 0, sent_ratio: float = 0.2,
+                      **options) -> Iterator[Tuple[bool, bytes]]:
+    """(送信済みか, RFC822バイト列) を count 件生成する"""
+    rng = random.Random(seed)
+    for index in range(count):
+        sent = rng.random() < sent_ratio
+        yield sent, generate_message(index, rng, sent=sent, **options)
+
+
+def build_mailbox(count: int, seed: int = 0, sent_folder: Optional[str] = '[Gmail]/Sent Mail',
+                  mailbox: Optional[FakeMailbox] = None, **options) -> FakeMailbox:
+    """INBOXと送信済みフォルダーに合成メッセージを入れたFakeMailboxを返す"""
+    mailbox = mailbox or FakeMailbox()
+    for sent, raw in generate_messages(count, seed=seed, **options):
+        mailbox.add_message(sent_folder if sent and sent_folder else 'INBOX', raw)
+    return mailbox
+
+
+def describe(mailbox: FakeMailbox) -> Dict[str, int]:
+    """フォルダーごとの件数と合計サイズ"""
+    summary = {}
+    for folder in mailbox.folders:
+        messages = mailbox.messages(folder)
+        summary[folder] = len(messages)
+        summary[f'{folder}:bytes'] = sum(len(raw) for _, raw in messages)
+    return summary
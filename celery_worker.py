@@ -2,9 +2,10 @@ from celery import Celery
 from datetime import datetime, timedelta
 from sqlalchemy import or_
 import traceback
-from models import EmailMessage
+from models import EmailMessage, FolderSyncState
 from database import session_scope
-from email_handler import EmailHandler
+from utils.connection_pool import connection_pool
+from utils.bulk_writer import write_messages
 
 def make_celery(app_name=__name__):
     celery = Celery(
@@ -17,7 +18,7 @@ def make_celery(app_name=__name__):
 celery = make_celery('email_tasks')
 
 @celery.task
-def sync_emails(email, password, imap_server):
+def sync_emails(email, password, imap_server, imap_port=None, use_ssl=True):
     """メールを同期するタスク"""
     from app import create_app
     import time
@@ -27,11 +28,12 @@ def sync_emails(email, password, imap_server):
     app = create_app()
     
     with app.app_context():
+        handler = None
         try:
-            handler = EmailHandler(email, password, imap_server)
+            handler = connection_pool.acquire(email, password, imap_server, imap_port=imap_port, use_ssl=use_ssl)
             print("IMAPサーバーに接続成功")
             
-            folders = [b'INBOX']
+            folders = ['INBOX']
             sent_folder = handler.get_gmail_folders()
             if sent_folder:
                 folders.append(sent_folder)
@@ -46,13 +48,15 @@ def sync_emails(email, password, imap_server):
             }
 
             for folder in folders:
+                # apply_imap_changes や fetch_full_body が同じ値で行を探せるよう、_sync_folderと同じ文字列で保存する
+                folder = handler.decode_folder_name(folder)
                 if not handler.select_folder(folder):
                     print(f"フォルダ選択失敗: {folder}")
                     continue
                 
                 folder_start_time = time.time()
                 print(f"\nフォルダ処理開始: {folder}")
-                stats['folder_stats'][str(folder)] = {
+                stats['folder_stats'][folder] = {
                     'processed': 0,
                     'new': 0,
                     'updated': 0,
@@ -60,83 +64,54 @@ def sync_emails(email, password, imap_server):
                 }
                 
                 try:
-                    _, messages = handler.conn.search(None, 'ALL')
-                    message_nums = messages[0].split()[-100:]  # 最新100件のみ
-                    message_count = len(message_nums)
+                    uids = handler.search_new_uids(0)[-100:]  # 最新100件のみ
+                    message_count = len(uids)
                     print(f"フォルダ内のメッセージ数（最新100件）: {message_count}")
                     
                     # バッチ処理用の設定
                     batch_size = 50
                     for i in range(0, message_count, batch_size):
-                        batch_nums = message_nums[i:i + batch_size]
+                        batch_uids = uids[i:i + batch_size]
                         batch_start_time = time.time()
                         
-                        for num in batch_nums:
-                            # メッセージのパースと保存部分
-                            try:
-                                with session_scope() as session:
-                                    _, msg_data = handler.conn.fetch(num, '(RFC822)')
-                                    email_body = msg_data[0][1]
-                                    
-                                    # デバッグ情報
-                                    print("\n=== メッセージ同期開始 ===")
-                                    print(f"Message number: {num}")
-                                    
-                                    # メッセージのパースと結果確認
-                                    parsed_msg = handler.parse_email_message(email_body)
-                                    print("\n=== パース結果 ===")
-                                    print(f"Message ID: {parsed_msg['message_id']}")
-                                    print(f"Subject: {parsed_msg['subject']}")
-                                    print(f"From: {parsed_msg['from']}")
-                                    print(f"To: {parsed_msg['to']}")
-                                    print(f"Body length: {len(parsed_msg['body']) if parsed_msg['body'] else 0}")
-                                    print(f"Body preview: {parsed_msg['body'][:100] if parsed_msg['body'] else 'No body'}")
-                                    
-                                    if parsed_msg['message_id']:
-                                        # データベースに保存する前にNoneチェック
-                                        subject = parsed_msg['subject'] if parsed_msg['subject'] else '(件名なし)'
-                                        body = parsed_msg['body'] if parsed_msg['body'] else ''
-                                        
-                                        existing_message = session.query(EmailMessage)\
-                                            .filter_by(message_id=parsed_msg['message_id'])\
-                                            .first()
-                                        
-                                        if existing_message:
-                                            print(f"メッセージ更新: ID={parsed_msg['message_id']}")
-                                            existing_message.subject = subject
-                                            existing_message.body = body
-                                            existing_message.last_sync = datetime.utcnow()
-                                            stats['total_updated'] += 1
-                                            stats['folder_stats'][str(folder)]['updated'] += 1
-                                        else:
-                                            print(f"新規メッセージ保存: ID={parsed_msg['message_id']}")
-                                            new_message = EmailMessage(
-                                                message_id=parsed_msg['message_id'],
-                                                from_address=parsed_msg['from'],
-                                                to_address=parsed_msg['to'],
-                                                from_contact_id=parsed_msg['from_contact_id'],
-                                                to_contact_id=parsed_msg['to_contact_id'],
-                                                subject=subject,
-                                                body=body,
-                                                date=parsed_msg['date'],
-                                                is_sent=parsed_msg['is_sent'],
-                                                folder=str(folder),
-                                                last_sync=datetime.utcnow()
-                                            )
-                                            session.add(new_message)
-                                            stats['total_new'] += 1
-                                            stats['folder_stats'][str(folder)]['new'] += 1
-                                        
-                                        session.commit()
-                                        print("メッセージ保存成功")
-                                    else:
-                                        print("メッセージIDなし: スキップ")
-                            except Exception as e:
-                                print(f"メッセージ処理エラー: {str(e)}")
-                                traceback.print_exc()
+                        # バッチ全体を1回の UID FETCH で取得し、まとめてパースする
+                        parsed_batch = []
+                        for record in handler.fetch_messages(batch_uids, '(UID FLAGS RFC822)'):
+                            uid = record.get('UID')
+                            stats['total_processed'] += 1
+                            stats['folder_stats'][folder]['processed'] += 1
+                            parsed_msg = handler.parse_email_message(record.get('RFC822'))
+                            if not parsed_msg:
                                 stats['total_errors'] += 1
-                                stats['folder_stats'][str(folder)]['errors'] += 1
+                                stats['folder_stats'][folder]['errors'] += 1
                                 continue
+                            if not parsed_msg['message_id']:
+                                print(f"メッセージIDなし: スキップ (UID: {uid})")
+                                continue
+                            parsed_msg['subject'] = parsed_msg['subject'] or '(件名なし)'
+                            parsed_msg['body'] = parsed_msg['body'] or ''
+                            parsed_msg['folder'] = folder
+                            parsed_msg['uid'] = uid
+                            parsed_msg['imap_account'] = email
+                            parsed_msg['imap_folder'] = folder
+                            parsed_msg['flags'] = ' '.join(str(flag) for flag in record.get('FLAGS') or [])
+                            parsed_msg['is_sent'] = folder == sent_folder
+                            parsed_batch.append(parsed_msg)
+
+                        # 既存メッセージは件名・本文を更新し、新規メッセージは一括INSERTする
+                        try:
+                            with session_scope() as session:
+                                write_stats = write_messages(session, parsed_batch, update_existing=True)
+                            stats['total_new'] += write_stats['inserted']
+                            stats['total_updated'] += write_stats['updated']
+                            stats['folder_stats'][folder]['new'] += write_stats['inserted']
+                            stats['folder_stats'][folder]['updated'] += write_stats['updated']
+                        except Exception as e:
+                            print(f"バッチ保存エラー: {str(e)}")
+                            traceback.print_exc()
+                            stats['total_errors'] += len(parsed_batch)
+                            stats['folder_stats'][folder]['errors'] += len(parsed_batch)
+                            continue
                         
                         batch_time = time.time() - batch_start_time
                         print(f"バッチ処理完了 ({i+1}-{min(i+batch_size, message_count)}/{message_count}): {batch_time:.2f}秒")
@@ -144,14 +119,15 @@ def sync_emails(email, password, imap_server):
                     folder_time = time.time() - folder_start_time
                     print(f"\nフォルダ処理完了: {folder}")
                     print(f"処理時間: {folder_time:.2f}秒")
-                    print(f"統計: {stats['folder_stats'][str(folder)]}")
+                    print(f"統計: {stats['folder_stats'][folder]}")
                     
                 except Exception as e:
                     print(f"フォルダ処理エラー ({folder}): {str(e)}")
                     traceback.print_exc()
                     continue
 
-            handler.disconnect()
+            connection_pool.release(handler)
+            handler = None
             total_time = time.time() - start_time
             print(f"\n同期完了サマリー:")
             print(f"総処理時間: {total_time:.2f}秒")
@@ -166,29 +142,155 @@ def sync_emails(email, password, imap_server):
         except Exception as e:
             print(f"メール同期エラー: {str(e)}")
             traceback.print_exc()
+            if handler is not None:
+                connection_pool.release(handler, discard=True)
             raise e
 
+def _write_async_chunk(app, email_address, items):
+    """非同期同期で届いたチャンクをパース・保存し、チェックポイントと一緒にコミットする"""
+    from models import EmailSettings, FolderSyncState
+    from utils.sync_pipeline import CONTROL_KEY, parse_raw_items
+
+    with app.app_context():
+        with session_scope() as session:
+            parsed = [item for item in parse_raw_items(email_address, items) if CONTROL_KEY not in item]
+            sync_states = {}
+            # UIDVALIDITYが変わったフォルダーは、古いUIDの位置を消してから新しいUIDで書き込む
+            for marker in items:
+                if marker.get(CONTROL_KEY) == 'checkpoint' and marker['folder'] not in sync_states:
+                    sync_state = FolderSyncState.get_or_create(session, email_address, marker['folder'])
+                    sync_state.reset_if_uidvalidity_changed(marker['uidvalidity'])
+                    sync_states[marker['folder']] = sync_state
+            write_messages(session, parsed)
+            for marker in items:
+                if marker.get(CONTROL_KEY) == 'checkpoint':
+                    sync_states[marker['folder']].record_progress(marker['last_uid'], marker['saved'], marker['skipped'])
+            email_settings = session.query(EmailSettings).filter_by(email=email_address).first()
+            if email_settings:
+                email_settings.renew_sync_lease()
+
+
+@celery.task
+def sync_accounts_async(accounts):
+    """多数のアカウントを1つのイベントループで同期するタスク
+
+    accounts: [{'email': ..., 'password': ..., 'imap_server': ...}, ...]
+    IMAPの待ち時間ではスレッドを消費せず、DBへの書き込みだけを1本のスレッドで行う。
+    新着はUIDだけで同期し、HIGHESTMODSEQ・Gmailの情報・フラグには触れない
+    （フラグ変更・削除はスレッド版の check_new_emails が取得する）。
+    """
+    import asyncio
+    import os
+    import socket
+    from concurrent.futures import ThreadPoolExecutor
+    from app import create_app
+    from models import EmailSettings, FolderSyncState
+    from utils.async_imap import AsyncSyncEngine
+    from utils.message_index import ExistingMessageIndex
+    from utils.sync_pipeline import CONTROL_KEY, WRITE_BATCH_SIZE
+
+    app = create_app()
+    owner = f"{socket.gethostname()}:{os.getpid()}:async"
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='async-sync-db')
+
+    def make_emit(email_address):
+        buffer = []
+
+        async def emit(item):
+            buffer.append(item)
+            # チェックポイントに達したら、そこまでをまとめて保存する
+            if item.get(CONTROL_KEY) == 'checkpoint' or len(buffer) >= WRITE_BATCH_SIZE * 2:
+                chunk = list(buffer)
+                buffer.clear()
+                await asyncio.get_running_loop().run_in_executor(
+                    db_executor, _write_async_chunk, app, email_address, chunk
+                )
+
+        return emit
+
+    with app.app_context():
+        with session_scope() as session:
+            jobs = []
+            for account in accounts:
+                # スレッド版の同期と同時に走らないよう、同じ同期リースを取る
+                email_settings = session.query(EmailSettings)\
+                    .filter_by(email=account['email'])\
+                    .with_for_update()\
+                    .first()
+                if email_settings and not email_settings.acquire_sync_lease(owner):
+                    print(f"別のプロセスが同期中のためスキップ: {account['email']}")
+                    continue
+                # 同期するフォルダー（INBOXと送信済み）は接続後にLISTで決める
+                states = session.query(FolderSyncState).filter_by(account_email=account['email']).all()
+                jobs.append({
+                    'email_address': account['email'],
+                    'password': account['password'],
+                    'imap_server': account['imap_server'],
+                    'checkpoints': {state.folder: (state.last_uid or 0, state.uidvalidity) for state in states},
+                    'message_index': ExistingMessageIndex.from_session(session),
+                    'emit': make_emit(account['email']),
+                })
+
+            session.commit()
+
+            results = {}
+            try:
+                engine = AsyncSyncEngine(app.config.get('IMAP_SERVER_CONNECTION_LIMITS'),
+                                         app.config.get('IMAP_DEFAULT_SERVER_CONNECTION_LIMIT'))
+                results = asyncio.run(engine.run(jobs))
+            finally:
+                db_executor.shutdown(wait=True)
+                interrupted = [job['email_address'] for job in jobs if job['email_address'] not in results]
+                if interrupted:
+                    # エンジンが途中で止まった場合も、取ったリースを期限切れまで残さない
+                    session.rollback()
+                    for email_settings in session.query(EmailSettings).filter(EmailSettings.email.in_(interrupted)):
+                        email_settings.release_sync_lease("ERROR", "非同期同期が中断されました")
+                    session.commit()
+
+            for email, outcome in results.items():
+                if not isinstance(outcome, BaseException):
+                    # UIDNEXTなどの記録はスレッド版と同じ処理で行う
+                    for result in outcome:
+                        if result['selected']:
+                            FolderSyncState.get_or_create(session, email, result['folder']).record_result(result)
+                email_settings = session.query(EmailSettings).filter_by(email=email).first()
+                if email_settings:
+                    if isinstance(outcome, BaseException):
+                        email_settings.release_sync_lease("ERROR", str(outcome))
+                    else:
+                        email_settings.release_sync_lease("SUCCESS")
+
+    failed = [email for email, outcome in results.items() if isinstance(outcome, BaseException)]
+    synced = len(results) - len(failed)
+    print(f"非同期同期完了: {synced}件成功, 失敗: {failed}")
+    print(f"サーバー別接続数: {engine.get_stats()}")
+    return {'synced': synced, 'failed': failed}
+
 @celery.task
 def sync_old_contacts():
-    """古いメッセージを定期的に同期"""
+    """既存メッセージの変更を追跡できていないフォルダーを報告する
+
+    フラグ変更と削除は通常の同期でCONDSTORE/QRESYNC（CHANGEDSINCE）により
+    変更分だけ取得するため、全メッセージのlast_syncを消して取り直すことはしない。
+    HIGHEST MODSEQがないフォルダー（サーバー非対応）だけをログに出す。
+    """
     from app import create_app
-    
+
     app = create_app()
     with app.app_context():
         try:
             with session_scope() as session:
-                # 24時間以上同期していないメッセージを取得
-                old_messages = session.query(EmailMessage)\
+                stale_states = session.query(FolderSyncState)\
+                    .filter(FolderSyncState.highest_modseq == None)\
                     .filter(or_(
-                        EmailMessage.last_sync == None,
-                        EmailMessage.last_sync <= datetime.utcnow() - timedelta(hours=24)
+                        FolderSyncState.last_sync == None,
+                        FolderSyncState.last_sync <= datetime.utcnow() - timedelta(hours=24)
                     ))\
                     .all()
-                
-                for msg in old_messages:
-                    msg.last_sync = None
-                session.commit()
-                
+                for state in stale_states:
+                    print(f"CONDSTORE非対応のため変更を追跡できません: {state.account_email} {state.folder}")
+
         except Exception as e:
             print(f"古いメッセージの同期エラー: {str(e)}")
             traceback.print_exc()
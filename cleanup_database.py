@@ -8,6 +8,7 @@ with app.app_context():
         with db.session.begin():
             # メールデータのみを削除
             db.session.execute(text('DELETE FROM email_message;'))
+            db.session.execute(text('DELETE FROM contact_stats;'))
             db.session.commit()
             print("メールデータを完全に削除しました")
     except Exception as e:
@@ -1,20 +1,32 @@
 import imaplib
-from typing import List, Set, Optional, Dict, Any
+from typing import Callable, List, Set, Optional, Dict, Any
 import email
-from email.utils import parsedate_to_datetime
+from email.utils import getaddresses, parsedate_to_datetime
 from email.header import decode_header
+import os
 import socket
+import select
+import ssl
 import time
 import random
 import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import logging
 import re
+from flask import current_app, has_app_context
 from database import session_scope
 import hashlib
 from utils.process_lock import ProcessLock
-from models import EmailMessage, EmailSettings
+from utils.imap_fetch import stream_uid_fetch, find_fetch_item, parse_fetch_response, find_sent_folder
+from utils.imap_fetch import IdleCommand, supports_raw_idle
+from utils.bodystructure import parse_bodystructure, find_text_part, list_attachments, decode_part
+from utils.message_index import ExistingMessageIndex
+from utils.rate_control import AIMDBatchController, classify_error, get_server_bucket
+from utils.sync_pipeline import SyncPipeline, CONTROL_KEY, WRITE_BATCH_SIZE
+from utils.contact_cache import ContactCache, get_contact_cache, imap_date
+from models import EmailMessage, EmailSettings, FolderSyncState
 
 
 
@@ -25,15 +37,42 @@ app_logger = logging.getLogger('mailchat')
 MAX_RETRIES = 5
 CONNECTION_TIMEOUT = 30
 RECONNECT_INTERVAL = 300  # 5分
-BATCH_DELAY = 1.0
 RETRY_DELAY = 2  # 基本待機時間
-MAX_BATCH_SIZE = 50
-MIN_BATCH_SIZE = 5
+INITIAL_BATCH_SIZE = 100  # FETCHバッチサイズの初期値（応答時間に応じてAIMDで調整）
+MAX_BATCH_SIZE = 500
+MIN_BATCH_SIZE = 10
+BATCH_TARGET_LATENCY = 5.0  # この時間内にバッチが返ってくる間はバッチを大きくする（秒）
 MAX_BACKOFF_TIME = 30  # 最大バックオフ時間（秒）
+MAX_THROTTLE_RETRIES = 3  # スロットリングされたバッチを取り直す回数の上限
 SOCKET_TIMEOUT = 60  # ソケットタイムアウト（秒）
 KEEPALIVE_INTERVAL = 60  # キープアライブ間隔（秒）
 MAX_CONNECTION_AGE = 600  # 最大接続維持時間（秒）
 
+IDLE_RENEW_INTERVAL = 25 * 60  # サーバー側の29分タイムアウトより前にIDLEを再発行
+IDLE_POLL_INTERVAL = 60  # IDLE非対応サーバーでのNOOPポーリング間隔（秒）
+
+# imaplibはIDLEコマンドを知らないため登録しておく
+imaplib.Commands.setdefault('IDLE', ('AUTH', 'SELECTED'))
+# QRESYNCを有効にした接続では、削除はEXPUNGEではなくVANISHED（UIDの集合）で通知される
+IDLE_EVENT = re.compile(rb'\* (?:(\d+) (EXISTS|EXPUNGE)|(VANISHED) (.+))', re.IGNORECASE)
+
+# 重複判定用に先に取得するヘッダー（本文はダウンロードしない）
+HEADER_FETCH_ITEMS = '(UID RFC822.SIZE FLAGS BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)])'
+# Gmail（X-GM-EXT-1）ではメッセージID・スレッドID・ラベルも一緒に取得する
+GMAIL_HEADER_FETCH_ITEMS = '(UID RFC822.SIZE FLAGS X-GM-MSGID X-GM-THRID X-GM-LABELS ' \
+    'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)])'
+# VANISHED (EARLIER) 41,43:116 の応答
+VANISHED_RESPONSE = re.compile(rb'^(?:\(EARLIER\)\s*)?(?P<uids>[\d:,]+)$', re.IGNORECASE)
+# \All 属性を返さないサーバー向けの「すべてのメール」の名前
+GMAIL_ALL_MAIL_NAMES = ('[Gmail]/All Mail', '[Gmail]/すべてのメール', '[Google Mail]/All Mail')
+GMAIL_SENT_FOLDER = '[Gmail]/Sent Mail'
+
+# フォルダー並列同期で同時に使う接続数（1なら逐次処理）
+SYNC_PARALLEL_FOLDERS = 2
+PARALLEL_ACQUIRE_TIMEOUT = 5  # 並列用の接続が空くまでの待機時間（秒）
+CONTACTS_SINCE_DAYS = 90  # get_contactsで対象にする期間（日）
+CONTACT_FETCH_ITEMS = '(UID BODY.PEEK[HEADER.FIELDS (FROM TO)])'
+
 class ConnectionState:
     DISCONNECTED = "DISCONNECTED"
     CONNECTED = "CONNECTED"
@@ -42,18 +81,27 @@ class ConnectionState:
     ERROR = "ERROR"
     
 class EmailHandler:
-    def __init__(self, email_address: str, password: str, imap_server: str):
+    def __init__(self, email_address: str, password: str, imap_server: str,
+                 imap_port: Optional[int] = None, use_ssl: bool = True):
         self.email_address = email_address
         self.password = password
         self.imap_server = imap_server
-        self.connection: Optional[imaplib.IMAP4_SSL] = None
+        self.imap_port = imap_port  # Noneなら993（SSL）/ 143
+        self.use_ssl = use_ssl
+        self.connection: Optional[imaplib.IMAP4] = None
         self.last_activity = None
-        self.connection_lock = threading.Lock()
+        self.connection_lock = threading.RLock()  # verify_connection_state内からconnectを呼ぶため再入可能にする
         self.current_state = ConnectionState.DISCONNECTED
         self.current_folder: Optional[str] = None
         self.last_error: Optional[str] = None
         self.connection_attempts = 0
         self.last_reconnect_time = 0
+        self.folder_status: Dict[str, Optional[int]] = {}
+        self.qresync_enabled = False  # 接続ごとにENABLE QRESYNCした場合True
+        self.batch_controller = AIMDBatchController(
+            INITIAL_BATCH_SIZE, MIN_BATCH_SIZE, MAX_BATCH_SIZE, target_latency=BATCH_TARGET_LATENCY
+        )
+        self.rate_limiter = get_server_bucket(imap_server)
 
     def _update_state(self, new_state: str, error: Optional[str] = None) -> None:
         """接続状態を更新し、必要に応じてログを出力"""
@@ -118,7 +166,10 @@ class EmailHandler:
                 
                 try:
                     app_logger.debug(f"Creating new connection to {self.imap_server}...")
-                    self.connection = imaplib.IMAP4_SSL(self.imap_server)
+                    if self.use_ssl:
+                        self.connection = imaplib.IMAP4_SSL(self.imap_server, self.imap_port or imaplib.IMAP4_SSL_PORT)
+                    else:
+                        self.connection = imaplib.IMAP4(self.imap_server, self.imap_port or imaplib.IMAP4_PORT)
                     
                     # ソケットレベルのタイムアウト設定
                     self.connection.socket().settimeout(adjusted_timeout)
@@ -133,6 +184,8 @@ class EmailHandler:
                     app_logger.debug("Attempting login...")
                     self.connection.login(self.email_address, self.password)
                     app_logger.debug("Login successful")
+                    # QRESYNCはSELECTより前にENABLEする必要がある
+                    self._enable_extensions()
                     
                     # 接続状態の更新
                     self._update_state(ConnectionState.AUTH)
@@ -167,11 +220,26 @@ class EmailHandler:
 
     def _handle_connection_error(self) -> None:
         """接続エラーの処理とバックオフ"""
-        backoff_time = min(RETRY_DELAY * (2 ** (self.connection_attempts - 1)), 30)
-        app_logger.debug(f"Backing off for {backoff_time} seconds...")
-        time.sleep(backoff_time)
+        self._backoff("connection error", self.connection_attempts - 1)
         self.disconnect()
 
+    def _backoff(self, reason: str, attempt: int = 0) -> None:
+        """接続レベルの再試行前に待機する（指数バックオフ＋ジッター）
+
+        待機時間は RETRY_DELAY から始まり MAX_BACKOFF_TIME で頭打ちになる。
+        この待機はアカウント単位で、サーバー共有のトークンバケットのレートは
+        下げない（パスワード誤りの再試行が同じサーバーの他アカウントを遅くしないため）。
+        """
+        backoff_time = min(RETRY_DELAY * (2 ** max(attempt, 0)) + random.uniform(0, 1), MAX_BACKOFF_TIME)
+        app_logger.debug(f"Backing off for {backoff_time:.2f} seconds ({reason})")
+        time.sleep(backoff_time)
+
+    def get_rate_stats(self) -> Dict[str, Any]:
+        """現在のバッチサイズとサーバーへのコマンドレートを返す"""
+        stats = self.batch_controller.get_stats()
+        stats.update(self.rate_limiter.get_stats())
+        return stats
+
     def disconnect(self) -> None:
         """IMAPサーバーから切断する（改善版）"""
         if self.connection:
@@ -187,6 +255,7 @@ class EmailHandler:
                     pass
             finally:
                 self.connection = None
+                self.qresync_enabled = False
                 self.current_folder = None
                 self._update_state(ConnectionState.DISCONNECTED)
                 self.last_activity = None
@@ -216,10 +285,7 @@ class EmailHandler:
                 for attempt in range(max_attempts):
                     try:
                         if attempt > 0:
-                            # 指数バックオフにジッターを追加
-                            backoff_time = min(2 ** attempt + random.uniform(0, 1), 15)
-                            app_logger.debug(f"Backing off for {backoff_time:.2f} seconds before reconnection attempt {attempt + 1}")
-                            time.sleep(backoff_time)
+                            self._backoff(f"reconnection attempt {attempt + 1}", attempt - 1)
                         
                         # 既存の接続を確実にクリーンアップ
                         self.disconnect()
@@ -265,8 +331,8 @@ class EmailHandler:
         max_attempts = 3
         for attempt in range(max_attempts):
             try:
-                backoff_time = min(2 ** attempt, 10)
-                time.sleep(backoff_time)
+                if attempt > 0:
+                    self._backoff(f"refresh attempt {attempt + 1}", attempt - 1)
                 
                 if self.connect():
                     app_logger.debug("Connection refreshed successfully")
@@ -296,15 +362,10 @@ class EmailHandler:
             
             # 再接続試行回数を制限し、バックオフを改善
             max_attempts = 3
-            base_delay = 2
             for attempt in range(max_attempts):
                 try:
                     if attempt > 0:
-                        # 指数バックオフにジッターを追加
-                        jitter = random.uniform(0, 1)
-                        backoff_time = min(base_delay * (2 ** attempt) + jitter, 20)
-                        app_logger.debug(f"Backing off for {backoff_time:.2f} seconds before retry attempt {attempt + 1}/{max_attempts}")
-                        time.sleep(backoff_time)
+                        self._backoff(f"FETCH retry attempt {attempt + 1}/{max_attempts}", attempt - 1)
                     
                     # 接続状態をリセット
                     self.disconnect()
@@ -324,15 +385,145 @@ class EmailHandler:
                     if attempt < max_attempts - 1:
                         continue
                     
-                # 最後の試行が失敗した場合はより長い待機時間を設定
+                # 最後の試行が失敗した場合は長めに待機
                 if attempt == max_attempts - 1:
-                    time.sleep(min(base_delay * (2 ** (attempt + 1)), 30))
+                    self._backoff("FETCH recovery failed", attempt)
                         
             app_logger.error("Failed to recover from FETCH error after multiple attempts")
             # 接続の完全リセット
             self.disconnect()
         return False
 
+    def _enable_extensions(self) -> None:
+        """QRESYNCに対応していればENABLEする（削除されたUIDをVANISHEDで受け取るため）"""
+        self.qresync_enabled = False
+        if not (self.has_capability('QRESYNC') and self.has_capability('ENABLE')):
+            return
+        try:
+            status, _ = self.connection.enable('QRESYNC')
+            self.qresync_enabled = status == 'OK'
+        except imaplib.IMAP4.error as e:
+            app_logger.warning(f"QRESYNCを有効にできませんでした: {str(e)}")
+
+    def fetch_changes(self, last_uid: int, modseq: Optional[int]) -> Optional[Dict[str, Any]]:
+        """前回のMODSEQ以降に変わったフラグと、削除されたUIDを取得する
+
+        CONDSTOREの CHANGEDSINCE で変更分だけを受け取り、QRESYNCが有効なら
+        VANISHED で削除されたUIDも受け取る。件数は変更の数に比例する。
+        非対応サーバーや初回同期ではNoneを返す。
+        """
+        if not last_uid or not modseq or not self.has_capability('CONDSTORE'):
+            return None
+
+        modifier = f"(CHANGEDSINCE {modseq}{' VANISHED' if self.qresync_enabled else ''})"
+        self.rate_limiter.acquire()
+        self.connection.untagged_responses.pop('VANISHED', None)
+        status, data = self.connection.uid('FETCH', f'1:{last_uid}', '(UID FLAGS)', modifier)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH CHANGEDSINCE failed: {status} {data}")
+
+        flags = {}
+        for record in parse_fetch_response([chunk for chunk in data or [] if chunk]):
+            if record.get('UID') is not None:
+                flags[record['UID']] = ' '.join(str(flag) for flag in record.get('FLAGS') or [])
+
+        vanished: List[int] = []
+        for line in self.connection.untagged_responses.pop('VANISHED', None) or []:
+            vanished.extend(self.parse_vanished(line))
+        self.last_activity = datetime.now()
+        return {'flags': flags, 'vanished': vanished}
+
+    @staticmethod
+    def parse_vanished(data: bytes) -> List[int]:
+        """VANISHED応答（"(EARLIER) 3:5,9" など）のUIDをリストにする"""
+        match = VANISHED_RESPONSE.match(data.strip())
+        if not match:
+            return []
+        uids: List[int] = []
+        for part in match.group('uids').decode().split(','):
+            start, _, end = part.partition(':')
+            uids.extend(range(int(start), int(end or start) + 1))
+        return uids
+
+    def has_capability(self, name: str) -> bool:
+        """サーバーが指定のCAPABILITYを持っているか"""
+        if not self.connection:
+            return False
+        return name.upper() in (cap.upper() for cap in self.connection.capabilities)
+
+    def _input_pending(self) -> bool:
+        """受信済み（またはバッファ済み）の応答があるかをブロックせずに確認する"""
+        sock = self.connection.socket()
+        original_timeout = sock.gettimeout()
+        try:
+            sock.setblocking(False)
+            return bool(self.connection.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(original_timeout)
+
+    def idle(self, timeout: float = IDLE_RENEW_INTERVAL, stop_event: Optional[threading.Event] = None) -> List[tuple]:
+        """選択中のフォルダーでIDLE待機し、受け取った (種類, 番号) のイベントを返す
+
+        EXISTS/EXPUNGE/VANISHEDを受信するか、timeout秒経過するか、stop_eventがセットされると
+        DONEを送ってIDLEを終了する。IDLE非対応サーバーや、imaplibの内部APIが
+        使えない場合はNOOPでポーリングする。接続が切れた場合は ConnectionError を送出する。
+        VANISHEDは削除されたUIDごとに ('VANISHED', UID) のイベントにする。
+        """
+        if not self.verify_connection_state(['SELECTED'], allow_reconnect=False):
+            raise Exception("IDLE requires a selected folder")
+
+        conn = self.connection
+        lines: List[bytes] = []
+
+        if not self.has_capability('IDLE') or not supports_raw_idle(conn):
+            waited = 0.0
+            while waited < min(timeout, IDLE_POLL_INTERVAL):
+                if stop_event and stop_event.wait(1.0):
+                    break
+                waited += 1.0
+            conn.noop()
+        else:
+            command = IdleCommand(conn)
+            command.start()
+
+            deadline = time.time() + timeout
+            sock = conn.socket()
+            try:
+                while not (stop_event and stop_event.is_set()):
+                    if not self._input_pending():
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        select.select([sock], [], [], min(remaining, 1.0))
+                        continue
+                    line = command.read_line()
+                    lines.append(line)
+                    if IDLE_EVENT.match(line) or line.startswith(b'* BYE'):
+                        break
+            finally:
+                command.done()
+
+        # DONE/NOOPの応答中に届いた通知も拾う
+        for kind in ('EXISTS', 'EXPUNGE'):
+            for number in conn.untagged_responses.pop(kind, []):
+                lines.append(b'* ' + number + b' ' + kind.encode())
+        for uids in conn.untagged_responses.pop('VANISHED', []):
+            lines.append(b'* VANISHED ' + uids)
+
+        self.last_activity = datetime.now()
+        events = []
+        for line in lines:
+            match = IDLE_EVENT.match(line)
+            if not match:
+                continue
+            if match.group(3):
+                events.extend(('VANISHED', uid) for uid in self.parse_vanished(match.group(4)))
+            else:
+                events.append((match.group(2).decode().upper(), int(match.group(1))))
+        return events
+
     def get_gmail_folders(self):
         """Gmailの特殊フォルダーを取得する"""
         try:
@@ -340,20 +531,51 @@ class EmailHandler:
                 raise Exception("Invalid connection state")
 
             _, folders = self.connection.list()
-            sent_folder = None
+            return find_sent_folder(folder_info.decode().split('"/"')[-1].strip() for folder_info in folders)
 
-            for folder_info in folders:
-                folder_name = folder_info.decode().split('"/"')[-1].strip()
-                if '[Gmail]/送信済みメール' in folder_name or '[Gmail]/Sent Mail' in folder_name:
-                    sent_folder = folder_name.strip('"')
-                    break
+        except Exception as e:
+            app_logger.error(f"フォルダー取得エラー: {str(e)}")
+            return None
+
+    def is_gmail(self) -> bool:
+        """GmailのIMAP拡張（X-GM-MSGID / X-GM-THRID / X-GM-LABELS）が使えるか"""
+        return self.has_capability('X-GM-EXT-1')
 
-            return sent_folder
+    def get_all_mail_folder(self) -> Optional[str]:
+        """Gmailの「すべてのメール」フォルダー名を返す（\\All 属性か既知の名前で判定）"""
+        try:
+            if not self.verify_connection_state(['AUTH', 'SELECTED']):
+                raise Exception("Invalid connection state")
+
+            _, folders = self.connection.list()
+            by_name = None
+            for folder_info in folders or []:
+                if not isinstance(folder_info, bytes):
+                    continue
+                text = folder_info.decode('utf-8', errors='replace')
+                folder_name = text.split('"/"')[-1].strip().strip('"')
+                if '\\All' in text.split(')')[0]:
+                    return folder_name
+                if folder_name in GMAIL_ALL_MAIL_NAMES:
+                    by_name = folder_name
+            return by_name
 
         except Exception as e:
             app_logger.error(f"フォルダー取得エラー: {str(e)}")
             return None
 
+    @staticmethod
+    def folder_from_labels(labels: List[Any], sent_folder: Optional[str] = None) -> tuple:
+        """X-GM-LABELSから (表示用のフォルダー, 送信済みか) を決める"""
+        labels = [str(label) for label in labels or []]
+        is_sent = '\\Sent' in labels
+        if '\\Inbox' in labels:
+            return 'INBOX', is_sent
+        if is_sent:
+            return sent_folder or GMAIL_SENT_FOLDER, True
+        user_labels = [label for label in labels if not label.startswith('\\')]
+        return (user_labels[0] if user_labels else None), is_sent
+
     def select_folder(self, folder):
         """フォルダーを選択し、必要に応じて再接続を行う"""
         if not self.verify_connection_state(['AUTH', 'SELECTED']):
@@ -368,7 +590,8 @@ class EmailHandler:
             # 選択したフォルダーのメッセージ数を取得
             message_count = int(data[0])
             app_logger.debug(f"Selected folder contains {message_count} messages")
-            
+
+            self.folder_status = self._read_folder_status(message_count)
             self.current_folder = folder
             self._update_state(ConnectionState.SELECTED)
             return True
@@ -377,23 +600,482 @@ class EmailHandler:
             app_logger.error(f"フォルダー選択エラー: {str(e)}")
             return False
 
-    def check_new_emails(self, session=None):
-        """新着メールをチェックし、バッチ処理で取得・保存する（改善版）"""
+    def _read_folder_status(self, message_count: int) -> Dict[str, Optional[int]]:
+        """SELECT応答からUIDVALIDITY/UIDNEXT/HIGHESTMODSEQを取り出す"""
+        status: Dict[str, Optional[int]] = {'exists': message_count}
+        for code in ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+            _, data = self.connection.response(code)
+            value = data[-1] if data else None
+            try:
+                status[code.lower()] = int(value) if value is not None else None
+            except (TypeError, ValueError):
+                status[code.lower()] = None
+        app_logger.debug(f"Folder status: {status}")
+        return status
+
+    def search_new_uids(self, last_uid: int) -> List[int]:
+        """最後に同期したUIDより新しいメッセージのUIDを取得する"""
+        status, data = self.connection.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+        if status != 'OK':
+            raise Exception(f"UID SEARCH failed: {status}")
+        if not data or not data[0]:
+            return []
+        # "n:*" は該当がなくても最大UIDを返すため、last_uid以下を除外する
+        return sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+
+    def fetch_messages(self, uids: List[int], items: str = '(UID RFC822)'):
+        """UIDのバッチを1回の UID FETCH で取得し、応答が届いた順にレコードを返す"""
+        if not uids:
+            return
+        if 'UID' not in items.upper():
+            items = f"(UID {items.strip('()')})"
+        self.rate_limiter.acquire()
+        for record in stream_uid_fetch(self.connection, uids, items):
+            self.last_activity = datetime.now()
+            yield record
+
+    def fetch_headers(self, uids: List[int], gmail: bool = False) -> List[Dict[str, Any]]:
+        """ヘッダーとサイズだけを取得し、UIDごとのMessage-IDを返す
+
+        gmail=True の場合はX-GM-MSGID・X-GM-THRID・X-GM-LABELSも返す。
+        """
+        headers = []
+        for record in self.fetch_messages(uids, GMAIL_HEADER_FETCH_ITEMS if gmail else HEADER_FETCH_ITEMS):
+            header_bytes = find_fetch_item(record, 'BODY[HEADER') or b''
+            msg = email.message_from_bytes(header_bytes)
+            header = {
+                'uid': record.get('UID'),
+                'size': record.get('RFC822.SIZE') or 0,
+                'message_id': msg['message-id'],
+                'flags': ' '.join(str(flag) for flag in record.get('FLAGS') or []),
+            }
+            if gmail:
+                header['gm_msgid'] = record.get('X-GM-MSGID')
+                header['gm_thrid'] = record.get('X-GM-THRID')
+                labels = record.get('X-GM-LABELS')
+                header['labels'] = labels if isinstance(labels, list) else []
+            headers.append(header)
+        return headers
+
+    def fetch_message_parts(self, uids: List[int], max_text_bytes: Optional[int] = None):
+        """BODYSTRUCTUREで本文パートを特定し、そのパートだけを未パースのまま取得する
+
+        添付ファイルはダウンロードせず、名前・サイズ・種類だけを記録する。
+        max_text_bytesを指定すると本文パートは先頭だけを取得する（BODY.PEEK[1]<0.N>）。
+        {'uid', 'header', 'text', 'text_part', 'attachments', 'partial'} の辞書を返す。
+        """
+        structures: Dict[int, Dict[str, Any]] = {}
+        for record in self.fetch_messages(uids, '(UID BODYSTRUCTURE BODY.PEEK[HEADER])'):
+            parts = parse_bodystructure(record.get('BODYSTRUCTURE'))
+            text_part = find_text_part(parts)
+            uid = record.get('UID')
+            structures[uid] = {
+                'uid': uid,
+                'header': find_fetch_item(record, 'BODY[HEADER'),
+                'text': None,
+                'text_part': text_part,
+                'attachments': list_attachments(parts, text_part),
+                'partial': bool(max_text_bytes and text_part and text_part['size'] > max_text_bytes),
+            }
+
+        # 本文パートのセクション番号ごとにまとめて1回のFETCHで取得
+        uids_by_section: Dict[str, List[int]] = {}
+        for uid, info in structures.items():
+            if info['text_part'] is None:
+                yield info
+            else:
+                uids_by_section.setdefault(info['text_part']['section'], []).append(uid)
+
+        partial = f'<0.{max_text_bytes}>' if max_text_bytes else ''
+        for section, section_uids in uids_by_section.items():
+            for record in self.fetch_messages(section_uids, f'(UID BODY.PEEK[{section}]{partial})'):
+                info = structures.get(record.get('UID'))
+                if info is None:
+                    continue
+                info['text'] = find_fetch_item(record, f'BODY[{section}]')
+                yield info
+
+    def fetch_message_texts(self, uids: List[int], max_text_bytes: Optional[int] = None):
+        """本文パートだけを取得してパースし、(uid, parsed_msg) を返す"""
+        for info in self.fetch_message_parts(uids, max_text_bytes):
+            yield info['uid'], self.parse_fetched_message(
+                info['header'], info['text'], info['text_part'], info['attachments'], info['partial']
+            )
+
+    def fetch_full_body(self, folder: str, uid: Optional[int], message_id: Optional[str],
+                        gm_msgid: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """プレビューだけ保存したメッセージの本文全体を取得する
+
+        UIDで見つからない場合（UIDVALIDITYの変更など）はMessage-IDで検索し直す。
+        Gmailモードで保存したメッセージ（gm_msgidあり）のUIDは「すべてのメール」のもの。
+        """
+        if gm_msgid and self.is_gmail():
+            folder = self.get_all_mail_folder() or folder
+        if not self.select_folder(folder):
+            return None
+
+        candidates = [uid] if uid else []
+        for attempt in range(2):
+            for found_uid, parsed_msg in self.fetch_message_texts(candidates):
+                if parsed_msg and (not message_id or parsed_msg['message_id'] == message_id):
+                    parsed_msg['uid'] = found_uid
+                    return parsed_msg
+            if attempt or not message_id:
+                break
+            if gm_msgid and self.is_gmail():
+                status, data = self.connection.uid('SEARCH', None, 'X-GM-MSGID', str(gm_msgid))
+            else:
+                status, data = self.connection.uid('SEARCH', None, 'HEADER', 'Message-ID', f'"{message_id}"')
+            if status != 'OK' or not data or not data[0]:
+                break
+            candidates = [int(found) for found in data[0].split()]
+        return None
+
+    def _sync_folder(self, folder: str, last_uid: int, known_uidvalidity: Optional[int],
+                     message_index: ExistingMessageIndex, is_sent: bool,
+                     emit: Callable[[Dict[str, Any]], None],
+                     preview_bytes: Optional[int] = None, gmail: bool = False,
+                     sent_folder: Optional[str] = None, known_modseq: Optional[int] = None) -> Dict[str, Any]:
+        """1フォルダー分の新着メールをIMAPから取得する（DBには触れない）
+
+        並列同期ではワーカースレッドから呼ばれるため、取得結果と新しい
+        チェックポイントを辞書で返し、保存は呼び出し側でまとめて行う。
+        取得した本文はパースせず、未パースのまま emit(item) に渡す
+        （1バッチ分の本文をメモリに溜めない）。
+        preview_bytesを渡した場合は本文パートの先頭だけを取得する。
+        gmail=True の場合（「すべてのメール」の同期）は、X-GM-MSGIDで既存判定し、
+        X-GM-LABELSからフォルダーと送信済みかを決める。
+        known_modseqを渡した場合は、既存分のフラグ変更と削除をCONDSTORE/QRESYNCで取得する。
+        """
+        result: Dict[str, Any] = {
+            'folder': folder,
+            'selected': False,
+            'uidvalidity': None,
+            'uidnext': None,
+            'highestmodseq': None,
+            'last_uid': None,
+            'processed': 0,
+            'saved': 0,
+            'skipped': 0,
+            'skipped_bytes': 0,
+            'flag_changes': {},
+            'vanished': [],
+        }
+        if not self.select_folder(folder):
+            return result
+
+        result['selected'] = True
+        for key in ('uidvalidity', 'uidnext', 'highestmodseq'):
+            result[key] = self.folder_status.get(key)
+
+        # UIDVALIDITYが変わっていればUID 1から取り直す
+        if known_uidvalidity is not None and result['uidvalidity'] is not None \
+                and result['uidvalidity'] != known_uidvalidity:
+            last_uid = 0
+            # 新しいUIDのメッセージより先に書き込み側へ伝え、古いUIDの位置を消させる
+            emit({
+                CONTROL_KEY: 'checkpoint',
+                'folder': folder,
+                'last_uid': 0,
+                'uidvalidity': result['uidvalidity'],
+                'saved': 0,
+                'skipped': 0,
+            })
+        elif known_modseq and result['highestmodseq'] != known_modseq:
+            # 既存メッセージのフラグ変更・削除は変更分だけ取得する
+            try:
+                changes = self.fetch_changes(last_uid, known_modseq)
+            except (socket.timeout, socket.error, imaplib.IMAP4.error) as e:
+                app_logger.error(f"変更の取得に失敗しました {folder}: {str(e)}")
+                changes = None
+                # 反映できなかった変更を次回取り直せるよう、MODSEQは進めない
+                result['highestmodseq'] = known_modseq
+            if changes:
+                result['flag_changes'] = changes['flags']
+                result['vanished'] = changes['vanished']
+                app_logger.debug(
+                    f"{folder}: フラグ変更 {len(changes['flags'])}件, 削除 {len(changes['vanished'])}件"
+                )
+                if changes['flags'] or changes['vanished']:
+                    emit({
+                        CONTROL_KEY: 'changes',
+                        'folder': folder,
+                        'flags': changes['flags'],
+                        'vanished': changes['vanished'],
+                    })
+
+        uids = self.search_new_uids(last_uid)
+        total_messages = len(uids)
+        app_logger.debug(f"{folder}: UID {last_uid + 1}以降の新着 {total_messages}件")
+        # 取得に失敗したUIDより先にはチェックポイントを進めない
+        first_failed_uid = None
+        position = 0
+        # スロットリングで取得できなかったUIDは、次のバッチとして取り直す
+        retry_batch: List[int] = []
+        throttle_retries = 0
+        carried_saved = carried_skipped = 0
+
+        while retry_batch or position < len(uids):
+            if retry_batch:
+                batch, retry_batch = retry_batch, []
+            else:
+                # バッチサイズは直前までの応答時間に応じて変わる
+                batch = uids[position:position + self.batch_controller.size]
+                position += len(batch)
+            # 取り直す前に取得できた分も、このバッチの件数に含める
+            batch_saved, batch_skipped = carried_saved, carried_skipped
+            carried_saved = carried_skipped = 0
+            batch_started = time.time()
+
+            app_logger.debug(
+                f"{folder}: バッチサイズ: {len(batch)}, レート: {self.rate_limiter.get_stats()['rate']}/s, "
+                f"処理済み: {result['processed']}/{total_messages}"
+            )
+
+            received_uids = set()
+            claimed_keys: Dict[int, str] = {}
+            try:
+                # フェーズ1: ヘッダーだけ取得し、バッチ分のMessage-IDをまとめて既存判定
+                headers = self.fetch_headers(batch, gmail=gmail)
+                received_uids.update(header['uid'] for header in headers)
+                if gmail:
+                    # 同じメッセージは「すべてのメール」に1回だけ現れ、X-GM-MSGIDで一意に決まる
+                    # （Message-IDのないメッセージもX-GM-MSGIDで判定して保存する）
+                    for header in headers:
+                        header['dedupe_key'] = str(header['gm_msgid']) if header['gm_msgid'] else None
+                else:
+                    for header in headers:
+                        header['dedupe_key'] = header['message_id']
+                claimed = message_index.claim_new(header['dedupe_key'] for header in headers)
+                item_meta: Dict[int, Dict[str, Any]] = {}
+                gmail_meta = {}
+                new_uids = []
+                for header in headers:
+                    if not header['dedupe_key']:
+                        # 重複判定できないメッセージは保存しない（チェックポイントは進むため件数とログに残す）
+                        app_logger.warning(f"{folder}: Message-IDがないためスキップします (UID: {header['uid']})")
+                        batch_skipped += 1
+                        result['processed'] += 1
+                    elif header['dedupe_key'] in claimed:
+                        claimed.discard(header['dedupe_key'])
+                        claimed_keys[header['uid']] = header['dedupe_key']
+                        new_uids.append(header['uid'])
+                        item_meta[header['uid']] = {
+                            'flags': header['flags'],
+                            'imap_account': self.email_address,
+                            'imap_folder': folder,
+                        }
+                        if gmail:
+                            label_folder, label_sent = self.folder_from_labels(header['labels'], sent_folder)
+                            gmail_meta[header['uid']] = {
+                                'gm_msgid': header['gm_msgid'],
+                                'gm_thrid': header['gm_thrid'],
+                                'folder': label_folder or folder,
+                                'is_sent': label_sent,
+                            }
+                    else:
+                        batch_skipped += 1
+                        result['skipped_bytes'] += header['size']
+                        result['processed'] += 1
+
+                # フェーズ2: 新規メッセージだけ本文パートを取得（添付ファイルは取得しない）
+                # （本文を受信するまでは未取得として扱う）
+                received_uids.difference_update(new_uids)
+                for item in self.fetch_message_parts(new_uids, preview_bytes):
+                    received_uids.add(item['uid'])
+                    item['folder'] = folder
+                    item['is_sent'] = is_sent
+                    item.update(item_meta.get(item['uid'], {}))
+                    item.update(gmail_meta.get(item['uid'], {}))
+                    emit(item)
+                    batch_saved += 1
+                    result['processed'] += 1
+
+            except (socket.timeout, socket.error, imaplib.IMAP4.error) as e:
+                app_logger.error(f"バッチ取得エラー: {str(e)}")
+                error_kind = classify_error(e)
+                self.batch_controller.record_failure(error_kind)
+                missing_uids = [uid for uid in batch if uid not in received_uids]
+                if error_kind is not None:
+                    # コマンド単位の負荷のサインなので、サーバーへのコマンドレートを下げる
+                    self.rate_limiter.on_failure()
+                if error_kind == 'throttle' and missing_uids and throttle_retries < MAX_THROTTLE_RETRIES:
+                    # 接続は生きているので、取得できなかった分をトークンバケットの待ちを経て取り直す
+                    throttle_retries += 1
+                    message_index.release(claimed_keys[uid] for uid in missing_uids if uid in claimed_keys)
+                    retry_batch = missing_uids
+                    carried_saved, carried_skipped = batch_saved, batch_skipped
+                    app_logger.info(
+                        f"{folder}: スロットリングされた{len(missing_uids)}件を取り直します "
+                        f"({throttle_retries}/{MAX_THROTTLE_RETRIES})"
+                    )
+                    continue
+                if missing_uids and (first_failed_uid is None or missing_uids[0] < first_failed_uid):
+                    first_failed_uid = missing_uids[0]
+                if error_kind == 'throttle':
+                    continue
+                if not self._handle_fetch_error(e, folder):
+                    break
+                continue
+
+            self.batch_controller.record_success(time.time() - batch_started)
+            self.rate_limiter.on_success()
+            throttle_retries = 0
+            result['saved'] += batch_saved
+            result['skipped'] += batch_skipped
+
+            # このバッチが保存されたらチェックポイントを進めてよいことを書き込み側に伝える
+            if first_failed_uid is None:
+                emit({
+                    CONTROL_KEY: 'checkpoint',
+                    'folder': folder,
+                    # 取り直したバッチの場合も、ここまでのUIDはすべて取得済み
+                    'last_uid': uids[position - 1],
+                    'uidvalidity': result['uidvalidity'],
+                    'saved': batch_saved,
+                    'skipped': batch_skipped,
+                })
+
+        if first_failed_uid is not None:
+            synced_uids = [uid for uid in uids if uid < first_failed_uid]
+        else:
+            synced_uids = uids
+        if synced_uids:
+            result['last_uid'] = max(synced_uids)
+        result['rate_control'] = self.get_rate_stats()
+        return result
+
+    def _sync_folders(self, plans: List[tuple], message_index: ExistingMessageIndex, sent_folder: Optional[str],
+                      parallel_folders: int,
+                      emit: Callable[[Dict[str, Any]], None],
+                      preview_bytes: Optional[int] = None) -> List[Dict[str, Any]]:
+        """(フォルダー, last_uid, uidvalidity) の計画に従って各フォルダーを同期する"""
+        if parallel_folders > 1 and len(plans) > 1:
+            return self._sync_folders_parallel(plans, message_index, sent_folder, parallel_folders,
+                                               emit, preview_bytes)
+
+        results = []
+        for plan in plans:
+            try:
+                results.append(self._sync_folder(
+                    *plan[:3], message_index, plan[0] == sent_folder, emit=emit, preview_bytes=preview_bytes,
+                    known_modseq=plan[3]
+                ))
+            except Exception as e:
+                app_logger.error(f"フォルダー処理エラー {plan[0]}: {str(e)}")
+        return results
+
+    def _sync_folders_parallel(self, plans: List[tuple], message_index: ExistingMessageIndex,
+                               sent_folder: Optional[str], max_connections: int,
+                               emit: Callable[[Dict[str, Any]], None],
+                               preview_bytes: Optional[int] = None) -> List[Dict[str, Any]]:
+        """フォルダーごとに別の接続を使って並列に同期する
+
+        先頭のフォルダーは自分の接続で処理し、残りは接続プールから借りた接続で処理する。
+        プールの上限で接続を借りられなかったフォルダーは最後に自分の接続で処理する。
+        """
+        # 接続プールはemail_handlerをimportするため、ここで読み込む
+        from utils.connection_pool import connection_pool
+
+        results: Dict[str, Dict[str, Any]] = {}
+        fallback: List[tuple] = []
+
+        def run_pooled(plan):
+            folder = plan[0]
+            try:
+                handler = connection_pool.acquire(
+                    self.email_address, self.password, self.imap_server,
+                    timeout=PARALLEL_ACQUIRE_TIMEOUT, imap_port=self.imap_port, use_ssl=self.use_ssl
+                )
+            except (TimeoutError, ConnectionError) as e:
+                app_logger.warning(f"並列同期用の接続を確保できませんでした {folder}: {str(e)}")
+                return None
+            failed = False
+            try:
+                return handler._sync_folder(*plan[:3], message_index, folder == sent_folder,
+                                            emit=emit, preview_bytes=preview_bytes, known_modseq=plan[3])
+            except Exception:
+                failed = True
+                raise
+            finally:
+                connection_pool.release(handler, discard=failed)
+
+        workers = max(min(max_connections, len(plans)) - 1, 1)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='folder-sync') as executor:
+            futures = {executor.submit(run_pooled, plan): plan for plan in plans[1:]}
+            own_plan = plans[0]
+            try:
+                results[own_plan[0]] = self._sync_folder(
+                    *own_plan[:3], message_index, own_plan[0] == sent_folder, emit=emit,
+                    preview_bytes=preview_bytes, known_modseq=own_plan[3]
+                )
+            except Exception as e:
+                app_logger.error(f"フォルダー処理エラー {own_plan[0]}: {str(e)}")
+
+            for future in as_completed(futures):
+                plan = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    app_logger.error(f"フォルダー処理エラー {plan[0]}: {str(e)}")
+                    continue
+                if result is None:
+                    fallback.append(plan)
+                else:
+                    results[plan[0]] = result
+
+        for plan in fallback:
+            try:
+                results[plan[0]] = self._sync_folder(
+                    *plan[:3], message_index, plan[0] == sent_folder, emit=emit, preview_bytes=preview_bytes,
+                    known_modseq=plan[3]
+                )
+            except Exception as e:
+                app_logger.error(f"フォルダー処理エラー {plan[0]}: {str(e)}")
+
+        return [results[plan[0]] for plan in plans if plan[0] in results]
+
+    def check_new_emails(self, session=None, parallel_folders: int = SYNC_PARALLEL_FOLDERS,
+                         writer: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+                         commit_every: int = WRITE_BATCH_SIZE,
+                         preview_bytes: Optional[int] = None) -> int:
+        """新着メールをチェックし、バッチ処理で取得・保存する（改善版）
+
+        Args:
+            session: DBセッション
+            parallel_folders: 同時に使うIMAP接続数（1ならフォルダーを順番に処理）
+            writer: 取得・パース・保存をパイプラインで並行して行い、パース済み
+                メッセージのバッチごとに writer(batch) を呼ぶ。バッチごとに
+                チェックポイントと一緒にコミットするため、メールボックスの大きさに
+                関係なくメモリ使用量は一定で、途中で失敗しても保存済みの分は残る
+            commit_every: 1トランザクションでまとめる件数
+            preview_bytes: 指定した場合は本文パートの先頭だけを取得してプレビュー用に保存し、
+                本文全体は表示時に fetch_full_body で取得する
+
+        Returns:
+            int: 保存したメッセージ数（他のプロセスが同期中の場合は0）
+        """
         if session is None:
             raise ValueError("Database session is required")
+        if writer is None:
+            # 保存前にチェックポイントを進めるとメッセージを取りこぼすため、必ずwriterで保存する
+            raise ValueError("writer is required")
 
         lock_name = f"email_sync_{self.email_address}"
         total_processed = 0
         total_saved = 0
         total_skipped = 0
+        skipped_bytes = 0
 
         with ProcessLock(lock_name) as lock:
             if not lock:
                 app_logger.warning(f"別の同期プロセスが実行中です: {self.email_address}")
-                return []
+                return 0
 
-            new_emails = []
             sent_folder = self.get_gmail_folders()
+            # Gmailでは「すべてのメール」だけを同期し、INBOXと送信済みで同じメッセージを二重に取得しない
+            all_mail_folder = self.get_all_mail_folder() if self.is_gmail() else None
+            email_settings = None
 
             try:
                 # 同期状態を更新
@@ -403,120 +1085,133 @@ class EmailHandler:
                     .first()
 
                 if email_settings:
-                    email_settings.is_syncing = True
-                    email_settings.last_sync_status = "IN_PROGRESS"
-                    email_settings.sync_error = None
-
-                # 最後に同期したメッセージの日付を取得
-                latest_message = session.query(EmailMessage)\
-                    .filter(EmailMessage.folder == 'INBOX')\
-                    .order_by(EmailMessage.date.desc())\
-                    .first()
-
-                last_sync_date = latest_message.date if latest_message else None
-
-                # 既存のメッセージIDを取得
-                existing_message_ids = {
-                    msg.message_id for msg in 
-                    session.query(EmailMessage.message_id).all()
+                    # 期限切れのリース（前回のプロセスが落ちた場合など）は回収する
+                    if not email_settings.acquire_sync_lease(self._sync_owner()):
+                        app_logger.warning(
+                            f"別のプロセスが同期中です: {self.email_address} (owner={email_settings.sync_owner})"
+                        )
+                        session.rollback()
+                        return 0
+                    session.commit()
+
+                # 既存判定はバッチごとにDBへ問い合わせる（全Message-IDは読み込まない）
+                message_index = ExistingMessageIndex.from_session(session, gmail=bool(all_mail_folder))
+
+                if all_mail_folder:
+                    app_logger.info(f"Gmailモードで同期します: {all_mail_folder}")
+                    folders_to_check = [all_mail_folder]
+                else:
+                    folders_to_check = ['INBOX']
+                    if sent_folder:
+                        folders_to_check.append(sent_folder)
+
+                # チェックポイントの読み書きはこのスレッドのセッションだけで行う
+                sync_states = {
+                    folder: FolderSyncState.get_or_create(session, self.email_address, folder)
+                    for folder in folders_to_check
                 }
+                plans = [
+                    (folder, sync_states[folder].last_uid or 0, sync_states[folder].uidvalidity,
+                     sync_states[folder].highest_modseq)
+                    for folder in folders_to_check
+                ]
+
+                # 取得（スレッド）→ パース（プロセスプール）→ 書き込み（このスレッド）
+                results = []
+                pipeline = SyncPipeline(self.email_address, write_batch_size=commit_every)
+
+                def produce(emit):
+                    if all_mail_folder:
+                        results.append(self._sync_folder(
+                            *plans[0][:3], message_index, False, emit=emit, preview_bytes=preview_bytes,
+                            gmail=True, sent_folder=sent_folder, known_modseq=plans[0][3]
+                        ))
+                    else:
+                        results.extend(self._sync_folders(
+                            plans, message_index, sent_folder, parallel_folders, emit, preview_bytes
+                        ))
 
-                folders_to_check = ['INBOX']
-                if sent_folder:
-                    folders_to_check.append(sent_folder)
-
-                for folder in folders_to_check:
-                    try:
-                        if not self.select_folder(folder):
-                            continue
-
-                        status, messages = self.connection.search(None, 'ALL')
-                        if status != 'OK':
-                            continue
-
-                        message_nums = messages[0].split()
-                        total_messages = len(message_nums)
-                        batch_size = 100
-                        batch_errors = 0
-
-                        for i in range(0, len(message_nums), batch_size):
-                            batch = message_nums[i:i + batch_size]
-                            current_batch_size = len(batch)
-                            batch_saved = 0
-                            batch_skipped = 0
-
-                            app_logger.debug(f"バッチサイズ: {current_batch_size}, 処理済み: {total_processed}/{total_messages}")
-
-                            try:
-                                for num in batch:
-                                    try:
-                                        status, msg_data = self.connection.fetch(num, '(RFC822)')
-                                        if status != 'OK' or not msg_data or not msg_data[0]:
-                                            batch_errors += 1
-                                            continue
-
-                                        email_body = msg_data[0][1]
-                                        parsed_msg = self.parse_email_message(email_body)
-
-                                        if parsed_msg and parsed_msg['message_id']:
-                                            if parsed_msg['message_id'] not in existing_message_ids:
-                                                parsed_msg['folder'] = folder
-                                                parsed_msg['is_sent'] = (folder == sent_folder)
-                                                new_emails.append(parsed_msg)
-                                                batch_saved += 1
-                                            else:
-                                                batch_skipped += 1
-
-                                    except Exception as e:
-                                        app_logger.error(f"メッセージ処理エラー: {str(e)}")
-                                        batch_errors += 1
-                                        continue
-
-                                    total_processed += 1
-
-                                total_saved += batch_saved
-                                total_skipped += batch_skipped
-
-                            except Exception as e:
-                                app_logger.error(f"バッチ処理エラー: {str(e)}")
-                                session.rollback()
-                                raise
+                pipeline.run(
+                    produce,
+                    lambda batch: self._commit_chunk(session, batch, writer, sync_states, email_settings)
+                )
 
-                    except Exception as e:
-                        app_logger.error(f"フォルダー処理エラー {folder}: {str(e)}")
+                # 全フォルダーの結果を同じ保存ステージにまとめる
+                for result in results:
+                    if not result['selected']:
                         continue
+                    folder = result['folder']
+                    # 件数はチャンクごとのチェックポイントで記録済み
+                    if sync_states[folder].record_result(result):
+                        app_logger.info(f"UIDVALIDITYが変更されたためフル再同期しました: {folder}")
+
+                    total_processed += result['processed']
+                    total_saved += result['saved']
+                    total_skipped += result['skipped']
+                    skipped_bytes += result['skipped_bytes']
 
                 # 同期状態を更新
                 if email_settings:
-                    email_settings.last_sync = datetime.utcnow()
-                    email_settings.last_sync_status = "SUCCESS"
-                    email_settings.is_syncing = False
+                    email_settings.release_sync_lease("SUCCESS")
 
-                app_logger.info(f"同期完了 - 処理: {total_processed}, 保存: {total_saved}, スキップ: {total_skipped}")
-                return new_emails
+                app_logger.info(f"同期完了 - 処理: {total_processed}, 保存: {total_saved}, スキップ: {total_skipped} (本文取得を省略: {skipped_bytes} bytes)")
+                for result in results:
+                    if 'rate_control' in result:
+                        app_logger.info(f"レート制御 {result['folder']}: {result['rate_control']}")
+                return total_saved
 
             except Exception as e:
                 app_logger.error(f"同期エラー: {str(e)}")
                 if email_settings:
-                    email_settings.is_syncing = False
-                    email_settings.last_sync_status = "ERROR"
-                    email_settings.sync_error = str(e)
+                    # 途中までのチャンクはコミット済みのため、エラー状態も確実に残す
+                    session.rollback()
+                    email_settings.release_sync_lease("ERROR", str(e))
+                    session.commit()
                 raise   
+
+    def _sync_owner(self) -> str:
+        """同期リースの所有者を表す文字列"""
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+    def _commit_chunk(self, session, batch: List[Dict[str, Any]], writer: Callable[[List[Dict[str, Any]]], None],
+                      sync_states: Dict[str, FolderSyncState], email_settings: Optional[EmailSettings] = None) -> None:
+        """パース済みメッセージのチャンクを保存し、到達したチェックポイントと一緒にコミットする
+
+        プロセスが途中で落ちても、次回はコミット済みのチェックポイントから再開できる。
+        """
+        messages = [item for item in batch if CONTROL_KEY not in item]
+        # 既存メッセージのフラグ変更・削除を先に反映する（新着と同じトランザクション）
+        for marker in batch:
+            if marker.get(CONTROL_KEY) == 'changes':
+                stats = EmailMessage.apply_imap_changes(
+                    session, self.email_address, marker['folder'], marker['flags'], marker['vanished']
+                )
+                app_logger.info(f"変更を反映しました {marker['folder']}: {stats}")
+        checkpoints = [marker for marker in batch if marker.get(CONTROL_KEY) == 'checkpoint']
+        # UIDVALIDITYが変わったフォルダーは、古いUIDの位置を消してから新しいUIDで書き込む
+        for marker in checkpoints:
+            if sync_states[marker['folder']].reset_if_uidvalidity_changed(marker['uidvalidity']):
+                app_logger.info(f"UIDVALIDITYが変更されたためフル再同期します: {marker['folder']}")
+        if messages:
+            writer(messages)
+
+        for marker in checkpoints:
+            sync_states[marker['folder']].record_progress(marker['last_uid'], marker['saved'], marker['skipped'])
+
+        if email_settings is not None:
+            email_settings.renew_sync_lease()
+        session.commit()
+        app_logger.debug(f"チャンクをコミットしました: {len(messages)}件")
     
     def test_connection(self):
         """接続テストを行う（タイムアウト自動再接続機能付き）"""
         app_logger.debug("Test Connection Started")
         max_attempts = 3
-        base_delay = 2
 
         for attempt in range(max_attempts):
             try:
                 if attempt > 0:
-                    # 指数バックオフとジッターを適用
-                    jitter = random.uniform(0, 1)
-                    backoff_time = min(base_delay * (2 ** attempt) + jitter, 20)
-                    app_logger.debug(f"Backing off for {backoff_time:.2f} seconds before retry attempt {attempt + 1}/{max_attempts}")
-                    time.sleep(backoff_time)
+                    self._backoff(f"test connection retry attempt {attempt + 1}/{max_attempts}", attempt - 1)
 
                 # 既存の接続を確実にクリーンアップ
                 self.disconnect()
@@ -587,16 +1282,12 @@ class EmailHandler:
 
         app_logger.warning(f"Timeout detected: {error_str}")
 
-        # Implement exponential backoff with jitter
+        # ジッター付きの指数バックオフで再接続する
         max_attempts = 3
-        base_delay = 2
 
         for attempt in range(max_attempts):
             try:
-                jitter = random.uniform(0, 1)
-                backoff_time = min(base_delay * (2 ** attempt) + jitter, 15)
-                app_logger.debug(f"Backing off for {backoff_time:.2f} seconds (attempt {attempt + 1}/{max_attempts})")
-                time.sleep(backoff_time)
+                self._backoff(f"timeout recovery attempt {attempt + 1}/{max_attempts}", attempt)
 
                 # Force disconnect and reconnect
                 self.disconnect()
@@ -634,77 +1325,6 @@ class EmailHandler:
         return folder
 
 
-    def get_conversation(self, contact_email, search_query=None):
-        """特定の連絡先とのメール会話を取得する"""
-        messages = []
-        try:
-            self.connect()
-            if not self.connection:
-                raise Exception("IMAP接続に失敗しました。接続がNoneです。")
-
-            sent_folder = self.get_gmail_folders()
-            folders = ['INBOX']
-            if sent_folder:
-                folders.append(sent_folder)
-
-            for folder in folders:
-                try:
-                    encoded_folder = self.encode_folder_name(folder)
-                    status, data = self.connection.select(encoded_folder)
-                    if status != 'OK':
-                        app_logger.error(f"フォルダー選択に失敗しました: {folder}")
-                        continue
-
-                    email_part = re.search(r'<(.+?)>', contact_email)
-                    if email_part:
-                        email = email_part.group(1)
-                        search_criteria = f'(OR FROM "{email}" TO "{email}")'
-
-                        if search_query:
-                            search_terms = search_query.split()
-                            for term in search_terms:
-                                search_criteria += f' (OR SUBJECT "{term}" BODY "{term}")'
-
-                        status, nums = self.connection.uid('SEARCH', None, search_criteria)
-                        if status != 'OK':
-                            app_logger.error(f"メールの検索に失敗しました: {search_criteria}")
-                            continue
-
-                        if not nums[0]:
-                            app_logger.debug(f"No messages found for criteria: {search_criteria}")
-                            continue
-
-                        for num in nums[0].split():
-                            try:
-                                status, msg_data = self.connection.fetch(num, '(RFC822)')
-                                if status != 'OK':
-                                    app_logger.error(f"メッセージの取得に失敗しました: UID {num}")
-                                    continue
-
-                                email_body = msg_data[0][1]
-                                if not email_body:
-                                    app_logger.error(f"メッセージのボディがNoneです: UID {num}")
-                                    continue
-
-                                parsed_msg = self.parse_email_message(email_body)
-                                if parsed_msg:
-                                    messages.append(parsed_msg)
-
-                            except Exception as e:
-                                app_logger.error(f"メッセージ処理エラー: UID {num} - {str(e)}")
-                                continue
-
-                except Exception as e:
-                    app_logger.error(f"フォルダー処理エラー ({folder}): {str(e)}")
-                    continue
-
-        except Exception as e:
-            app_logger.error(f"会話取得エラー: {str(e)}")
-        finally:
-            self.disconnect()
-
-        return sorted(messages, key=lambda x: x['date'])
-
     def decode_str(self, s):
         """文字列をデコードする"""
         if s is None:
@@ -728,7 +1348,6 @@ class EmailHandler:
         """メールメッセージをパースしてディクショナリを返す"""
         try:
             msg = email.message_from_bytes(email_body)
-            subject = self.decode_str(msg['subject'])
             body = None
 
             if msg.is_multipart():
@@ -751,124 +1370,123 @@ class EmailHandler:
                     except UnicodeDecodeError:
                         body = payload.decode('utf-8', errors='replace')
 
-            if not subject:
-                subject = "(件名なし)"
-            if not body:
-                body = "(本文なし)"
-
-            # 本文のハッシュとプレビューを生成
-            body_hash = None
-            body_preview = None
-            if body:
-                # MD5ハッシュの生成
-                body_hash = hashlib.md5(body.encode()).hexdigest()
-
-                # プレビューの生成（HTMLタグを除去）
-                text = re.sub(r'<[^>]+>', '', body)
-                text = re.sub(r'\s+', ' ', text)  # 連続する空白を1つに
-                body_preview = text[:1000].strip()
-
-            from_str = self.decode_str(msg['from'])
-            to_str = self.decode_str(msg['to'])
-
-            def extract_email(header_str):
-                if not header_str:
-                    return None, None
-                match = re.search(r'<(.+?)>', header_str)
-                if match:
-                    email = match.group(1)
-                    display_name = header_str[:match.start()].strip(' "\'')
-                    return email, display_name or email
-                return header_str, header_str
-
-            from_email, from_display = extract_email(from_str)
-            to_email, to_display = extract_email(to_str)
-
-            return {
-                'message_id': msg['message-id'],
-                'from': from_str,
-                'to': to_str,
-                'subject': subject,
-                'body': body,
-                'body_hash': body_hash,
-                'body_preview': body_preview,
-                'date': parsedate_to_datetime(msg['date']),
-                'is_sent': self.email_address and self.email_address in from_str if self.email_address else False
-            }
+            return self._build_parsed_message(msg, body)
+
+        except Exception as e:
+            app_logger.error(f"メッセージパースエラー: {str(e)}")
+            traceback.print_exc()
+            return None
+
+    def parse_fetched_message(self, header_bytes, text_bytes, text_part=None, attachments=None, partial=False):
+        """ヘッダーとBODYSTRUCTUREで選んだ本文パートだけからディクショナリを作る
+
+        partial=True の場合、本文は先頭部分だけで body_loaded は False になる。
+        """
+        try:
+            msg = email.message_from_bytes(header_bytes or b'')
+            body = None
+            if text_part is not None:
+                body = decode_part(text_bytes, text_part['encoding'], text_part['params'].get('charset'), partial)
+
+            parsed_msg = self._build_parsed_message(msg, body)
+            parsed_msg['attachments'] = attachments or []
+            parsed_msg['body_loaded'] = not partial
+            if partial:
+                # 先頭部分だけのハッシュは重複判定に使えない
+                parsed_msg['body_hash'] = None
+            return parsed_msg
 
         except Exception as e:
             app_logger.error(f"メッセージパースエラー: {str(e)}")
             traceback.print_exc()
             return None
 
-    def get_contacts(self, search_query=None, limit=100) -> List[str]:
-        """メールの連絡先一覧を取得する（改善版）"""
-        contacts: Set[str] = set()
+    def _build_parsed_message(self, msg, body):
+        """ヘッダーと本文テキストから保存用のディクショナリを作る"""
+        subject = self.decode_str(msg['subject'])
+
+        if not subject:
+            subject = "(件名なし)"
+        if not body:
+            body = "(本文なし)"
+
+        # 本文のハッシュとプレビューを生成
+        body_hash = None
+        body_preview = None
+        if body:
+            # MD5ハッシュの生成
+            body_hash = hashlib.md5(body.encode()).hexdigest()
+
+            # プレビューの生成（HTMLタグを除去）
+            text = re.sub(r'<[^>]+>', '', body)
+            text = re.sub(r'\s+', ' ', text)  # 連続する空白を1つに
+            body_preview = text[:1000].strip()
+
+        from_str = self.decode_str(msg['from'])
+        to_str = self.decode_str(msg['to'])
+
+        return {
+            'message_id': msg['message-id'],
+            'from': from_str,
+            'to': to_str,
+            'subject': subject,
+            'body': body,
+            'body_hash': body_hash,
+            'body_preview': body_preview,
+            'date': parsedate_to_datetime(msg['date']),
+            'is_sent': self.email_address and self.email_address in from_str if self.email_address else False
+        }
+
+    def get_contacts(self, search_query=None, limit=100, since_days=None, folder='INBOX') -> List[str]:
+        """メールの連絡先一覧を取得する
+
+        SINCEの期間内で前回より新しいUIDのFROM/TOヘッダーだけを1回のUID FETCHで取得し、
+        アカウントごとのキャッシュに追加する。2回目以降は新着分しか取得しない。
+        """
+        if since_days is None:
+            since_days = current_app.config.get('CONTACTS_SINCE_DAYS', CONTACTS_SINCE_DAYS) \
+                if has_app_context() else CONTACTS_SINCE_DAYS
+        since = (datetime.now() - timedelta(days=since_days)).date()
         retry_count = 0
-        
+
         while retry_count < MAX_RETRIES:
             try:
-                if not self.verify_connection_state(['AUTH', 'SELECTED'], allow_reconnect=True):
-                    app_logger.error("Failed to establish connection")
-                    retry_count += 1
-                    continue
-                    
-                # Select INBOX
-                try:
-                    status, _ = self.connection.select('INBOX', readonly=True)
-                    if status != 'OK':
-                        raise Exception("Failed to select INBOX")
-                    app_logger.debug("Selected INBOX folder")
-                except Exception as e:
-                    app_logger.error(f"Folder selection error: {str(e)}")
-                    raise
-                    
-                # Search for messages
-                search_cmd = '(SINCE "1-Dec-2023")'
-                status, messages = self.connection.search(None, search_cmd)
-                if status != 'OK':
-                    raise Exception("Search command failed")
-                    
-                if not messages[0]:
-                    app_logger.debug("No messages found")
-                    return []
-                    
-                # Process messages
-                message_nums = messages[0].split()[-limit:]
-                app_logger.debug(f"Processing {len(message_nums)} messages")
-                
-                for num in message_nums:
-                    try:
-                        if not self.verify_connection_state(['SELECTED']):
-                            raise Exception("Connection state invalid")
-                            
-                        status, msg_data = self.connection.fetch(num, '(BODY[HEADER.FIELDS (FROM)])')
-                        if status != 'OK' or not msg_data or not msg_data[0]:
-                            continue
-                            
-                        header_data = msg_data[0][1]
-                        if isinstance(header_data, bytes):
-                            msg = email.message_from_bytes(header_data)
-                            from_addr = self.decode_str(msg['from'])
-                            if from_addr and (not search_query or search_query.lower() in from_addr.lower()):
-                                contacts.add(from_addr)
-                                
-                    except (socket.timeout, imaplib.IMAP4.error) as e:
-                        app_logger.error(f"Message processing error: {str(e)}")
-                        if 'timeout' in str(e).lower():
-                            raise  # Re-raise timeout errors for retry
-                            
-                # Success - return results
-                return sorted(list(contacts))
-                
-            except (socket.timeout, imaplib.IMAP4.error) as e:
+                if not self.select_folder(folder):
+                    raise imaplib.IMAP4.error(f"Failed to select {folder}")
+
+                cache = get_contact_cache(self.email_address, self.imap_server, folder,
+                                          self.folder_status.get('uidvalidity'), since)
+                with cache.lock:
+                    self._refresh_contact_cache(cache)
+                    return cache.top(limit, search_query)
+
+            except (socket.timeout, socket.error, imaplib.IMAP4.error) as e:
                 app_logger.error(f"Connection error (attempt {retry_count + 1}): {str(e)}")
                 self.disconnect()
                 retry_count += 1
                 if retry_count < MAX_RETRIES:
-                    backoff_time = min(RETRY_DELAY * (2 ** retry_count), 30)
-                    app_logger.debug(f"Retrying in {backoff_time} seconds...")
-                    time.sleep(backoff_time)
-                    
+                    self._backoff(f"get_contacts retry {retry_count}", retry_count - 1)
+
         app_logger.error("Maximum retry attempts reached")
-        return sorted(list(contacts))  # Return any contacts found before failure
\ No newline at end of file
+        return []
+
+    def _refresh_contact_cache(self, cache: ContactCache) -> None:
+        """キャッシュ済みのUIDより新しいメッセージのFROM/TOをまとめて取り込む"""
+        status, data = self.connection.uid(
+            'SEARCH', None, f'UID {cache.last_uid + 1}:* SINCE {imap_date(cache.since)}'
+        )
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID SEARCH failed: {status}")
+        # "n:*" は該当がなくても最大UIDを返すため、取り込み済みのUIDを除外する
+        uids = [uid for uid in map(int, (data[0] or b'').split()) if uid > cache.last_uid] if data else []
+        app_logger.debug(f"連絡先キャッシュの更新: {len(uids)}件 (UID > {cache.last_uid})")
+
+        own_address = self.email_address.lower()
+        for record in self.fetch_messages(uids, CONTACT_FETCH_ITEMS):
+            msg = email.message_from_bytes(find_fetch_item(record, 'BODY[HEADER') or b'')
+            fields = [self.decode_str(msg[name]) for name in ('from', 'to') if msg[name]]
+            cache.add(record['UID'], (
+                f'{name} <{address}>' if name else address
+                for name, address in getaddresses(fields)
+                if address and address.lower() != own_address
+            ))
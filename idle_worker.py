@@ -0,0 +1,139 @@
+import argparse
+import getpass
+import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from email_handler import EmailHandler, IDLE_RENEW_INTERVAL, RETRY_DELAY, MAX_BACKOFF_TIME
+from utils.connection_pool import connection_pool
+
+app_logger = logging.getLogger('mailchat')
+
+# 別の同期が実行中で同期できなかったときに、次に同期を試みるまでの秒数
+PENDING_SYNC_RETRY_INTERVAL = 5.0
+
+
+def _run_incremental_sync(listener: 'IdleListener') -> Optional[bool]:
+    """IDLEで通知された新着分だけをUIDチェックポイントから同期する
+
+    別の同期が実行中で同期できなかった場合は False を返す。
+    """
+    from app import sync_emails_background
+
+    return sync_emails_background(
+        listener.email_address,
+        listener.password,
+        listener.imap_server,
+        handler=listener.handler
+    )
+
+
+class IdleListener(threading.Thread):
+    """アカウントごとにIMAP IDLEで新着を待ち受ける常駐スレッド"""
+
+    def __init__(self, email_address: str, password: str, imap_server: str,
+                 folder: str = 'INBOX',
+                 on_change: Optional[Callable[['IdleListener'], Optional[bool]]] = None):
+        super().__init__(name=f"idle-{email_address}", daemon=True)
+        self.email_address = email_address
+        self.password = password
+        self.imap_server = imap_server
+        self.folder = folder
+        self.on_change = on_change or _run_incremental_sync
+        # IDLE用の接続もサーバーごとの同時接続数に数えるため、プールから借りる
+        self.handler: Optional[EmailHandler] = None
+        self._stop_event = threading.Event()
+        self.failures = 0
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        app_logger.info(f"IDLEリスナー開始: {self.email_address} ({self.folder})")
+        # 起動直後に取りこぼし分を同期しておく
+        pending_sync = True
+
+        while not self._stop_event.is_set():
+            try:
+                if self.handler is None:
+                    self.handler = connection_pool.acquire(self.email_address, self.password, self.imap_server)
+
+                if pending_sync:
+                    # 別の同期が実行中で同期できなかった通知は捨てずに、少し待ってからやり直す
+                    pending_sync = self.on_change(self) is False
+                    if pending_sync:
+                        self._stop_event.wait(PENDING_SYNC_RETRY_INTERVAL)
+                        continue
+
+                if not self.handler.select_folder(self.folder):
+                    raise Exception(f"フォルダー選択に失敗しました: {self.folder}")
+
+                events = self.handler.idle(timeout=IDLE_RENEW_INTERVAL, stop_event=self._stop_event)
+                self.failures = 0
+                if events:
+                    app_logger.debug(f"IDLE通知: {self.email_address} {events}")
+                    pending_sync = True
+
+            except Exception as e:
+                self.failures += 1
+                backoff_time = min(RETRY_DELAY * (2 ** min(self.failures, 5)) + random.uniform(0, 1), MAX_BACKOFF_TIME)
+                app_logger.error(f"IDLEリスナーエラー ({self.email_address}): {str(e)} - {backoff_time:.1f}秒後に再接続します")
+                self._release_handler(discard=True)
+                pending_sync = True
+                self._stop_event.wait(backoff_time)
+
+        self._release_handler()
+        app_logger.info(f"IDLEリスナー停止: {self.email_address}")
+
+
+    def _release_handler(self, discard: bool = False) -> None:
+        if self.handler is not None:
+            connection_pool.release(self.handler, discard=discard)
+            self.handler = None
+
+
+_listeners: Dict[Tuple[str, str], IdleListener] = {}
+_listeners_lock = threading.Lock()
+
+
+def start_idle_listener(email_address: str, password: str, imap_server: str) -> IdleListener:
+    """アカウントのIDLEリスナーを起動する（既に動いていれば再利用）"""
+    key = (email_address, imap_server)
+    with _listeners_lock:
+        listener = _listeners.get(key)
+        if listener and listener.is_alive() and listener.password == password:
+            return listener
+        if listener:
+            listener.stop()
+
+        listener = IdleListener(email_address, password, imap_server)
+        _listeners[key] = listener
+        listener.start()
+        return listener
+
+
+def stop_idle_listeners() -> None:
+    """すべてのIDLEリスナーを停止する"""
+    with _listeners_lock:
+        for listener in _listeners.values():
+            listener.stop()
+        _listeners.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='IMAP IDLEで新着メールを待ち受けて同期する')
+    parser.add_argument('email')
+    parser.add_argument('imap_server')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    password = os.environ.get('IMAP_PASSWORD') or getpass.getpass('IMAP password: ')
+    listener = start_idle_listener(args.email, password, args.imap_server)
+    try:
+        while listener.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_idle_listeners()
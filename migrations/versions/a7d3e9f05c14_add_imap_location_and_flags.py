@@ -0,0 +1,33 @@
+"""add_imap_location_and_flags
+
+Revision ID: a7d3e9f05c14
+Revises: f2a6c8d41b95
+Create Date: 2024-12-16 09:41:27.318406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3e9f05c14'
+down_revision = 'f2a6c8d41b95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CONDSTORE/QRESYNCの変更をUIDで反映するため、取得元のアカウント・フォルダーとフラグを保存する
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('imap_account', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('imap_folder', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('flags', sa.String(length=255), nullable=True))
+        batch_op.create_index('idx_email_message_imap_location', ['imap_account', 'imap_folder', 'imap_uid'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.drop_index('idx_email_message_imap_location')
+        batch_op.drop_column('flags')
+        batch_op.drop_column('imap_folder')
+        batch_op.drop_column('imap_account')
@@ -0,0 +1,34 @@
+"""add_conversation_keyset_indexes
+
+Revision ID: b3c5f7a92e06
+Revises: a7d3e9f05c14
+Create Date: 2024-12-17 14:05:12.660318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3c5f7a92e06'
+down_revision = 'a7d3e9f05c14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 連絡先ごとの会話を(日付, ID)のキーセットで読むための複合インデックス
+    # （連絡先IDだけの既存インデックスは先頭列が同じなので置き換える）
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.create_index('idx_email_message_from_contact_date', ['from_contact_id', 'date', 'id'], unique=False)
+        batch_op.create_index('idx_email_message_to_contact_date', ['to_contact_id', 'date', 'id'], unique=False)
+        batch_op.drop_index('idx_email_message_from_contact')
+        batch_op.drop_index('idx_email_message_to_contact')
+
+
+def downgrade():
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.create_index('idx_email_message_to_contact', ['to_contact_id'], unique=False)
+        batch_op.create_index('idx_email_message_from_contact', ['from_contact_id'], unique=False)
+        batch_op.drop_index('idx_email_message_to_contact_date')
+        batch_op.drop_index('idx_email_message_from_contact_date')
@@ -0,0 +1,43 @@
+"""add_folder_sync_state
+
+Revision ID: b71e3c9d2a40
+Revises: 5885eb18a076
+Create Date: 2024-12-05 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71e3c9d2a40'
+down_revision = '5885eb18a076'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # フォルダーごとの同期チェックポイント
+    op.create_table(
+        'folder_sync_state',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('account_email', sa.String(length=120), nullable=False),
+        sa.Column('folder', sa.String(length=255), nullable=False),
+        sa.Column('uidvalidity', sa.BigInteger(), nullable=True),
+        sa.Column('last_uid', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('uidnext', sa.BigInteger(), nullable=True),
+        sa.Column('highest_modseq', sa.BigInteger(), nullable=True),
+        sa.Column('last_sync', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('account_email', 'folder', name='uq_folder_sync_state_account_folder')
+    )
+
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('imap_uid', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.drop_column('imap_uid')
+
+    op.drop_table('folder_sync_state')
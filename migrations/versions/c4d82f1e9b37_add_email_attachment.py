@@ -0,0 +1,37 @@
+"""add_email_attachment
+
+Revision ID: c4d82f1e9b37
+Revises: b71e3c9d2a40
+Create Date: 2024-12-05 15:40:02.118934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d82f1e9b37'
+down_revision = 'b71e3c9d2a40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 添付ファイルのメタデータ（BODYSTRUCTUREから取得）
+    op.create_table(
+        'email_attachment',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('email_message_id', sa.Integer(), nullable=False),
+        sa.Column('filename', sa.String(length=255), nullable=True),
+        sa.Column('content_type', sa.String(length=255), nullable=True),
+        sa.Column('size', sa.Integer(), nullable=True),
+        sa.Column('section', sa.String(length=50), nullable=True),
+        sa.ForeignKeyConstraint(['email_message_id'], ['email_message.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('idx_email_attachment_message', 'email_attachment', ['email_message_id'])
+
+
+def downgrade():
+    op.drop_index('idx_email_attachment_message', table_name='email_attachment')
+    op.drop_table('email_attachment')
@@ -0,0 +1,61 @@
+"""add_contact_stats
+
+Revision ID: c9e4b2d7f613
+Revises: b3c5f7a92e06
+Create Date: 2024-12-19 11:42:08.517203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e4b2d7f613'
+down_revision = 'b3c5f7a92e06'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # サイドバー用の連絡先ごとの集計（同期の書き込み時に差分で更新する）
+    op.create_table('contact_stats',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('address', sa.String(length=255), nullable=False),
+        sa.Column('last_message_date', sa.DateTime(), nullable=True),
+        sa.Column('last_subject', sa.Text(), nullable=True),
+        sa.Column('sent_count', sa.Integer(), nullable=False),
+        sa.Column('received_count', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('address', name='uq_contact_stats_address')
+    )
+    with op.batch_alter_table('contact_stats', schema=None) as batch_op:
+        batch_op.create_index('idx_contact_stats_last_message_date', ['last_message_date', 'address'], unique=False)
+
+    # 既存のメッセージから初期値を作る（ContactStats.rebuildと同じ集計）
+    op.execute("""
+        INSERT INTO contact_stats (address, last_message_date, last_subject,
+                                   sent_count, received_count, updated_at)
+        SELECT DISTINCT ON (address)
+               address,
+               max(date) OVER w,
+               subject,
+               count(*) FILTER (WHERE is_sent) OVER w,
+               count(*) FILTER (WHERE NOT is_sent) OVER w,
+               now() AT TIME ZONE 'utc'
+        FROM (
+            SELECT CASE WHEN is_sent THEN to_address ELSE from_address END AS address,
+                   date, subject, coalesce(is_sent, false) AS is_sent, id
+            FROM email_message
+        ) AS messages
+        WHERE address IS NOT NULL
+        WINDOW w AS (PARTITION BY address)
+        ORDER BY address, date DESC NULLS LAST, id DESC
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('contact_stats', schema=None) as batch_op:
+        batch_op.drop_index('idx_contact_stats_last_message_date')
+
+    op.drop_table('contact_stats')
@@ -0,0 +1,40 @@
+"""add_sync_lease_and_progress
+
+Revision ID: d5e1a7c3f820
+Revises: c4d82f1e9b37
+Create Date: 2024-12-09 14:03:52.118405
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e1a7c3f820'
+down_revision = 'c4d82f1e9b37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 同期リース（放置されたis_syncingを回収するため）
+    with op.batch_alter_table('email_settings', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('sync_owner', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('sync_heartbeat', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('sync_lease_expires', sa.DateTime(), nullable=True))
+
+    # フォルダーごとの進捗件数
+    with op.batch_alter_table('folder_sync_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('synced_count', sa.BigInteger(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('skipped_count', sa.BigInteger(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('folder_sync_state', schema=None) as batch_op:
+        batch_op.drop_column('skipped_count')
+        batch_op.drop_column('synced_count')
+
+    with op.batch_alter_table('email_settings', schema=None) as batch_op:
+        batch_op.drop_column('sync_lease_expires')
+        batch_op.drop_column('sync_heartbeat')
+        batch_op.drop_column('sync_owner')
@@ -0,0 +1,27 @@
+"""add_message_keyset_index
+
+Revision ID: d7f1a3c85e29
+Revises: c9e4b2d7f613
+Create Date: 2024-12-20 09:31:55.204816
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7f1a3c85e29'
+down_revision = 'c9e4b2d7f613'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 検索結果・全メッセージの一覧を (日付, ID) のキーセットで新しい順に読むためのインデックス
+    # （newest_firstの ORDER BY date DESC NULLS LAST, id DESC と同じ並び）
+    op.create_index('idx_email_message_newest_first', 'email_message',
+                    [sa.text('date DESC NULLS LAST'), sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_email_message_newest_first', table_name='email_message')
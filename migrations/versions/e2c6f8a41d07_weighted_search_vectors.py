@@ -0,0 +1,43 @@
+"""weighted_search_vectors
+
+Revision ID: e2c6f8a41d07
+Revises: d7f1a3c85e29
+Create Date: 2024-12-21 15:07:43.118362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2c6f8a41d07'
+down_revision = 'd7f1a3c85e29'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # body_tsvは取り込み時に件名・本文・アドレスを重み付けして書き込むので、
+    # 行ごとに（フラグの更新でも）本文全体を解析し直していたトリガーは削除する。
+    # 既存の行は `flask backfill-search-vectors --all` で作り直す。
+    op.execute('DROP TRIGGER IF EXISTS email_message_tsvector_update ON email_message')
+    op.execute('DROP FUNCTION IF EXISTS email_message_tsvector_update')
+
+
+def downgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION email_message_tsvector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.body_tsv := to_tsvector('english', COALESCE(NEW.subject, '') || ' ' || COALESCE(NEW.body, ''));
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    op.execute("""
+        DROP TRIGGER IF EXISTS email_message_tsvector_update ON email_message;
+        CREATE TRIGGER email_message_tsvector_update
+            BEFORE INSERT OR UPDATE ON email_message
+            FOR EACH ROW
+            EXECUTE FUNCTION email_message_tsvector_update();
+    """)
@@ -0,0 +1,27 @@
+"""add_email_message_body_loaded
+
+Revision ID: e8b3f4a19d62
+Revises: d5e1a7c3f820
+Create Date: 2024-12-11 09:41:07.553280
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8b3f4a19d62'
+down_revision = 'd5e1a7c3f820'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 既存のメッセージは本文全体を保存済み
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('body_loaded', sa.Boolean(), nullable=False, server_default=sa.true()))
+
+
+def downgrade():
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.drop_column('body_loaded')
@@ -0,0 +1,33 @@
+"""add_gmail_message_ids
+
+Revision ID: f2a6c8d41b95
+Revises: e8b3f4a19d62
+Create Date: 2024-12-12 10:18:44.902731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a6c8d41b95'
+down_revision = 'e8b3f4a19d62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Gmailモード（[Gmail]/All Mailの同期）で使うX-GM-MSGID / X-GM-THRID
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('gm_msgid', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('gm_thrid', sa.BigInteger(), nullable=True))
+        batch_op.create_unique_constraint('uq_email_message_gm_msgid', ['gm_msgid'])
+        batch_op.create_index('ix_email_message_gm_thrid', ['gm_thrid'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.drop_index('ix_email_message_gm_thrid')
+        batch_op.drop_constraint('uq_email_message_gm_msgid', type_='unique')
+        batch_op.drop_column('gm_thrid')
+        batch_op.drop_column('gm_msgid')
@@ -0,0 +1,32 @@
+"""add_search_ngrams
+
+Revision ID: f4a9d2b6c158
+Revises: e2c6f8a41d07
+Create Date: 2024-12-22 10:26:37.640915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a9d2b6c158'
+down_revision = 'e2c6f8a41d07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CJKのbigram（取り込み時にPythonでNFKC正規化して作る）とその転置インデックス
+    # 既存の行は `flask backfill-search-vectors` で作成する
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_ngrams', postgresql.ARRAY(sa.Text()), nullable=True))
+        batch_op.create_index('idx_email_message_search_ngrams', ['search_ngrams'], unique=False,
+                              postgresql_using='gin')
+
+
+def downgrade():
+    with op.batch_alter_table('email_message', schema=None) as batch_op:
+        batch_op.drop_index('idx_email_message_search_ngrams')
+        batch_op.drop_column('search_ngrams')
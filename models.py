@@ -1,11 +1,24 @@
-from database import db
-from datetime import datetime
+from database import db, session_scope
+from datetime import datetime, timedelta
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.dialects.postgresql import TSVECTOR
-from sqlalchemy import text
-
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
+from sqlalchemy import and_, any_, literal, literal_column, or_, select, text
+from sqlalchemy.orm import defer, object_session, query_expression, with_expression
+from sqlalchemy.sql.elements import ClauseElement
+from utils.highlight import SNIPPET_RADIUS, SNIPPET_SOURCE_LENGTH
+from utils.pagination import after_key, before_cursor, decode_cursor, newest_first, page_of, ranked_page, sort_order
+from utils.text_search import cjk_ngrams, normalize_query, query_ngrams, query_terms, use_full_text
+
+import hashlib
+import logging
 import re
 
+app_logger = logging.getLogger('mailchat')
+
+SYNC_LEASE_DURATION = 600  # 同期のリース期間（秒）。チャンクをコミットするたびに延長する
+SEARCH_CONFIG = 'english'  # body_tsvと検索クエリに使うテキスト検索設定
+SEARCH_BACKFILL_BATCH_SIZE = 1000  # body_tsvの一括作成で1回に更新する行数
+
 class Contact(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), nullable=False)
@@ -145,6 +158,304 @@ class EmailSettings(db.Model):
     last_sync_status = db.Column(db.String(50))  # SUCCESS, ERROR など
     sync_error = db.Column(db.Text)
     is_syncing = db.Column(db.Boolean, default=False)
+    sync_owner = db.Column(db.String(255))  # 同期中のプロセス（ホスト名:PID:スレッドID）
+    sync_heartbeat = db.Column(db.DateTime)  # 最後に進捗をコミットした時刻
+    sync_lease_expires = db.Column(db.DateTime)  # これを過ぎたis_syncingは放置されたものとみなす
+
+    @property
+    def sync_in_progress(self):
+        """リースが有効な同期が実行中か（期限切れのis_syncingは無視する）"""
+        return bool(self.is_syncing and self.sync_lease_expires
+                    and self.sync_lease_expires > datetime.utcnow())
+
+    def acquire_sync_lease(self, owner, duration=SYNC_LEASE_DURATION):
+        """同期のリースを取得する。期限切れのリースは回収する
+
+        Returns:
+            bool: 取得できた場合True（他のプロセスが同期中ならFalse）
+        """
+        if self.sync_in_progress and self.sync_owner != owner:
+            return False
+        if self.is_syncing and self.sync_owner != owner:
+            app_logger.warning(
+                f"期限切れの同期フラグを回収します: {self.email} "
+                f"(owner={self.sync_owner}, heartbeat={self.sync_heartbeat})"
+            )
+        now = datetime.utcnow()
+        self.is_syncing = True
+        self.sync_owner = owner
+        self.sync_heartbeat = now
+        self.sync_lease_expires = now + timedelta(seconds=duration)
+        self.last_sync_status = "IN_PROGRESS"
+        self.sync_error = None
+        return True
+
+    def renew_sync_lease(self, duration=SYNC_LEASE_DURATION):
+        """進捗をコミットするたびにリースを延長する"""
+        now = datetime.utcnow()
+        self.sync_heartbeat = now
+        self.sync_lease_expires = now + timedelta(seconds=duration)
+
+    def release_sync_lease(self, status, error=None):
+        """同期の終了を記録してリースを解放する"""
+        self.is_syncing = False
+        self.sync_owner = None
+        self.sync_lease_expires = None
+        self.last_sync_status = status
+        self.sync_error = error
+        if status == "SUCCESS":
+            self.last_sync = datetime.utcnow()
+
+class FolderSyncState(db.Model):
+    """アカウント・フォルダーごとのIMAP同期チェックポイント"""
+    id = db.Column(db.Integer, primary_key=True)
+    account_email = db.Column(db.String(120), nullable=False)
+    folder = db.Column(db.String(255), nullable=False)
+    uidvalidity = db.Column(db.BigInteger)
+    last_uid = db.Column(db.BigInteger, default=0, nullable=False)  # 同期済みの最大UID
+    uidnext = db.Column(db.BigInteger)
+    highest_modseq = db.Column(db.BigInteger)  # CONDSTORE対応サーバーのみ
+    last_sync = db.Column(db.DateTime)
+    synced_count = db.Column(db.BigInteger, default=0, nullable=False)  # 取得して保存に回した件数
+    skipped_count = db.Column(db.BigInteger, default=0, nullable=False)  # 既存のためスキップした件数
+
+    __table_args__ = (
+        db.UniqueConstraint('account_email', 'folder', name='uq_folder_sync_state_account_folder'),
+    )
+
+    @classmethod
+    def get_or_create(cls, session, account_email, folder):
+        """同期状態を取得し、存在しない場合は作成する"""
+        state = session.query(cls)\
+            .filter_by(account_email=account_email, folder=folder)\
+            .with_for_update()\
+            .first()
+        if state is None:
+            state = cls(account_email=account_email, folder=folder, last_uid=0,
+                        synced_count=0, skipped_count=0)
+            session.add(state)
+        return state
+
+    def reset_if_uidvalidity_changed(self, uidvalidity):
+        """UIDVALIDITYが変わった場合はチェックポイントを破棄する
+
+        古いUIDで記録したメッセージの位置は新しいUIDと食い違うため、同じトランザクションで
+        消しておく（VANISHEDやフラグ変更を別のメッセージに反映しない）。
+        新しいUIDで書き込む前に呼ぶこと。
+
+        Returns:
+            bool: フル再同期が必要な場合True
+        """
+        if uidvalidity is None or self.uidvalidity == uidvalidity:
+            return False
+        session = object_session(self)
+        if self.uidvalidity is not None and session is not None:
+            cleared = EmailMessage.forget_imap_locations(session, self.account_email, self.folder)
+            app_logger.info(f"UIDVALIDITYの変更で{cleared}件のIMAP上の位置を消しました: {self.folder}")
+        self.uidvalidity = uidvalidity
+        self.last_uid = 0
+        self.highest_modseq = None
+        self.synced_count = 0
+        self.skipped_count = 0
+        return True
+
+    def record_progress(self, last_uid, synced=0, skipped=0):
+        """コミットしたチャンクまでの進捗を記録する（チェックポイントは後退させない）"""
+        self.last_uid = max(self.last_uid or 0, last_uid)
+        self.synced_count = (self.synced_count or 0) + synced
+        self.skipped_count = (self.skipped_count or 0) + skipped
+        self.last_sync = datetime.utcnow()
+
+    def record_result(self, result):
+        """フォルダー同期の結果（_sync_folderの戻り値）でUIDNEXT・HIGHESTMODSEQまで記録する
+
+        last_uidはチャンクごとにrecord_progressで記録済みのため、後退させずに反映するだけにする。
+        UIDだけで同期した結果（非同期版）にはhighestmodseqがないため、記録済みの値を残す
+        （フラグ変更・削除はCONDSTOREで同期するときに、そのMODSEQから取得する）。
+
+        Returns:
+            bool: UIDVALIDITYが変わってフル再同期した場合True
+        """
+        reset = self.reset_if_uidvalidity_changed(result['uidvalidity'])
+        if result['last_uid'] is not None:
+            self.last_uid = max(self.last_uid or 0, result['last_uid'])
+        self.uidnext = result['uidnext']
+        if 'highestmodseq' in result:
+            self.highest_modseq = result['highestmodseq']
+        self.last_sync = datetime.utcnow()
+        return reset
+
+class ContactStats(db.Model):
+    """サイドバー用の連絡先ごとの集計（同期の書き込み時に差分で更新する）
+
+    addressは相手側のアドレス（送信済みならto_address、それ以外はfrom_address）で、
+    email_messageの値をそのまま使う。集計がずれた場合は rebuild() で作り直す。
+    """
+    __tablename__ = 'contact_stats'
+
+    id = db.Column(db.Integer, primary_key=True)
+    address = db.Column(db.String(255), nullable=False)
+    last_message_date = db.Column(db.DateTime)
+    last_subject = db.Column(db.Text)
+    sent_count = db.Column(db.Integer, default=0, nullable=False)
+    received_count = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        # 名前順（昇順・降順）はこの一意インデックスを前後どちらからでも辿れる
+        db.UniqueConstraint('address', name='uq_contact_stats_address'),
+        # 日付順（新しい順・古い順）用。同じ日付はアドレス順で並べる
+        db.Index('idx_contact_stats_last_message_date', 'last_message_date', 'address'),
+    )
+
+    # 並び順ごとの (ソートキーの列, 降順か)
+    SORT_ORDERS = {
+        'name_asc': (('address',), False),
+        'name_desc': (('address',), True),
+        'date_desc': (('last_message_date', 'address'), True),
+        'date_asc': (('last_message_date', 'address'), False),
+    }
+
+    @staticmethod
+    def counterpart(from_address, to_address, is_sent):
+        """メッセージの相手側のアドレス"""
+        return to_address if is_sent else from_address
+
+    @classmethod
+    def sorted_query(cls, session, sort_by):
+        """サイドバーの並び順でのクエリ（不明な値は名前の昇順）
+
+        Returns:
+            tuple: (クエリ, ソートキーの列, 降順か)
+        """
+        names, descending = cls.SORT_ORDERS.get(sort_by, cls.SORT_ORDERS['name_asc'])
+        columns = [getattr(cls, name) for name in names]
+        query = session.query(cls)\
+            .filter((cls.sent_count + cls.received_count) > 0)\
+            .order_by(*sort_order(columns, descending))
+        return query, columns, descending
+
+    @classmethod
+    def page(cls, session, sort_by, cursor=None, limit=20):
+        """サイドバーの1ページ分をソートキーのキーセットで読む
+
+        NULLの位置はPostgreSQLの既定に合わせ、並び順ごとのインデックスを
+        前後どちらからでも辿れるようにする。
+
+        Returns:
+            tuple: (ContactStatsのリスト, 次ページのカーソル または None)
+        """
+        query, columns, descending = cls.sorted_query(session, sort_by)
+        names = [column.key for column in columns]
+        types = [datetime if name == 'last_message_date' else str for name in names]
+        keyset = after_key(columns, decode_cursor(cursor, types), descending)
+        if keyset is not None:
+            query = query.filter(keyset)
+        rows = query.limit(limit + 1).all()
+        return page_of(rows, limit, key=lambda row: tuple(getattr(row, name) for name in names))
+
+    @classmethod
+    def summarize(cls, messages):
+        """(from_address, to_address, is_sent, date, subject) の列をアドレスごとに集計する
+
+        Returns:
+            dict: {アドレス: {'sent_count', 'received_count', 'last_message_date', 'last_subject'}}
+        """
+        summary = {}
+        for from_address, to_address, is_sent, date, subject in messages:
+            address = cls.counterpart(from_address, to_address, is_sent)
+            if not address:
+                continue
+            stats = summary.setdefault(address, {
+                'address': address,
+                'sent_count': 0,
+                'received_count': 0,
+                'last_message_date': None,
+                'last_subject': None,
+            })
+            stats['sent_count' if is_sent else 'received_count'] += 1
+            if date is not None and (stats['last_message_date'] is None or date >= stats['last_message_date']):
+                stats['last_message_date'] = date
+                stats['last_subject'] = subject
+        return summary
+
+    @classmethod
+    def apply(cls, session, summary):
+        """summarize() の結果を既存の集計に足し込む（1文のINSERT ... ON CONFLICT）"""
+        from sqlalchemy.dialects.postgresql import insert
+
+        if not summary:
+            return
+        table = cls.__table__
+        now = datetime.utcnow()
+        # 同時に書き込む同期どうしがデッドロックしないよう、アドレス順にロックを取る
+        rows = [dict(summary[address], updated_at=now) for address in sorted(summary)]
+        stmt = insert(table).values(rows)
+        newer = stmt.excluded.last_message_date >= db.func.coalesce(
+            table.c.last_message_date, stmt.excluded.last_message_date)
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=['address'],
+            set_={
+                'sent_count': table.c.sent_count + stmt.excluded.sent_count,
+                'received_count': table.c.received_count + stmt.excluded.received_count,
+                # GREATESTはNULLを無視する
+                'last_message_date': db.func.greatest(table.c.last_message_date, stmt.excluded.last_message_date),
+                'last_subject': db.case((newer, stmt.excluded.last_subject), else_=table.c.last_subject),
+                'updated_at': stmt.excluded.updated_at,
+            }
+        ))
+
+    @classmethod
+    def subtract(cls, session, messages):
+        """削除したメッセージ (from_address, to_address, is_sent) の分だけ件数を減らす
+
+        最終日時・件名は戻せないため、必要なら rebuild() で作り直す。
+        """
+        counts = {}
+        for from_address, to_address, is_sent in messages:
+            address = cls.counterpart(from_address, to_address, is_sent)
+            if address:
+                sent, received = counts.get(address, (0, 0))
+                counts[address] = (sent + 1, received) if is_sent else (sent, received + 1)
+        if not counts:
+            return
+        session.execute(
+            cls.__table__.update()
+            .where(cls.address == db.bindparam('b_address'))
+            .values(sent_count=db.func.greatest(cls.sent_count - db.bindparam('b_sent'), 0),
+                    received_count=db.func.greatest(cls.received_count - db.bindparam('b_received'), 0)),
+            [{'b_address': address, 'b_sent': sent, 'b_received': received}
+             for address, (sent, received) in counts.items()]
+        )
+
+    @classmethod
+    def rebuild(cls, session):
+        """email_messageから集計を作り直す
+
+        Returns:
+            int: 作成した行数
+        """
+        session.execute(text('DELETE FROM contact_stats'))
+        result = session.execute(text("""
+            INSERT INTO contact_stats (address, last_message_date, last_subject,
+                                       sent_count, received_count, updated_at)
+            SELECT DISTINCT ON (address)
+                   address,
+                   max(date) OVER w,
+                   subject,
+                   count(*) FILTER (WHERE is_sent) OVER w,
+                   count(*) FILTER (WHERE NOT is_sent) OVER w,
+                   now() AT TIME ZONE 'utc'
+            FROM (
+                SELECT CASE WHEN is_sent THEN to_address ELSE from_address END AS address,
+                       date, subject, coalesce(is_sent, false) AS is_sent, id
+                FROM email_message
+            ) AS messages
+            WHERE address IS NOT NULL
+            WINDOW w AS (PARTITION BY address)
+            ORDER BY address, date DESC NULLS LAST, id DESC
+        """))
+        return max(result.rowcount, 0)
 
 class EmailMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -156,20 +467,39 @@ class EmailMessage(db.Model):
     subject = db.Column(db.Text)
     body = db.Column(db.Text)
     body_tsv = db.Column(TSVECTOR)
+    search_ngrams = db.Column(ARRAY(db.Text))  # 件名・本文・アドレス中のCJKのbigram（部分一致検索の絞り込み用）
     body_hash = db.Column(db.String(32))  # MD5ハッシュ用
     body_preview = db.Column(db.String(1000))  # プレビュー用
+    body_loaded = db.Column(db.Boolean, default=True, nullable=False)  # Falseならbodyは先頭部分のみ
     date = db.Column(db.DateTime, index=True)
     is_sent = db.Column(db.Boolean, default=False)
     folder = db.Column(db.String(100))
+    imap_uid = db.Column(db.BigInteger)  # 取得元フォルダーでのUID
+    imap_account = db.Column(db.String(255))  # 取得元のアカウント
+    imap_folder = db.Column(db.String(255))  # imap_uidが有効なフォルダー（Gmailモードでは「すべてのメール」）
+    flags = db.Column(db.String(255))  # IMAPフラグ（空白区切り）
+    gm_msgid = db.Column(db.BigInteger, unique=True)  # GmailのX-GM-MSGID（Gmailモードのみ）
+    gm_thrid = db.Column(db.BigInteger, index=True)  # GmailのX-GM-THRID（スレッド）
     last_sync = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # 検索結果の一覧で本文の代わりに読む、一致箇所の周辺（snippet_optionsを指定したときだけ）
+    snippet_start = query_expression()  # 切り出した位置（1始まり）
+    snippet_source = query_expression()
+
+    attachments = db.relationship('EmailAttachment', backref='message', cascade='all, delete-orphan')
+
     __table_args__ = (
         db.Index('idx_email_message_content_hash', 'body_hash'),
         db.Index('idx_email_message_fulltext', 'body_tsv', postgresql_using='gin'),
-        db.Index('idx_email_message_from_contact', 'from_contact_id'),
-        db.Index('idx_email_message_to_contact', 'to_contact_id'),
+        db.Index('idx_email_message_search_ngrams', 'search_ngrams', postgresql_using='gin'),
+        # 会話表示（連絡先ごとの新しい順）をインデックスだけで辿れるようにする
+        db.Index('idx_email_message_from_contact_date', 'from_contact_id', 'date', 'id'),
+        db.Index('idx_email_message_to_contact_date', 'to_contact_id', 'date', 'id'),
         db.Index('idx_email_message_addresses', 'from_address', 'to_address'),
         db.Index('idx_email_message_date_folder', 'date', 'folder'),
+        # 検索結果・全メッセージの一覧を (日付, ID) のキーセットで新しい順に読む
+        db.Index('idx_email_message_newest_first', db.text('date DESC NULLS LAST'), db.text('id DESC')),
+        db.Index('idx_email_message_imap_location', 'imap_account', 'imap_folder', 'imap_uid'),
     )
 
     @staticmethod
@@ -190,6 +520,142 @@ class EmailMessage(db.Model):
         text = re.sub(r'\s+', ' ', text)
         return text[:length].strip()
 
+    def hydrate_body(self, body):
+        """プレビューだけ保存していたメッセージに本文全体を保存する"""
+        self.body = body
+        self.body_loaded = True
+        self.update_body_fields()
+        self.body_tsv = self.search_vector(self.subject, body, self.from_address, self.to_address)
+        self.search_ngrams = cjk_ngrams(self.subject, body, self.from_address, self.to_address)
+
+    @staticmethod
+    def search_vector(subject, body, from_address=None, to_address=None):
+        """body_tsvに保存するtsvectorの式
+
+        件名をA、本文をB、差出人・宛先をCで重み付けし、ts_rankで件名の一致を上位にする。
+        値には列もPythonの文字列も渡せる（取り込み時は文字列、一括作成時は列）。
+        """
+        def weighted(value, weight):
+            if not isinstance(value, ClauseElement):
+                value = literal(value, db.Text)
+            return db.func.setweight(
+                db.func.to_tsvector(SEARCH_CONFIG, db.func.coalesce(value, '')), weight
+            )
+
+        if not isinstance(from_address, ClauseElement):
+            addresses = ' '.join(filter(None, (from_address, to_address)))
+        else:
+            addresses = db.func.concat_ws(' ', from_address, to_address)
+        return weighted(subject, 'A').op('||')(weighted(body, 'B')).op('||')(weighted(addresses, 'C'))
+
+    @classmethod
+    def substring_condition(cls, term):
+        """1語の部分一致の条件（件名・本文・差出人・宛先のいずれかに含む）
+
+        CJKを含む語は、先にsearch_ngramsのGINインデックスでbigramをすべて持つ
+        メッセージに絞り込み、ILIKEはその候補の確認にだけ使う。bigramはNFKC正規化した
+        文字列から作っているため、確認も列をNFKC正規化してから行う（半角カナ・全角英数字対策）。
+        語に含まれる % と _ はエスケープする。
+        """
+        term = normalize_query(term)
+        columns = (cls.subject, cls.body, cls.from_address, cls.to_address)
+        grams = query_ngrams(term)
+        if not grams:
+            # 正規化すると列のトライグラムインデックスが使えないため、そのまま比較する
+            return or_(*(column.icontains(term, autoescape=True) for column in columns))
+        condition = or_(*(
+            db.func.normalize(column, literal_column('NFKC'), type_=db.Text).icontains(term, autoescape=True)
+            for column in columns
+        ))
+        return and_(cls.search_ngrams.contains(grams), condition)
+
+    @classmethod
+    def snippet_options(cls, terms):
+        """検索結果の一覧用のローダーオプション
+
+        本文全体と検索用の列は読まず、最初に一致した箇所の少し前から
+        SNIPPET_SOURCE_LENGTH+1文字だけを snippet_source に読む（1文字多いのは末尾が
+        切れているかの判定用）。位置が見つからない語（語幹で一致した全文検索など）は本文の先頭を読む。
+        一致箇所は substring_condition と同じく本文をNFKC正規化してから探す（半角カナ・全角英数字も
+        一致する）。半角カナの濁点などは正規化で1文字にまとまるため、元の本文での一致箇所は
+        読む範囲の中で少し後ろにずれるだけで、スニペットには含まれる。
+        """
+        lowered = db.func.lower(db.func.normalize(cls.body, literal_column('NFKC'), type_=db.Text))
+        positions = [db.func.nullif(db.func.strpos(lowered, normalize_query(term).lower()), 0) for term in terms]
+        first_match = db.func.coalesce(db.func.least(*positions), 1) if positions else literal(1)
+        start = db.func.greatest(first_match - SNIPPET_RADIUS, 1)
+        return (
+            defer(cls.body), defer(cls.body_tsv), defer(cls.search_ngrams),
+            with_expression(cls.snippet_start, start),
+            with_expression(cls.snippet_source, db.func.substr(cls.body, start, SNIPPET_SOURCE_LENGTH + 1)),
+        )
+
+    @staticmethod
+    def search_tsquery(query_text):
+        """検索欄の文字列をtsqueryにする（"フレーズ"、or、-除外 の構文を使える）"""
+        return db.func.websearch_to_tsquery(SEARCH_CONFIG, query_text)
+
+    @classmethod
+    def backfill_search_vectors(cls, session, only_missing=True, batch_size=SEARCH_BACKFILL_BATCH_SIZE):
+        """既存メッセージのbody_tsvをIDの順にbatch_size件ずつ作成し、バッチごとにコミットする
+
+        only_missing=Falseの場合は、古い形式（重み付けなし）のものも含めて作り直す。
+
+        Returns:
+            int: 更新した件数
+        """
+        table = cls.__table__
+        last_id = 0
+        updated = 0
+        while True:
+            batch = select(table.c.id).where(table.c.id > last_id)
+            if only_missing:
+                batch = batch.where(table.c.body_tsv.is_(None))
+            batch = batch.order_by(table.c.id).limit(batch_size).scalar_subquery()
+            ids = session.execute(
+                table.update()
+                .where(table.c.id.in_(batch))
+                .values(body_tsv=cls.search_vector(table.c.subject, table.c.body,
+                                                   table.c.from_address, table.c.to_address))
+                .returning(table.c.id)
+            ).scalars().all()
+            session.commit()
+            if not ids:
+                return updated
+            updated += len(ids)
+            last_id = max(ids)
+            app_logger.debug(f"body_tsvを作成しました: {updated}件 (ID {last_id}まで)")
+
+    @classmethod
+    def backfill_search_ngrams(cls, session, only_missing=True, batch_size=SEARCH_BACKFILL_BATCH_SIZE):
+        """既存メッセージのsearch_ngramsをIDの順にbatch_size件ずつ作成し、バッチごとにコミットする
+
+        bigramはPythonで作るため、件名・本文を読み出してexecutemanyで書き戻す。
+
+        Returns:
+            int: 更新した件数
+        """
+        table = cls.__table__
+        last_id = 0
+        updated = 0
+        while True:
+            query = select(table.c.id, table.c.subject, table.c.body, table.c.from_address, table.c.to_address)\
+                .where(table.c.id > last_id)
+            if only_missing:
+                query = query.where(table.c.search_ngrams.is_(None))
+            rows = session.execute(query.order_by(table.c.id).limit(batch_size)).all()
+            if not rows:
+                return updated
+            session.execute(
+                table.update().where(table.c.id == db.bindparam('b_id')).values(search_ngrams=db.bindparam('b_ngrams')),
+                [{'b_id': row.id, 'b_ngrams': cjk_ngrams(row.subject, row.body, row.from_address, row.to_address)}
+                 for row in rows]
+            )
+            session.commit()
+            updated += len(rows)
+            last_id = rows[-1].id
+            app_logger.debug(f"search_ngramsを作成しました: {updated}件 (ID {last_id}まで)")
+
     def update_body_fields(self):
         """本文関連のフィールドを更新"""
         if self.body:
@@ -234,14 +700,165 @@ class EmailMessage(db.Model):
             'body_preview': self.body_preview,
             'date': self.date,
             'is_sent': self.is_sent,
-            'folder': self.folder
+            'folder': self.folder,
+            'imap_uid': self.imap_uid,
+            'flags': self.flags,
+            'body_loaded': self.body_loaded,
+            'gm_thrid': self.gm_thrid
         }
 
     @classmethod
-    def search_full_text(cls, query_text):
-        """全文検索を実行するクラスメソッド"""
-        return cls.query.filter(
-            cls.body_tsv.match(
-                db.func.plainto_tsquery('english', query_text)
-            )
+    def page(cls, query, cursor=None, limit=20, rank=None):
+        """絞り込み済みのクエリから1ページ分をキーセットで読む
+
+        通常は (日付, ID) の新しい順に並べる。rankを渡した場合は
+        (rank, 日付, ID) の降順に並べ、rankの値もカーソルに含める（検索の関連度順）。
+
+        Returns:
+            tuple: (メッセージのリスト, 次ページのカーソル または None)
+        """
+        if rank is None:
+            keyset = before_cursor(cls.date, cls.id, decode_cursor(cursor))
+            if keyset is not None:
+                query = query.filter(keyset)
+            rows = query.order_by(*newest_first(cls.date, cls.id)).limit(limit + 1).all()
+            return page_of(rows, limit)
+
+        return ranked_page(query, rank, cls.date, cls.id, cursor, limit)
+
+    @classmethod
+    def conversation(cls, session, contact_email, search_query=None, cursor=None, limit=50):
+        """連絡先とのやり取りを新しい順に1ページ分返す（キーセット方式）
+
+        送信側・受信側それぞれを(連絡先ID, 日付, ID)のインデックスで
+        limit+1件だけ読み、マージする。OR条件の全件ソートやOFFSETは使わない。
+
+        Returns:
+            tuple: (メッセージのリスト, 次ページのカーソル または None)
+        """
+        from utils.email_normalizer import normalize_email
+
+        contact_id = session.query(Contact.id)\
+            .filter_by(normalized_email=normalize_email(contact_email)[0])\
+            .scalar()
+        if contact_id is not None:
+            sides = [cls.from_contact_id == contact_id, cls.to_contact_id == contact_id]
+        else:
+            sides = [cls.from_address == contact_email, cls.to_address == contact_email]
+
+        keyset = before_cursor(cls.date, cls.id, cursor)
+        if use_full_text(search_query):
+            search_filters = [cls.body_tsv.op('@@')(cls.search_tsquery(normalize_query(search_query)))]
+        else:
+            search_filters = [cls.substring_condition(term) for term in query_terms(search_query)]
+        found = {}
+        for side in sides:
+            query = session.query(cls).filter(side, *search_filters)
+            if keyset is not None:
+                query = query.filter(keyset)
+            for message in query.order_by(*newest_first(cls.date, cls.id)).limit(limit + 1):
+                found[message.id] = message
+
+        # newest_firstと同じ並び（日付なしは最後）
+        ordered = sorted(found.values(), key=lambda m: (m.date is not None, m.date or datetime.min, m.id),
+                         reverse=True)
+        return page_of(ordered, limit)
+
+    @classmethod
+    def existing_message_ids(cls, connection, message_ids):
+        """指定したMessage-IDのうち保存済みのものを返す
+
+        message_idの一意インデックスを = ANY(:ids) で引くため、
+        コストはテーブルの件数ではなく渡したIDの件数に比例する。
+        """
+        ids = list({message_id for message_id in message_ids if message_id})
+        if not ids:
+            return set()
+        rows = connection.execute(
+            select(cls.message_id).where(cls.message_id == any_(literal(ids, ARRAY(db.String))))
         )
+        return {row[0] for row in rows}
+
+    @classmethod
+    def existing_gm_msgids(cls, connection, gm_msgids):
+        """指定したX-GM-MSGIDのうち保存済みのものを文字列で返す"""
+        ids = list({int(gm_msgid) for gm_msgid in gm_msgids if gm_msgid})
+        if not ids:
+            return set()
+        rows = connection.execute(
+            select(cls.gm_msgid).where(cls.gm_msgid == any_(literal(ids, ARRAY(db.BigInteger))))
+        )
+        return {str(row[0]) for row in rows}
+
+    @classmethod
+    def forget_imap_locations(cls, session, imap_account, imap_folder):
+        """フォルダーに記録したIMAP上の位置（UID）を消し、消した件数を返す"""
+        result = session.execute(
+            cls.__table__.update()
+            .where((cls.imap_account == imap_account) & (cls.imap_folder == imap_folder))
+            .values(imap_uid=None, imap_folder=None)
+        )
+        return max(result.rowcount, 0)
+
+    @classmethod
+    def apply_imap_changes(cls, session, imap_account, imap_folder, flags_by_uid, vanished_uids, chunk_size=1000):
+        """CONDSTORE/QRESYNCで受け取ったフラグ変更と削除を反映する
+
+        フラグはexecutemanyでまとめて更新し、削除はUIDの配列で一括削除する
+        （添付ファイルはDBのON DELETE CASCADEで消える）。削除した分は連絡先集計からも引く。
+
+        Returns:
+            dict: {'updated': フラグ更新件数, 'deleted': 削除件数}
+        """
+        location = (cls.imap_account == imap_account) & (cls.imap_folder == imap_folder)
+        stats = {'updated': 0, 'deleted': 0}
+
+        if flags_by_uid:
+            result = session.execute(
+                cls.__table__.update()
+                .where(location & (cls.imap_uid == db.bindparam('b_uid')))
+                .values(flags=db.bindparam('b_flags')),
+                [{'b_uid': uid, 'b_flags': flags} for uid, flags in flags_by_uid.items()]
+            )
+            stats['updated'] = max(result.rowcount, 0)
+
+        uids = sorted(set(vanished_uids or ()))
+        for start in range(0, len(uids), chunk_size):
+            chunk = uids[start:start + chunk_size]
+            deleted = session.execute(
+                cls.__table__.delete()
+                .where(location & (cls.imap_uid == any_(literal(chunk, ARRAY(db.BigInteger)))))
+                .returning(cls.from_address, cls.to_address, cls.is_sent)
+            ).all()
+            ContactStats.subtract(session, deleted)
+            stats['deleted'] += len(deleted)
+        return stats
+
+    @classmethod
+    def search_full_text(cls, query_text):
+        """全文検索を実行するクラスメソッド（関連度の高い順）"""
+        tsquery = cls.search_tsquery(query_text)
+        return cls.query.filter(cls.body_tsv.op('@@')(tsquery))\
+            .order_by(db.func.ts_rank(cls.body_tsv, tsquery).desc(), *newest_first(cls.date, cls.id))
+
+class EmailAttachment(db.Model):
+    """添付ファイルのメタデータ（本体はダウンロードしない）"""
+    id = db.Column(db.Integer, primary_key=True)
+    email_message_id = db.Column(db.Integer, db.ForeignKey('email_message.id', ondelete='CASCADE'), nullable=False)
+    filename = db.Column(db.String(255))
+    content_type = db.Column(db.String(255))
+    size = db.Column(db.Integer)  # BODYSTRUCTUREが返すエンコード後のサイズ
+    section = db.Column(db.String(50))  # BODY[section] で個別に取得する場合のセクション番号
+
+    __table_args__ = (
+        db.Index('idx_email_attachment_message', 'email_message_id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'section': self.section
+        }
@@ -4,9 +4,10 @@ document.addEventListener('DOMContentLoaded', function() {
     const sortSelect = document.getElementById('sortSelect');
     const searchInput = document.getElementById('contactSearch');
     const searchResults = document.getElementById('searchResults');
-    let currentPage = 1;
+    const loadMore = document.querySelector('.load-more');
+    // 続きはサーバーが返したカーソルで取得する（ページ番号は使わない）
+    let nextCursor = loadMore ? loadMore.dataset.nextCursor : null;
     let loading = false;
-    let hasNextPage = true;
 
     // ページサイズと並び替えの変更を処理する関数
     function updateUrlAndReload(params) {
@@ -35,9 +36,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // ページサイズの変更を処理
     if (pageSizeSelect) {
         pageSizeSelect.addEventListener('change', function() {
+            // カーソルは引き継がないので先頭から表示し直す
             updateUrlAndReload({
-                'per_page': this.value,
-                'page': 1 // ページサイズ変更時はページを1に戻す
+                'per_page': this.value
             });
         });
     }
@@ -46,8 +47,7 @@ document.addEventListener('DOMContentLoaded', function() {
     if (sortSelect) {
         sortSelect.addEventListener('change', function() {
             updateUrlAndReload({
-                'sort_by': this.value,
-                'page': 1 // 並び替え変更時はページを1に戻す
+                'sort_by': this.value
             });
         });
     }
@@ -57,6 +57,28 @@ document.addEventListener('DOMContentLoaded', function() {
         button.addEventListener('click', function() {
             const preview = this.closest('.message-preview');
             const full = preview.nextElementSibling;
+            if (full.dataset.loaded === 'false') {
+                // 同期時はプレビューだけ保存しているため、本文全体をサーバーから取得する
+                this.disabled = true;
+                fetch(`/api/messages/${full.dataset.messageId}/body`, { credentials: 'same-origin' })
+                    .then(response => {
+                        if (!response.ok) {
+                            throw new Error(`HTTP error! status: ${response.status}`);
+                        }
+                        return response.json();
+                    })
+                    .then(data => {
+                        full.textContent = data.body;
+                        full.dataset.loaded = 'true';
+                        preview.style.display = 'none';
+                        full.style.display = 'block';
+                    })
+                    .catch(error => {
+                        console.error('Error loading message body:', error);
+                        this.disabled = false;
+                    });
+                return;
+            }
             preview.style.display = 'none';
             full.style.display = 'block';
         });
@@ -67,15 +89,14 @@ document.addEventListener('DOMContentLoaded', function() {
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
 
         messagesContainer.addEventListener('scroll', function() {
-            if (loading || !hasNextPage) return;
+            if (loading || !nextCursor) return;
 
             const threshold = 100;
             if (messagesContainer.scrollHeight - messagesContainer.scrollTop - messagesContainer.clientHeight < threshold) {
                 loading = true;
-                currentPage++;
 
                 const searchParams = new URLSearchParams(window.location.search);
-                searchParams.set('page', currentPage);
+                searchParams.set('cursor', nextCursor);
 
                 fetch(`/?${searchParams.toString()}`, {
                     headers: {
@@ -100,25 +121,33 @@ document.addEventListener('DOMContentLoaded', function() {
                             data.messages.forEach(message => {
                                 const messageDiv = document.createElement('div');
                                 messageDiv.className = `message ${message.is_sent ? 'sent' : 'received'}`;
-                                messageDiv.innerHTML = `
-                                    <div class="message-content">
-                                        ${message.body || ''}
-                                        <div class="message-time">
-                                            ${new Date(message.date).toLocaleString()}
-                                        </div>
-                                    </div>
-                                `;
-                                messagesContainer.appendChild(messageDiv);
+                                const content = document.createElement('div');
+                                content.className = 'message-content';
+                                if (message.snippet !== undefined) {
+                                    // 検索結果のスニペットはサーバー側でエスケープ・ハイライト済み
+                                    content.innerHTML = message.snippet;
+                                } else {
+                                    content.textContent = message.body || '';
+                                }
+                                const time = document.createElement('div');
+                                time.className = 'message-time';
+                                time.textContent = message.date ? new Date(message.date).toLocaleString() : '';
+                                content.appendChild(time);
+                                messageDiv.appendChild(content);
+                                messagesContainer.insertBefore(messageDiv, loadMore);
                             });
                         }
-                        hasNextPage = Boolean(data.has_next);
+                        nextCursor = data.next_cursor || null;
                     } else {
-                        hasNextPage = false;
+                        nextCursor = null;
+                    }
+                    if (!nextCursor && loadMore) {
+                        loadMore.remove();
                     }
                 })
                 .catch(error => {
                     console.error('Error:', error);
-                    hasNextPage = false;
+                    nextCursor = null;
                 })
                 .finally(() => {
                     loading = false;
@@ -0,0 +1,96 @@
+import asyncio
+
+from benchmarks.fake_imap_server import FakeIMAPServer, FakeMailbox
+from test_imap_fetch import _build_message
+from utils.async_imap import AsyncIMAPClient, AsyncSyncEngine
+from utils.message_index import ExistingMessageIndex
+
+
+def test_async_client_select_search_fetch():
+    mailbox = FakeMailbox(uidvalidity=7)
+    for i in range(5):
+        mailbox.add_message('INBOX', _build_message(i))
+
+    async def scenario(port):
+        client = AsyncIMAPClient('test@example.com', 'password', '127.0.0.1', port=port, use_ssl=False)
+        assert await client.connect()
+        status = await client.select('INBOX')
+        assert status['uidvalidity'] == 7
+        assert status['exists'] == 5
+        assert await client.search_new_uids(2) == [3, 4, 5]
+
+        records = [record async for record in client.fetch([1, 2, 3], '(UID RFC822)')]
+        assert [r['UID'] for r in records] == [1, 2, 3]
+        assert records[1]['RFC822'] == _build_message(1)
+
+        headers = await client.fetch_headers([4])
+        assert headers[0]['message_id'] == '<fetch3@example.com>'
+        await client.logout()
+
+    with FakeIMAPServer(mailbox) as server:
+        asyncio.run(scenario(server.port))
+
+
+def test_async_engine_syncs_accounts_with_server_cap():
+    mailbox = FakeMailbox()
+    for i in range(12):
+        mailbox.add_message('INBOX', _build_message(i))
+
+    with FakeIMAPServer(mailbox) as server:
+        engine = AsyncSyncEngine(server_limits={'127.0.0.1': 2})
+        emitted = {}
+        jobs = []
+        for n in range(5):
+            address = f'user{n}@example.com'
+            emitted[address] = []
+            jobs.append({
+                'email_address': address,
+                'password': 'password',
+                'imap_server': '127.0.0.1',
+                'port': server.port,
+                'use_ssl': False,
+                'plans': [('INBOX', 4, None)],
+                'message_index': ExistingMessageIndex(lambda ids: set()),
+                'emit': emitted[address].append,
+            })
+
+        results = asyncio.run(engine.run(jobs))
+
+        assert engine.get_stats()['127.0.0.1']['peak'] == 2
+        for address, outcome in results.items():
+            assert outcome[0]['last_uid'] == 12
+            messages = [item for item in emitted[address] if 'control' not in item]
+            assert sorted(item['uid'] for item in messages) == list(range(5, 13))
+            assert emitted[address][-1]['control'] == 'checkpoint'
+
+
+def test_async_engine_syncs_gmail_and_condstore_servers_by_uid_only():
+    from benchmarks.mailbox_generator import build_mailbox
+
+    mailbox = build_mailbox(20)
+    sent_uids = [uid for uid, _ in mailbox.messages('[Gmail]/Sent Mail')]
+    assert sent_uids
+
+    with FakeIMAPServer(mailbox) as server:
+        server.capabilities += ['X-GM-EXT-1', 'ENABLE', 'CONDSTORE', 'QRESYNC']
+        emitted = []
+        results = asyncio.run(AsyncSyncEngine().run([{
+            'email_address': 'me@example.com',
+            'password': 'password',
+            'imap_server': '127.0.0.1',
+            'port': server.port,
+            'use_ssl': False,
+            'checkpoints': {'INBOX': (0, None)},
+            'message_index': ExistingMessageIndex(lambda ids: set()),
+            'emit': emitted.append,
+        }]))
+
+    # 送信済みフォルダーはスレッド版と同じくLISTで見つける
+    outcome = results['me@example.com']
+    assert [result['folder'] for result in outcome] == ['INBOX', '[Gmail]/Sent Mail']
+    # HIGHESTMODSEQ・X-GM-MSGID・フラグは読まず、記録済みの値を上書きしない
+    assert all('highestmodseq' not in result for result in outcome)
+    messages = [item for item in emitted if 'control' not in item]
+    assert len(messages) == 20
+    assert not any('gm_msgid' in item or 'flags' in item for item in messages)
+    assert sorted(item['uid'] for item in messages if item['is_sent']) == sent_uids
@@ -0,0 +1,21 @@
+import pytest
+
+from benchmarks.fake_imap_server import FakeIMAPServer, FakeMailbox
+from utils.connection_pool import IMAPConnectionPool, PoolTimeoutError
+
+
+def test_server_limit_ignores_host_case():
+    with FakeIMAPServer(FakeMailbox()) as server:
+        pool = IMAPConnectionPool(server_limits={'localhost': 1})
+        handler = pool.acquire('a@example.com', 'password', 'LocalHost', imap_port=server.port, use_ssl=False)
+
+        # 表記の違う同じホストも同じサーバーの上限に数える
+        with pytest.raises(PoolTimeoutError):
+            pool.acquire('b@example.com', 'password', 'localhost', timeout=0.2,
+                         imap_port=server.port, use_ssl=False)
+
+        pool.release(handler)
+        assert pool.acquire('a@example.com', 'password', 'LOCALHOST', timeout=0.2) is handler
+        pool.release(handler)
+        assert pool.get_metrics()['hits'] == 1
+        pool.close_all()
@@ -0,0 +1,62 @@
+from utils.highlight import TermMatcher, highlight, highlight_terms, snippet
+
+
+def test_highlight_terms_follow_search_syntax():
+    assert highlight_terms('"project plan" report -draft OR memo') == ['project plan', 'report', 'memo']
+    assert highlight_terms('ＲＥＰＯＲＴ　２０２４') == ['REPORT', '2024']
+    assert highlight_terms('   ') == []
+
+
+def test_highlight_maps_normalized_matches_back_to_original_text():
+    # 半角カナ・全角英字でも元の表記のままハイライトする
+    assert highlight('ｶﾞｲﾄﾞを見る', 'ガイド') == '<mark class="search-highlight">ｶﾞｲﾄﾞ</mark>を見る'
+    assert highlight('件名: ＲＥＰＯＲＴ', 'report') == '件名: <mark class="search-highlight">ＲＥＰＯＲＴ</mark>'
+    assert highlight('Straße', 'STRASSE') == '<mark class="search-highlight">Straße</mark>'
+
+
+def test_highlight_escapes_body_and_merges_overlapping_terms():
+    assert highlight('<b>abcd</b>', 'abc bcd') == '&lt;b&gt;<mark class="search-highlight">abcd</mark>&lt;/b&gt;'
+    assert highlight('a & b', None) == 'a &amp; b'
+    assert list(TermMatcher(['ab', 'b']).spans('ab b abc')) == [(0, 2), (3, 4), (5, 7)]
+
+
+def test_snippet_keeps_only_windows_around_matches():
+    body = 'x' * 100 + ' 請求書 ' + 'y' * 100 + ' 請求書 ' + 'z' * 100
+    result = snippet(body, '請求書', radius=5, fragments=3)
+    assert result == ('…xxxx <mark class="search-highlight">請求書</mark> yyyy '
+                      '…yyyy <mark class="search-highlight">請求書</mark> zzzz…')
+
+    # 断片数の上限に達したら残りは走査しない
+    assert str(snippet(body, '請求書', radius=5, fragments=1)).count('<mark') == 1
+    # 一致がなければ本文の先頭を返す
+    assert snippet('<p>' + 'a' * 50, 'none', radius=5) == '&lt;p&gt;aaaaaaa…'
+
+
+def test_snippet_marks_text_cut_from_a_longer_body():
+    assert snippet('前後が切れた 請求書 の本文', '請求書', radius=3, head_truncated=True, tail_truncated=True) \
+        == '…れた <mark class="search-highlight">請求書</mark> の本…'
+    assert snippet('一致なし', '請求書', head_truncated=True, tail_truncated=True) == '…一致なし…'
+
+
+def test_snippet_options_read_only_a_window_of_the_body():
+    from sqlalchemy import select
+    from sqlalchemy.dialects import postgresql
+
+    from models import EmailMessage
+
+    sql = str(select(EmailMessage).options(*EmailMessage.snippet_options(['請求書'])).compile(
+        dialect=postgresql.dialect()
+    ))
+    selected = sql.split('FROM')[0]
+    # 本文と検索用の列はそのままは読まず、一致箇所の周辺だけを切り出す
+    assert 'substr(email_message.body' in selected
+    # 一致箇所は substring_condition と同じくNFKC正規化した本文で探す
+    assert 'strpos(lower(normalize(email_message.body, NFKC))' in selected
+    assert ', email_message.body,' not in selected
+    assert 'body_tsv' not in selected and 'search_ngrams' not in selected
+
+    # 全角英字の語も正規化して探す
+    sql = str(select(EmailMessage).options(*EmailMessage.snippet_options(['ＲＥＰＯＲＴ'])).compile(
+        dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}
+    ))
+    assert "'report'" in sql.split('FROM')[0]
@@ -0,0 +1,498 @@
+import imaplib
+from email.message import EmailMessage as EmailMsg
+
+from benchmarks.fake_imap_server import FakeIMAPServer, FakeMailbox
+from utils.imap_fetch import compress_uid_set, parse_fetch_response, stream_uid_fetch
+from utils.message_index import ExistingMessageIndex
+
+
+def _build_message(i):
+    msg = EmailMsg()
+    msg['Subject'] = f'テスト件名 {i}'
+    msg['From'] = f'"送信者{i}" <sender{i}@example.com>'
+    msg['To'] = 'me@example.com'
+    msg['Message-ID'] = f'<fetch{i}@example.com>'
+    msg['Date'] = 'Thu, 1 Dec 2024 10:00:00 +0900'
+    msg.set_content(f'これはテスト本文です。{i}')
+    return msg.as_bytes()
+
+
+def test_compress_uid_set():
+    assert compress_uid_set([5, 1, 2, 3, 8, 10, 11, 12]) == '1:3,5,8,10:12'
+    assert compress_uid_set([7]) == '7'
+    assert compress_uid_set([]) == ''
+
+
+def test_parse_fetch_response_with_literals():
+    data = [
+        (b'1 (UID 10 RFC822.SIZE 5 BODY[HEADER.FIELDS (FROM)] {5}', b'From:'),
+        b' FLAGS (\\Seen))',
+        b'2 (UID 11 RFC822.SIZE 7 FLAGS ())',
+    ]
+    records = list(parse_fetch_response(data))
+
+    assert len(records) == 2
+    assert records[0]['UID'] == 10
+    assert records[0]['BODY[HEADER.FIELDS (FROM)]'] == b'From:'
+    assert records[0]['FLAGS'] == ['\\Seen']
+    assert records[1]['UID'] == 11
+    assert records[1]['FLAGS'] == []
+
+
+def test_stream_uid_fetch_against_fake_server():
+    mailbox = FakeMailbox()
+    raw_messages = [_build_message(i) for i in range(25)]
+    for raw in raw_messages:
+        mailbox.add_message('INBOX', raw)
+
+    with FakeIMAPServer(mailbox) as server:
+        conn = imaplib.IMAP4('127.0.0.1', server.port)
+        conn.login('test@example.com', 'password')
+        conn.select('INBOX')
+
+        records = list(stream_uid_fetch(conn, range(1, 26), '(UID RFC822)'))
+        assert [r['UID'] for r in records] == list(range(1, 26))
+        assert records[3]['RFC822'] == raw_messages[3]
+
+        # 途中で読むのをやめても次のコマンドが正常に使える
+        stream = stream_uid_fetch(conn, [1, 2, 3], '(UID RFC822)')
+        next(stream)
+        stream.close()
+        status, _ = conn.noop()
+        assert status == 'OK'
+
+        conn.logout()
+
+
+def _connected_handler(server):
+    from email_handler import EmailHandler
+
+    handler = EmailHandler('test@example.com', 'password', '127.0.0.1')
+    handler.connection = imaplib.IMAP4('127.0.0.1', server.port)
+    handler.connection.login('test@example.com', 'password')
+    handler.connection.select('INBOX')
+    handler.current_state = 'SELECTED'
+    return handler
+
+
+def _sync_folder(handler, *args, **kwargs):
+    """_sync_folderを実行し、結果とemitされたメッセージ（制御項目を除く）を返す"""
+    emitted = []
+    result = handler._sync_folder(*args, emit=emitted.append, **kwargs)
+    return result, [item for item in emitted if 'control' not in item]
+
+
+def test_fetch_headers_reads_message_ids_without_bodies():
+    mailbox = FakeMailbox()
+    for i in range(5):
+        mailbox.add_message('INBOX', _build_message(i))
+
+    with FakeIMAPServer(mailbox) as server:
+        handler = _connected_handler(server)
+
+        headers = handler.fetch_headers([1, 2, 3, 4, 5])
+
+        assert [h['uid'] for h in headers] == [1, 2, 3, 4, 5]
+        assert headers[2]['message_id'] == '<fetch2@example.com>'
+        assert headers[2]['size'] == len(_build_message(2))
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_fetch_message_texts_skips_attachments():
+    msg = EmailMsg()
+    msg['Subject'] = '請求書の送付'
+    msg['From'] = 'billing@example.com'
+    msg['To'] = 'me@example.com'
+    msg['Message-ID'] = '<invoice@example.com>'
+    msg['Date'] = 'Thu, 1 Dec 2024 10:00:00 +0900'
+    msg.set_content('請求書を添付します。')
+    msg.add_alternative('<p>請求書を添付します。</p>', subtype='html')
+    msg.add_attachment(b'%PDF-1.4' * 4096, maintype='application', subtype='pdf', filename='invoice.pdf')
+
+    mailbox = FakeMailbox()
+    mailbox.add_message('INBOX', msg.as_bytes())
+
+    with FakeIMAPServer(mailbox) as server:
+        handler = _connected_handler(server)
+
+        results = list(handler.fetch_message_texts([1]))
+
+        assert len(results) == 1
+        uid, parsed = results[0]
+        assert uid == 1
+        assert parsed['subject'] == '請求書の送付'
+        assert parsed['body'].strip() == '請求書を添付します。'
+        assert parsed['attachments'] == [{
+            'filename': 'invoice.pdf',
+            'content_type': 'application/pdf',
+            'size': parsed['attachments'][0]['size'],
+            'section': '2',
+        }]
+        assert parsed['attachments'][0]['size'] > 32768
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_preview_fetch_and_full_body_hydration():
+    body = 'プレビューだけ取得する長い本文です。' * 400
+    msg = EmailMsg()
+    msg['Subject'] = '長いメール'
+    msg['From'] = 'long@example.com'
+    msg['To'] = 'me@example.com'
+    msg['Message-ID'] = '<long@example.com>'
+    msg['Date'] = 'Thu, 1 Dec 2024 10:00:00 +0900'
+    msg.set_content(body)
+
+    mailbox = FakeMailbox()
+    mailbox.add_message('INBOX', msg.as_bytes())
+
+    with FakeIMAPServer(mailbox) as server:
+        handler = _connected_handler(server)
+
+        (uid, parsed), = list(handler.fetch_message_texts([1], max_text_bytes=1024))
+        assert parsed['body_loaded'] is False
+        assert parsed['body_hash'] is None
+        assert 0 < len(parsed['body']) < len(body)
+        assert body.startswith(parsed['body'].strip())
+
+        full = handler.fetch_full_body('INBOX', uid, '<long@example.com>')
+        assert full['body_loaded'] is True
+        assert full['body'].strip() == body
+
+        # UIDが変わっていてもMessage-IDで見つけられる
+        full = handler.fetch_full_body('INBOX', 999, '<long@example.com>')
+        assert full['uid'] == 1
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_idle_wakes_on_new_message():
+    import threading
+
+    mailbox = FakeMailbox()
+    mailbox.add_message('INBOX', _build_message(0))
+
+    with FakeIMAPServer(mailbox) as server:
+        handler = _connected_handler(server)
+        handler.current_state = 'SELECTED'
+
+        timer = threading.Timer(0.3, mailbox.add_message, args=('INBOX', _build_message(1)))
+        timer.start()
+        events = handler.idle(timeout=5)
+        timer.join()
+
+        assert ('EXISTS', 2) in events
+        status, _ = handler.connection.noop()
+        assert status == 'OK'
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_idle_wakes_on_expunge_with_and_without_qresync():
+    import threading
+
+    from email_handler import EmailHandler
+
+    mailbox = FakeMailbox()
+    for i in range(4):
+        mailbox.add_message('INBOX', _build_message(i))
+
+    with FakeIMAPServer(mailbox) as server:
+        server.capabilities += ['ENABLE', 'CONDSTORE', 'QRESYNC']
+
+        # 通常の接続と同じく、SELECT前にQRESYNCをENABLEする
+        handler = EmailHandler('test@example.com', 'password', '127.0.0.1')
+        handler.connection = imaplib.IMAP4('127.0.0.1', server.port)
+        handler.connection.login('test@example.com', 'password')
+        handler._enable_extensions()
+        assert handler.qresync_enabled
+        handler.connection.select('INBOX')
+        handler.current_state = 'SELECTED'
+
+        timer = threading.Timer(0.3, mailbox.expunge, args=('INBOX', 2))
+        timer.start()
+        events = handler.idle(timeout=5)
+        timer.join()
+        assert ('VANISHED', 2) in events
+        handler.connection.logout()
+        handler.connection = None
+
+        # QRESYNCなしではシーケンス番号のEXPUNGEになる
+        handler = _connected_handler(server)
+        timer = threading.Timer(0.3, mailbox.expunge, args=('INBOX', 3))
+        timer.start()
+        events = handler.idle(timeout=5)
+        timer.join()
+        assert ('EXPUNGE', 2) in events
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_idle_reports_dropped_connection_and_falls_back_to_noop(monkeypatch):
+    import socket
+
+    import pytest
+
+    import email_handler
+    from utils.imap_fetch import IdleCommand
+
+    mailbox = FakeMailbox()
+    mailbox.add_message('INBOX', _build_message(0))
+
+    with FakeIMAPServer(mailbox) as server:
+        # IDLE中に切断されたら、DONEを送らずに ConnectionError にする
+        handler = _connected_handler(server)
+        command = IdleCommand(handler.connection)
+        command.start()
+        handler.connection.sock.shutdown(socket.SHUT_RDWR)
+        with pytest.raises(ConnectionError):
+            command.read_line()
+        command.done()
+        handler.connection.shutdown()
+        handler.connection = None
+
+        # imaplibの内部APIが使えなければNOOPのポーリングで通知を拾う
+        monkeypatch.setattr(email_handler, 'supports_raw_idle', lambda conn: False)
+        monkeypatch.setattr(email_handler, 'IDLE_POLL_INTERVAL', 1)
+        handler = _connected_handler(server)
+        mailbox.add_message('INBOX', _build_message(1))
+        assert ('EXISTS', 2) in handler.idle(timeout=5)
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_sync_folder_skips_known_ids_and_returns_checkpoint():
+    mailbox = FakeMailbox()
+    for i in range(6):
+        mailbox.add_message('INBOX', _build_message(i))
+
+    with FakeIMAPServer(mailbox) as server:
+        handler = _connected_handler(server)
+        handler.current_state = 'SELECTED'
+        stored = {'<fetch1@example.com>'}
+        lookups = []
+
+        def lookup(message_ids):
+            lookups.append(sorted(message_ids))
+            return stored & set(message_ids)
+
+        index = ExistingMessageIndex(lookup)
+        result, messages = _sync_folder(handler, 'INBOX', 2, None, index, is_sent=False)
+
+        assert result['selected']
+        assert result['last_uid'] == 6
+        assert [m['uid'] for m in messages] == [3, 4, 5, 6]
+        # 既存判定はバッチ単位の1回の問い合わせで行う
+        assert lookups == [[f'<fetch{i}@example.com>' for i in range(2, 6)]]
+
+        # UIDVALIDITYが変わった場合はUID 1から取り直す（既知のIDはスキップ）
+        emitted = []
+        result = handler._sync_folder('INBOX', 6, 999, index, False, emitted.append)
+        assert [m['uid'] for m in emitted if 'control' not in m] == [1]
+        assert result['skipped'] == 5
+        # 新しいUIDのメッセージより先に、UIDVALIDITYの変更を書き込み側へ伝える
+        assert emitted[0] == {'control': 'checkpoint', 'folder': 'INBOX', 'last_uid': 0,
+                              'uidvalidity': 1, 'saved': 0, 'skipped': 0}
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_gmail_mode_syncs_all_mail_once_with_labels():
+    from email import message_from_bytes
+
+    from benchmarks.fake_imap_server import gmail_ids
+
+    mailbox = FakeMailbox()
+    all_mail = '[Gmail]/All Mail'
+    mailbox.add_message(all_mail, _build_message(0), labels=['\\Inbox', 'work'])
+    mailbox.add_message(all_mail, _build_message(1), labels=['\\Sent'])
+    mailbox.add_message(all_mail, _build_message(2), labels=['Receipts'])
+    mailbox.add_message('[Gmail]/Sent Mail', _build_message(1))
+    message_without_id = message_from_bytes(_build_message(3))
+
+    with FakeIMAPServer(mailbox) as server:
+        server.capabilities.append('X-GM-EXT-1')
+        handler = _connected_handler(server)
+        assert handler.is_gmail()
+        assert handler.get_all_mail_folder() == all_mail
+
+        lookups = []
+
+        def lookup(gm_msgids):
+            lookups.append(sorted(gm_msgids))
+            return set()
+
+        result, messages = _sync_folder(handler, all_mail, 0, None, ExistingMessageIndex(lookup), False,
+                                        gmail=True, sent_folder='[Gmail]/Sent Mail')
+
+        by_uid = {m['uid']: m for m in messages}
+        assert sorted(by_uid) == [1, 2, 3]
+        assert (by_uid[1]['folder'], by_uid[1]['is_sent']) == ('INBOX', False)
+        assert (by_uid[2]['folder'], by_uid[2]['is_sent']) == ('[Gmail]/Sent Mail', True)
+        assert by_uid[3]['folder'] == 'Receipts'
+        assert (by_uid[2]['gm_msgid'], by_uid[2]['gm_thrid']) == gmail_ids(_build_message(1))
+        # 既存判定はX-GM-MSGIDで行う
+        assert lookups == [sorted(str(gmail_ids(_build_message(i))[0]) for i in range(3))]
+
+        # Message-IDのないメッセージもX-GM-MSGIDで判定し、保存用のIDを付ける
+        from utils.sync_pipeline import parse_raw_items
+
+        del message_without_id['Message-ID']
+        mailbox.add_message(all_mail, message_without_id.as_bytes(), labels=['\\Inbox'])
+        result, messages = _sync_folder(handler, all_mail, 3, None, ExistingMessageIndex(lookup), False,
+                                        gmail=True, sent_folder='[Gmail]/Sent Mail')
+        assert [m['uid'] for m in messages] == [4]
+        gm_msgid = gmail_ids(message_without_id.as_bytes())[0]
+        assert lookups[-1] == [str(gm_msgid)]
+        [parsed] = parse_raw_items('me@example.com', messages)
+        assert parsed['message_id'] == f'<{gm_msgid}@x-gm-msgid.invalid>'
+        assert parsed['gm_msgid'] == gm_msgid
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_condstore_sync_returns_only_flag_changes_and_vanished_uids():
+    mailbox = FakeMailbox()
+    for i in range(5):
+        mailbox.add_message('INBOX', _build_message(i))
+
+    with FakeIMAPServer(mailbox) as server:
+        server.capabilities += ['ENABLE', 'CONDSTORE', 'QRESYNC']
+        from email_handler import EmailHandler
+
+        # ENABLEはSELECT前（AUTH状態）でしか送れない
+        handler = EmailHandler('test@example.com', 'password', '127.0.0.1')
+        handler.connection = imaplib.IMAP4('127.0.0.1', server.port)
+        handler.connection.login('test@example.com', 'password')
+        handler._enable_extensions()
+        handler.current_state = 'SELECTED'
+        assert handler.qresync_enabled
+
+        first, messages = _sync_folder(handler, 'INBOX', 0, None, ExistingMessageIndex(lambda ids: set()), False)
+        assert len(messages) == 5
+        assert messages[0]['imap_folder'] == 'INBOX'
+        modseq = first['highestmodseq']
+
+        mailbox.set_flags('INBOX', 2, ['\\Seen', '\\Flagged'])
+        mailbox.expunge('INBOX', 4)
+        mailbox.expunge('INBOX', 5)
+
+        second, messages = _sync_folder(handler, 'INBOX', first['last_uid'], first['uidvalidity'],
+                                        ExistingMessageIndex(lambda ids: set(ids)), False, known_modseq=modseq)
+        assert messages == []
+        assert second['flag_changes'] == {2: '\\Seen \\Flagged'}
+        assert second['vanished'] == [4, 5]
+        assert second['highestmodseq'] > modseq
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_get_contacts_fetches_only_new_uids_after_first_call():
+    from utils.contact_cache import clear_contact_cache
+
+    mailbox = FakeMailbox()
+    for i in range(3):
+        mailbox.add_message('INBOX', _build_message(i))
+
+    with FakeIMAPServer(mailbox) as server:
+        clear_contact_cache()
+        handler = _connected_handler(server)
+        fetched = []
+        fetch_messages = handler.fetch_messages
+        handler.fetch_messages = lambda uids, items: fetched.append(list(uids)) or fetch_messages(uids, items)
+
+        contacts = handler.get_contacts(since_days=30)
+        assert contacts == sorted(['me@example.com'] + [f'送信者{i} <sender{i}@example.com>' for i in range(3)])
+
+        mailbox.add_message('INBOX', _build_message(3))
+        contacts = handler.get_contacts(search_query='sender3', since_days=30)
+        assert contacts == ['送信者3 <sender3@example.com>']
+        assert fetched == [[1, 2, 3], [4]]
+        handler.connection.logout()
+        handler.connection = None
+
+
+def test_sync_folder_recovers_from_injected_throttling_and_disconnects():
+    from benchmarks.mailbox_generator import build_mailbox
+    from email_handler import EmailHandler
+
+    mailbox = build_mailbox(30, sent_folder=None)
+    with FakeIMAPServer(mailbox, throttle_every=6, disconnect_every=11) as server:
+        handler = EmailHandler('test@example.com', 'password', '127.0.0.1', imap_port=server.port, use_ssl=False)
+        assert handler.connect()
+        handler.batch_controller._size = 5
+
+        # チェックポイントは失敗したUIDの手前までしか進まないので、繰り返せば全件そろう
+        last_uid, received = 0, set()
+        for _ in range(10):
+            result, messages = _sync_folder(handler, 'INBOX', last_uid, None, ExistingMessageIndex(lambda ids: set()), False)
+            received.update(message['uid'] for message in messages)
+            last_uid = result['last_uid'] or last_uid
+            if last_uid == 30:
+                break
+
+        assert last_uid == 30
+        assert received == set(range(1, 31))
+        assert server.stats['throttled'] and server.stats['disconnects']
+        handler.disconnect()
+
+
+def test_sync_folder_retries_throttled_batches_in_one_pass():
+    from benchmarks.mailbox_generator import build_mailbox
+    from utils.sync_pipeline import CONTROL_KEY
+    from email_handler import EmailHandler
+
+    mailbox = build_mailbox(30, sent_folder=None)
+    with FakeIMAPServer(mailbox, throttle_every=4) as server:
+        handler = EmailHandler('test@example.com', 'password', '127.0.0.1', imap_port=server.port, use_ssl=False)
+        assert handler.connect()
+        handler.batch_controller._size = 5
+
+        # スロットリングされたバッチは取り直すので、1回の同期で全件そろいチェックポイントも最後まで進む
+        items = []
+        result = handler._sync_folder('INBOX', 0, None, ExistingMessageIndex(lambda ids: set()), False, items.append)
+        messages = [item for item in items if CONTROL_KEY not in item]
+        checkpoints = [item['last_uid'] for item in items if item.get(CONTROL_KEY) == 'checkpoint']
+
+        assert server.stats['throttled']
+        assert sorted(message['uid'] for message in messages) == list(range(1, 31))
+        assert result['last_uid'] == 30 and checkpoints[-1] == 30
+        assert result['saved'] == 30
+        handler.disconnect()
+
+
+def test_sync_pipeline_parses_in_worker_processes():
+    from utils.sync_pipeline import SyncPipeline
+
+    mailbox = FakeMailbox()
+    for i in range(60):
+        mailbox.add_message('INBOX', _build_message(i))
+
+    with FakeIMAPServer(mailbox) as server:
+        handler = _connected_handler(server)
+        handler.current_state = 'SELECTED'
+        written = []
+        results = []
+
+        pipeline = SyncPipeline('me@example.com', parse_workers=2, queue_size=20, chunk_size=5,
+                                write_batch_size=25)
+        stats = pipeline.run(
+            lambda emit: results.append(handler._sync_folder('INBOX', 0, None, ExistingMessageIndex(lambda ids: set()), False, emit=emit)),
+            lambda batch: written.append(list(batch))
+        )
+
+        items = [item for batch in written for item in batch]
+        messages = [item for item in items if 'control' not in item]
+        assert sorted(m['uid'] for m in messages) == list(range(1, 61))
+        assert all(len(batch) <= 25 + 5 + 1 for batch in written)
+        assert messages[0]['body_hash']
+
+        # チェックポイントは対象のメッセージがすべて書き込まれた後に届く
+        checkpoint = next(i for i, item in enumerate(items) if item.get('control') == 'checkpoint')
+        assert items[checkpoint]['last_uid'] == 60
+        assert checkpoint == len(items) - 1
+        assert results[0]['last_uid'] == 60
+        assert stats['fetch']['items'] == stats['parse']['items'] == stats['write']['items'] == 60
+        handler.connection.logout()
+        handler.connection = None
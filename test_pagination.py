@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, create_engine, select
+
+from utils.pagination import after_key, decode_cursor, encode_cursor, page_of, ranked_page, sort_order
+
+
+def test_cursor_round_trip_and_rejects_tampered_values():
+    date = datetime(2024, 12, 1, 9, 30)
+    assert decode_cursor(encode_cursor(date, 42)) == (date, 42)
+    assert decode_cursor(encode_cursor(None, 7)) == (None, 7)
+    assert decode_cursor(encode_cursor('山田 <yamada@example.jp>'), (str,)) == ('山田 <yamada@example.jp>',)
+    assert decode_cursor(encode_cursor(3, date, 5), (float, datetime, int)) == (3.0, date, 5)
+
+    # 数や型が合わないカーソルは先頭ページとして扱う
+    assert decode_cursor(encode_cursor(date, 'x')) is None
+    assert decode_cursor(encode_cursor(date)) is None
+    assert decode_cursor('not-a-cursor') is None
+    assert decode_cursor(None) is None
+
+
+# SQLiteはNULLの既定の位置がPostgreSQLと逆なので、位置は明示して確かめる
+@pytest.mark.parametrize('descending,nulls_last', [(True, True), (True, False), (False, True), (False, False)])
+def test_keyset_pages_match_full_sort(descending, nulls_last):
+    engine = create_engine('sqlite://')
+    metadata = MetaData()
+    rows = Table('rows', metadata, Column('id', Integer, primary_key=True),
+                 Column('date', DateTime), Column('name', String))
+    metadata.create_all(engine)
+    base = datetime(2024, 12, 1)
+    with engine.begin() as connection:
+        # 同じ日付・日付なしを含める
+        connection.execute(rows.insert(), [
+            {'id': i, 'date': None if i % 7 == 0 else base + timedelta(days=i % 5), 'name': f'n{i % 3}'}
+            for i in range(1, 41)
+        ])
+
+    columns = [rows.c.date, rows.c.id]
+    order = sort_order(columns, descending, nulls_last)
+    with engine.connect() as connection:
+        expected = [row.id for row in connection.execute(select(rows).order_by(*order))]
+        seen, cursor = [], None
+        while True:
+            query = select(rows).order_by(*order)
+            keyset = after_key(columns, decode_cursor(cursor), descending, nulls_last)
+            if keyset is not None:
+                query = query.where(keyset)
+            page, cursor = page_of(connection.execute(query.limit(7)).all(), 6)
+            seen.extend(row.id for row in page)
+            if cursor is None:
+                break
+
+    assert seen == expected
+
+
+def test_ranked_pages_keep_rows_with_equal_rank_across_page_boundary():
+    from sqlalchemy import Float, event
+    from sqlalchemy.orm import Session, declarative_base
+
+    Base = declarative_base()
+
+    class Row(Base):
+        __tablename__ = 'ranked_rows'
+        id = Column(Integer, primary_key=True)
+        date = Column(DateTime)
+        rank = Column(Float)
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    base = datetime(2024, 12, 1)
+    with Session(engine) as session:
+        # ts_rankが返しがちな同じ値を、ページ境界をまたいで何行も並べる
+        session.add_all(Row(id=i, date=base + timedelta(days=i % 3), rank=(0.0607927 if i % 4 else 0.1))
+                        for i in range(1, 31))
+        session.commit()
+
+        expected = [row.id for row in session.query(Row).order_by(Row.rank.desc(), Row.date.desc(), Row.id.desc())]
+        seen, cursor = [], None
+        while True:
+            page, cursor = ranked_page(session.query(Row), Row.rank, Row.date, Row.id, cursor, limit=4)
+            seen.extend(row.id for row in page)
+            if cursor is None:
+                break
+
+    assert seen == expected
+    # カーソルとの比較は倍精度にキャストしたrankだけで行う（PostgreSQLのreal対策）
+    keyset_queries = [sql for sql in statements if 'WHERE' in sql]
+    assert keyset_queries
+    for sql in keyset_queries:
+        assert 'CAST(ranked_rows.rank AS FLOAT) = ?' in sql
+        assert 'ranked_rows.rank =' not in sql and 'ranked_rows.rank <' not in sql
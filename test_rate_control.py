@@ -0,0 +1,62 @@
+import socket
+
+from utils.rate_control import AIMDBatchController, TokenBucket, classify_error
+
+
+def test_aimd_grows_on_fast_batches_and_halves_on_failure():
+    controller = AIMDBatchController(100, 10, 500, target_latency=5.0, increase=10)
+
+    controller.record_success(1.0)
+    controller.record_success(1.0)
+    assert controller.size == 120
+
+    controller.record_failure('timeout')
+    assert controller.size == 60
+
+    # 目標の2倍を超える応答も輻輳とみなす
+    controller.record_success(11.0)
+    assert controller.size == 30
+
+    for _ in range(10):
+        controller.record_failure('throttle')
+    assert controller.size == 10
+
+
+def test_token_bucket_slows_down_after_failures():
+    bucket = TokenBucket(rate=100.0, capacity=2, min_rate=1.0, max_rate=200.0)
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+
+    bucket.on_failure()
+    assert bucket.get_stats()['rate'] == 50.0
+    assert not bucket.acquire(timeout=0.001)
+    assert bucket.acquire(timeout=1)
+
+    bucket.on_success()
+    assert bucket.get_stats()['rate'] == 51.0
+
+
+def test_classify_error():
+    assert classify_error(socket.timeout('The read operation timed out')) == 'timeout'
+    assert classify_error(Exception('UID FETCH failed: NO [THROTTLED] Too many requests')) == 'throttle'
+    assert classify_error(Exception('UID FETCH failed: BAD syntax')) is None
+
+
+def test_connection_backoff_has_floor_and_cap(monkeypatch):
+    import email_handler
+    from email_handler import EmailHandler, MAX_BACKOFF_TIME, RETRY_DELAY
+
+    sleeps = []
+    monkeypatch.setattr(email_handler.time, 'sleep', sleeps.append)
+    handler = EmailHandler('backoff@example.com', 'password', 'imap.backoff.example.com')
+    rate_before = handler.rate_limiter.get_stats()['rate']
+
+    for attempt in range(6):
+        handler._backoff('test', attempt)
+
+    assert RETRY_DELAY <= sleeps[0] <= RETRY_DELAY + 1
+    assert all(later >= earlier for earlier, later in zip(sleeps, sleeps[1:]))
+    assert sleeps[-1] == MAX_BACKOFF_TIME
+    # 接続レベルの失敗ではサーバー共有のレートを下げない
+    assert handler.rate_limiter.get_stats()['rate'] == rate_before
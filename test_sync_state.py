@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+
+from models import EmailSettings, FolderSyncState
+
+
+def test_stale_sync_lease_is_reclaimed():
+    settings = EmailSettings(email='me@example.com', imap_server='imap.example.com')
+
+    assert settings.acquire_sync_lease('host:1:1')
+    assert settings.sync_in_progress
+    assert not settings.acquire_sync_lease('host:2:1')
+
+    # プロセスが落ちてリースが切れた場合は別のプロセスが回収できる
+    settings.sync_lease_expires = datetime.utcnow() - timedelta(seconds=1)
+    assert not settings.sync_in_progress
+    assert settings.acquire_sync_lease('host:2:1')
+    assert settings.sync_owner == 'host:2:1'
+
+    settings.release_sync_lease('SUCCESS')
+    assert not settings.is_syncing
+    assert settings.last_sync_status == 'SUCCESS'
+
+
+def test_legacy_stuck_flag_without_lease_is_not_in_progress():
+    settings = EmailSettings(email='me@example.com', imap_server='imap.example.com', is_syncing=True)
+    assert not settings.sync_in_progress
+
+
+def test_record_progress_never_moves_checkpoint_backwards():
+    state = FolderSyncState(account_email='me@example.com', folder='INBOX', last_uid=0,
+                            synced_count=0, skipped_count=0)
+    state.record_progress(200, synced=150, skipped=50)
+    state.record_progress(100, synced=10)
+
+    assert state.last_uid == 200
+    assert state.synced_count == 160
+    assert state.skipped_count == 50
+
+
+def test_record_result_keeps_checkpoint_and_resets_on_uidvalidity_change():
+    state = FolderSyncState(account_email='me@example.com', folder='INBOX', last_uid=300, uidvalidity=7,
+                            highest_modseq=40, synced_count=300, skipped_count=0)
+    result = {'uidvalidity': 7, 'last_uid': 250, 'uidnext': 301, 'highestmodseq': 55}
+
+    assert not state.record_result(result)
+    assert (state.last_uid, state.uidnext, state.highest_modseq) == (300, 301, 55)
+
+    assert state.record_result(dict(result, uidvalidity=8, last_uid=None, uidnext=5, highestmodseq=None))
+    assert (state.uidvalidity, state.last_uid, state.synced_count) == (8, 0, 0)
+    assert (state.uidnext, state.highest_modseq) == (5, None)
+
+    # UIDだけで同期した結果（highestmodseqなし）は記録済みのMODSEQを残す
+    state.highest_modseq = 60
+    state.record_result({'uidvalidity': 8, 'last_uid': 9, 'uidnext': 10})
+    assert (state.last_uid, state.uidnext, state.highest_modseq) == (9, 10, 60)
+
+
+def test_uidvalidity_change_forgets_old_imap_locations(monkeypatch):
+    from sqlalchemy.dialects import postgresql
+    from sqlalchemy.orm import Session
+
+    from models import EmailMessage
+
+    forgotten = []
+    monkeypatch.setattr(EmailMessage, 'forget_imap_locations',
+                        classmethod(lambda cls, session, account, folder: forgotten.append((account, folder)) or 0))
+    session = Session()
+    state = FolderSyncState(account_email='me@example.com', folder='INBOX', last_uid=300, uidvalidity=7,
+                            synced_count=300, skipped_count=0)
+    session.add(state)
+
+    assert not state.reset_if_uidvalidity_changed(7)
+    assert state.reset_if_uidvalidity_changed(8)
+    # 古いUIDは新しいUIDの空間では別のメッセージを指すため、同じセッションで位置を消す
+    assert forgotten == [('me@example.com', 'INBOX')]
+
+    # 初回の同期（UIDVALIDITY未記録）では消すものがない
+    assert FolderSyncState(account_email='me@example.com', folder='Sent').reset_if_uidvalidity_changed(1)
+    assert forgotten == [('me@example.com', 'INBOX')]
+    monkeypatch.undo()
+
+    class Recorder:
+        def execute(self, statement):
+            self.sql = str(statement.compile(dialect=postgresql.dialect()))
+            return type('Result', (), {'rowcount': 3})()
+
+    recorder = Recorder()
+    assert EmailMessage.forget_imap_locations(recorder, 'me@example.com', 'INBOX') == 3
+    assert recorder.sql.startswith('UPDATE email_message SET imap_uid=')
+    assert 'imap_folder=' in recorder.sql.split('WHERE')[0]
+    assert 'email_message.imap_account =' in recorder.sql and 'email_message.imap_folder =' in recorder.sql
+
+
+def test_contact_stats_summarize_counts_by_counterpart():
+    from models import ContactStats
+
+    summary = ContactStats.summarize([
+        ('alice@example.com', 'me@example.com', False, datetime(2024, 12, 1), '最初'),
+        ('me@example.com', 'alice@example.com', True, datetime(2024, 12, 3), '返信'),
+        ('alice@example.com', 'me@example.com', False, datetime(2024, 12, 2), '二通目'),
+        ('bob@example.com', 'me@example.com', False, None, '日付なし'),
+        (None, 'me@example.com', False, datetime(2024, 12, 4), '差出人なし'),
+    ])
+
+    # 送信済みは宛先側に数え、自分のアドレスは集計に出てこない
+    assert set(summary) == {'alice@example.com', 'bob@example.com'}
+    alice = summary['alice@example.com']
+    assert (alice['sent_count'], alice['received_count']) == (1, 2)
+    assert alice['last_message_date'] == datetime(2024, 12, 3)
+    assert alice['last_subject'] == '返信'
+    assert summary['bob@example.com']['last_message_date'] is None
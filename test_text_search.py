@@ -0,0 +1,60 @@
+from utils.text_search import has_cjk, normalize_query, use_full_text
+
+
+def test_word_queries_use_full_text_and_substrings_fall_back():
+    assert use_full_text('quarterly report')
+    assert use_full_text('"project plan" -draft')
+    # 全角英数字はNFKCで半角になってから判定する
+    assert normalize_query('ＲＥＰＯＲＴ　２０２４') == 'REPORT 2024'
+    assert use_full_text('ＲＥＰＯＲＴ　２０２４')
+
+    assert not use_full_text('打ち合わせ')
+    assert not use_full_text('invoice 請求書')
+    assert not use_full_text('alice@exam')
+    assert not use_full_text('report.pdf')
+    assert not use_full_text('   ')
+
+
+def test_has_cjk():
+    assert has_cjk('ｶﾀｶﾅ')
+    assert has_cjk('회의')
+    assert has_cjk('项目')
+    assert not has_cjk('Отчёт café')
+
+
+def test_cjk_ngrams_cover_every_query_bigram():
+    from utils.text_search import cjk_ngrams, query_ngrams
+
+    indexed = cjk_ngrams('来週の打ち合わせの件', 'ご確認ください。', '"山田 太郎" <yamada@example.jp>')
+    # 漢字・かなの連続だけをbigramにし、英数字は含めない
+    assert '打ち' in indexed and 'ち合' in indexed and '山田' in indexed
+    assert not any(gram.isascii() for gram in indexed)
+    assert set(query_ngrams('打ち合わせ')) <= set(indexed)
+    assert set(query_ngrams('ｶｸﾆﾝ')) == {'カク', 'クニ', 'ニン'}
+
+    # 1文字の連続はその文字を保存するが、1文字の検索語ではインデックスを使わない
+    assert '件' not in indexed and '字' in cjk_ngrams('a 字 b')
+    assert query_ngrams('字') == []
+    assert query_ngrams('report') == []
+
+
+def test_substring_condition_rechecks_normalized_columns_and_escapes_wildcards():
+    from sqlalchemy.dialects import postgresql
+
+    from models import EmailMessage
+
+    def compile_sql(condition):
+        return condition.compile(dialect=postgresql.dialect())
+
+    # 半角カナの語はbigramと同じくNFKC正規化した列で確かめる
+    compiled = compile_sql(EmailMessage.substring_condition('ｶﾞｲﾄﾞ'))
+    assert 'email_message.search_ngrams @>' in str(compiled)
+    assert str(compiled).count('normalize(email_message.') == 4
+    assert 'ガイド' in compiled.params.values()
+    assert ['イド', 'ガイ'] in compiled.params.values()
+
+    # CJKを含まない語はインデックスを使えるよう列をそのまま比較し、% と _ はエスケープする
+    compiled = compile_sql(EmailMessage.substring_condition('100%_off'))
+    assert 'normalize(' not in str(compiled) and 'search_ngrams' not in str(compiled)
+    assert "ESCAPE '/'" in str(compiled)
+    assert '100/%/_off' in compiled.params.values()
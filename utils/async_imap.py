@@ -0,0 +1,555 @@
+"""
+asyncio版のIMAPクライアントと同期エンジン
+
+EmailHandlerはimaplib（ブロッキング）の上に作られており、同期中のアカウント
+ごとにOSスレッドを1本占有する。ここではasyncioのストリームでIMAPを直接話し、
+1つのイベントループ上で多数のアカウントを同時に同期する。
+サーバーごとの同時接続数はセマフォで制限する。
+
+新着はUIDとMessage-IDだけで同期する。GmailやCONDSTORE/QRESYNC対応のサーバーでも
+X-GM-MSGID・フラグ・HIGHESTMODSEQは読み書きしないため、スレッド版の同期の
+チェックポイント（フラグ変更・削除の取得位置）はそのまま残る。
+"""
+import asyncio
+import email
+import inspect
+import logging
+import re
+import ssl
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from utils.bodystructure import parse_bodystructure, find_text_part, list_attachments
+from utils.imap_fetch import FetchChunk, compress_uid_set, find_fetch_item, find_sent_folder, parse_fetch_response
+from utils.message_index import ExistingMessageIndex
+from utils.rate_control import AIMDBatchController, classify_error
+from utils.sync_pipeline import CONTROL_KEY
+
+app_logger = logging.getLogger('mailchat')
+
+# 定数の定義
+IMAP_SSL_PORT = 993
+SOCKET_TIMEOUT = 60  # 応答1行を待つ最大時間（秒）
+INITIAL_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 500
+MIN_BATCH_SIZE = 10
+BATCH_TARGET_LATENCY = 5.0
+RETRY_DELAY = 2
+MAX_BACKOFF_TIME = 30
+
+# 重複判定用に先に取得するヘッダー（EmailHandlerと同じ）
+HEADER_FETCH_ITEMS = '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE FROM TO SUBJECT)])'
+
+_TAGGED = re.compile(rb'^(?P<tag>[A-Z]\d+) (?P<status>[A-Z]+) ?(?P<text>.*)$')
+_UNTAGGED_NUMBERED = re.compile(rb'^\* (?P<number>\d+) (?P<type>[A-Z-]+) ?(?P<rest>.*)$', re.IGNORECASE | re.DOTALL)
+_UNTAGGED = re.compile(rb'^\* (?P<type>[A-Z-]+) ?(?P<rest>.*)$', re.IGNORECASE | re.DOTALL)
+_LITERAL_AT_END = re.compile(rb'\{(\d+)\}$')
+_RESPONSE_CODE = re.compile(rb'\[(?P<code>[A-Z-]+)(?: (?P<value>[^\]]*))?\]', re.IGNORECASE)
+_LIST_RESPONSE = re.compile(rb'\((?P<flags>[^)]*)\) (?P<delimiter>"[^"]*"|NIL) (?P<name>.+)$')
+
+Emit = Callable[[Dict[str, Any]], Union[None, Awaitable[None]]]
+
+
+class AsyncIMAPError(Exception):
+    """IMAPコマンドがOK以外で完了した"""
+
+
+def _quote(value: str) -> str:
+    """空白や特殊文字を含む引数を引用符で囲む（imaplibと同じ規則）"""
+    if value and not re.search(r'[\s"(){}%*\\\]]', value):
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class AsyncIMAPClient:
+    """asyncioで動くIMAPクライアント（EmailHandlerの接続・選択・検索・取得に相当）"""
+
+    def __init__(self, email_address: str, password: str, imap_server: str,
+                 port: int = IMAP_SSL_PORT, use_ssl: bool = True, timeout: float = SOCKET_TIMEOUT):
+        self.email_address = email_address
+        self.password = password
+        self.imap_server = imap_server
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.capabilities: set = set()
+        self.folder_status: Dict[str, Optional[int]] = {}
+        self.current_folder: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._tag_counter = 0
+        # 1接続で同時に1コマンドだけ発行する
+        self._command_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    # --- 低レベルの送受信 -------------------------------------------------
+
+    async def _readline(self) -> bytes:
+        line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+        if not line:
+            raise ConnectionError("IMAPサーバーとの接続が切断されました")
+        return line.rstrip(b'\r\n')
+
+    async def _read_response(self) -> List[FetchChunk]:
+        """応答1件分をリテラルごとに読み、imaplibと同じ (bytes | (bytes, literal)) のリストで返す"""
+        chunks: List[FetchChunk] = []
+        line = await self._readline()
+        while True:
+            match = _LITERAL_AT_END.search(line)
+            if not match:
+                chunks.append(line)
+                return chunks
+            literal = await asyncio.wait_for(self._reader.readexactly(int(match.group(1))), self.timeout)
+            chunks.append((line, literal))
+            line = await self._readline()
+
+    async def _send(self, *args: str) -> bytes:
+        self._tag_counter += 1
+        tag = f'A{self._tag_counter:04d}'.encode()
+        self._writer.write(tag + b' ' + ' '.join(args).encode('utf-8') + b'\r\n')
+        await self._writer.drain()
+        return tag
+
+    async def _stream(self, *args: str) -> AsyncIterator[Tuple[str, List[FetchChunk]]]:
+        """コマンドを送り、未タグ応答を (種類, チャンク) として届いた順に返す
+
+        FETCHの応答はimaplibと同じく "12 (UID 34 ...)" の形に整える。
+        """
+        async with self._command_lock:
+            tag = await self._send(*args)
+            completed = False
+            try:
+                while True:
+                    chunks = await self._read_response()
+                    head = chunks[0][0] if isinstance(chunks[0], tuple) else chunks[0]
+                    tagged = _TAGGED.match(head) if head.startswith(tag + b' ') else None
+                    if tagged:
+                        completed = True
+                        if tagged.group('status') != b'OK':
+                            raise AsyncIMAPError(
+                                f"{args[0]} failed: {tagged.group('status').decode()} "
+                                f"{tagged.group('text').decode('utf-8', errors='replace')}"
+                            )
+                        return
+                    if head.startswith(b'+'):
+                        continue
+                    kind, chunks = self._classify(chunks)
+                    if kind == 'BYE' and args[0] != 'LOGOUT':
+                        raise ConnectionError(f"サーバーが接続を閉じました: {chunks[0]!r}")
+                    yield kind, chunks
+            finally:
+                if not completed and self.connected:
+                    # 途中で読むのをやめた場合は接続を捨てる（残りの応答と同期が取れないため）
+                    await self._close()
+
+    @staticmethod
+    def _classify(chunks: List[FetchChunk]) -> Tuple[str, List[FetchChunk]]:
+        first = chunks[0]
+        head, literal = (first if isinstance(first, tuple) else (first, None))
+        numbered = _UNTAGGED_NUMBERED.match(head)
+        if numbered:
+            kind = numbered.group('type').decode().upper()
+            head = numbered.group('number') + b' ' + numbered.group('rest')
+        else:
+            untagged = _UNTAGGED.match(head)
+            if not untagged:
+                return 'UNKNOWN', chunks
+            kind = untagged.group('type').decode().upper()
+            head = untagged.group('rest')
+        first = (head, literal) if literal is not None else head
+        return kind, [first] + chunks[1:]
+
+    async def _command(self, *args: str) -> Dict[str, List[List[FetchChunk]]]:
+        """コマンドを完了まで実行し、未タグ応答を種類ごとにまとめて返す"""
+        responses: Dict[str, List[List[FetchChunk]]] = {}
+        async for kind, chunks in self._stream(*args):
+            responses.setdefault(kind, []).append(chunks)
+        return responses
+
+    async def _close(self) -> None:
+        writer, self._writer, self._reader = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    # --- 公開API ----------------------------------------------------------
+
+    async def connect(self) -> bool:
+        """接続してログインする。失敗した場合はlast_errorに理由を残してFalseを返す"""
+        await self._close()
+        try:
+            ssl_context = ssl.create_default_context() if self.use_ssl else None
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.imap_server, self.port, ssl=ssl_context), self.timeout
+            )
+            greeting = await self._readline()
+            if not greeting.startswith(b'* OK') and not greeting.startswith(b'* PREAUTH'):
+                raise AsyncIMAPError(f"想定外の応答です: {greeting!r}")
+            if not greeting.startswith(b'* PREAUTH'):
+                await self._command('LOGIN', _quote(self.email_address), _quote(self.password))
+            await self.capability()
+            self.last_error = None
+            return True
+        except (OSError, asyncio.TimeoutError, AsyncIMAPError) as e:
+            self.last_error = str(e) or e.__class__.__name__
+            app_logger.error(f"IMAP接続エラー ({self.email_address}): {self.last_error}")
+            await self._close()
+            return False
+
+    async def logout(self) -> None:
+        if not self.connected:
+            return
+        try:
+            await self._command('LOGOUT')
+        except Exception as e:
+            app_logger.debug(f"LOGOUTエラー（無視します）: {str(e)}")
+        finally:
+            await self._close()
+
+    async def capability(self) -> set:
+        responses = await self._command('CAPABILITY')
+        for chunks in responses.get('CAPABILITY', []):
+            self.capabilities = {cap.upper() for cap in chunks[0].decode().split()}
+        return self.capabilities
+
+    def has_capability(self, name: str) -> bool:
+        return name.upper() in self.capabilities
+
+    async def list_folders(self) -> List[Tuple[List[str], str]]:
+        """(フラグ, フォルダー名) のリストを返す"""
+        responses = await self._command('LIST', '""', '"*"')
+        folders = []
+        for chunks in responses.get('LIST', []):
+            match = _LIST_RESPONSE.match(chunks[0])
+            if not match:
+                continue
+            name = match.group('name').decode('utf-8', errors='replace').strip().strip('"')
+            folders.append((match.group('flags').decode().split(), name))
+        return folders
+
+    async def get_sent_folder(self) -> Optional[str]:
+        """送信済みフォルダーをLISTから探す（EmailHandler.get_gmail_foldersと同じ規則）"""
+        return find_sent_folder(name for _, name in await self.list_folders())
+
+    async def select(self, folder: str, readonly: bool = False) -> Dict[str, Optional[int]]:
+        """フォルダーを選択し、EXISTS/UIDVALIDITY/UIDNEXT/HIGHESTMODSEQを返す"""
+        responses = await self._command('EXAMINE' if readonly else 'SELECT', _quote(folder))
+        status: Dict[str, Optional[int]] = {
+            'exists': None, 'uidvalidity': None, 'uidnext': None, 'highestmodseq': None,
+        }
+        for chunks in responses.get('EXISTS', []):
+            status['exists'] = int(chunks[0].split()[0])
+        for chunks in responses.get('OK', []):
+            match = _RESPONSE_CODE.search(chunks[0])
+            if match and match.group('code').lower().decode() in status and match.group('value'):
+                try:
+                    status[match.group('code').lower().decode()] = int(match.group('value'))
+                except ValueError:
+                    pass
+        self.folder_status = status
+        self.current_folder = folder
+        return status
+
+    async def search(self, *criteria: str) -> List[int]:
+        """UID SEARCH を実行してUIDのリストを返す"""
+        responses = await self._command('UID', 'SEARCH', *criteria)
+        uids: List[int] = []
+        for chunks in responses.get('SEARCH', []):
+            uids.extend(int(uid) for uid in chunks[0].split() if uid.isdigit())
+        return uids
+
+    async def search_new_uids(self, last_uid: int) -> List[int]:
+        """last_uidより大きいUIDを昇順で返す"""
+        uids = await self.search('UID', f'{last_uid + 1}:*')
+        # "n:*" は該当がなくても最大UIDを返すため、last_uid以下を除外する
+        return sorted(uid for uid in uids if uid > last_uid)
+
+    async def fetch(self, uids: Sequence[int], items: str) -> AsyncIterator[Dict[str, Any]]:
+        """1回の UID FETCH でバッチ全体を取得し、届いた順にレコードを返す"""
+        uid_set = compress_uid_set(uids)
+        if not uid_set:
+            return
+        if 'UID' not in items.upper():
+            items = f"(UID {items.strip('()')})"
+        async for kind, chunks in self._stream('UID', 'FETCH', uid_set, items):
+            if kind == 'FETCH':
+                for record in parse_fetch_response(chunks):
+                    yield record
+
+    async def fetch_headers(self, uids: Sequence[int]) -> List[Dict[str, Any]]:
+        """ヘッダーとサイズだけを取得し、UIDごとのMessage-IDを返す"""
+        headers = []
+        async for record in self.fetch(uids, HEADER_FETCH_ITEMS):
+            msg = email.message_from_bytes(find_fetch_item(record, 'BODY[HEADER') or b'')
+            headers.append({
+                'uid': record.get('UID'),
+                'size': record.get('RFC822.SIZE') or 0,
+                'message_id': msg['message-id'],
+            })
+        return headers
+
+    async def fetch_message_parts(self, uids: Sequence[int],
+                                  max_text_bytes: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """BODYSTRUCTUREで選んだ本文パートだけを未パースのまま取得する（EmailHandlerと同じ形式）"""
+        structures: Dict[int, Dict[str, Any]] = {}
+        async for record in self.fetch(uids, '(UID BODYSTRUCTURE BODY.PEEK[HEADER])'):
+            parts = parse_bodystructure(record.get('BODYSTRUCTURE'))
+            text_part = find_text_part(parts)
+            structures[record.get('UID')] = {
+                'uid': record.get('UID'),
+                'header': find_fetch_item(record, 'BODY[HEADER'),
+                'text': None,
+                'text_part': text_part,
+                'attachments': list_attachments(parts, text_part),
+                'partial': bool(max_text_bytes and text_part and text_part['size'] > max_text_bytes),
+            }
+
+        uids_by_section: Dict[str, List[int]] = {}
+        for uid, info in structures.items():
+            if info['text_part'] is None:
+                yield info
+            else:
+                uids_by_section.setdefault(info['text_part']['section'], []).append(uid)
+
+        partial = f'<0.{max_text_bytes}>' if max_text_bytes else ''
+        for section, section_uids in uids_by_section.items():
+            async for record in self.fetch(section_uids, f'(UID BODY.PEEK[{section}]{partial})'):
+                info = structures.get(record.get('UID'))
+                if info is None:
+                    continue
+                info['text'] = find_fetch_item(record, f'BODY[{section}]')
+                yield info
+
+
+async def _call(emit: Emit, item: Dict[str, Any]) -> None:
+    result = emit(item)
+    if inspect.isawaitable(result):
+        await result
+
+
+class AsyncSyncEngine:
+    """1つのイベントループで多数のアカウントのフォルダーを増分同期する
+
+    サーバーごとの同時接続数は asyncio.Semaphore で制限し、上限に達した
+    アカウントは接続が空くまで待つ（スレッドは消費しない）。
+    取得したメッセージは EmailHandler._sync_folder と同じ形式の未パース項目と
+    チェックポイントとして emit(item) に渡す。
+    """
+
+    def __init__(self, server_limits: Optional[Dict[str, int]] = None,
+                 default_server_limit: Optional[int] = None):
+        from utils.connection_pool import DEFAULT_MAX_CONNECTIONS_PER_SERVER, MAX_CONNECTIONS_PER_SERVER
+
+        self.server_limits = dict(MAX_CONNECTIONS_PER_SERVER)
+        self.server_limits.update({server.lower(): limit for server, limit in (server_limits or {}).items()})
+        self.default_server_limit = default_server_limit or DEFAULT_MAX_CONNECTIONS_PER_SERVER
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.active: Dict[str, int] = {}
+        self.peak: Dict[str, int] = {}
+
+    def server_limit(self, imap_server: str) -> int:
+        return self.server_limits.get(imap_server.lower(), self.default_server_limit)
+
+    def _semaphore(self, imap_server: str) -> asyncio.Semaphore:
+        key = imap_server.lower()
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = self._semaphores[key] = asyncio.Semaphore(self.server_limit(key))
+        return semaphore
+
+    async def sync_folder(self, client: AsyncIMAPClient, folder: str, last_uid: int,
+                          known_uidvalidity: Optional[int], message_index: ExistingMessageIndex,
+                          is_sent: bool, emit: Emit, preview_bytes: Optional[int] = None,
+                          batch_controller: Optional[AIMDBatchController] = None) -> Dict[str, Any]:
+        """1フォルダー分の新着を取得する（EmailHandler._sync_folderのasyncio版）
+
+        フラグ変更・削除は取得しないため、結果にhighestmodseqは含めない
+        （FolderSyncState.record_result は記録済みのHIGHESTMODSEQを残す）。
+        """
+        loop = asyncio.get_running_loop()
+        controller = batch_controller or AIMDBatchController(
+            INITIAL_BATCH_SIZE, MIN_BATCH_SIZE, MAX_BATCH_SIZE, BATCH_TARGET_LATENCY
+        )
+        result: Dict[str, Any] = {
+            'folder': folder,
+            'selected': False,
+            'uidvalidity': None,
+            'uidnext': None,
+            'last_uid': None,
+            'processed': 0,
+            'saved': 0,
+            'skipped': 0,
+            'skipped_bytes': 0,
+        }
+        try:
+            status = await client.select(folder)
+        except AsyncIMAPError as e:
+            app_logger.error(f"フォルダー選択エラー ({client.email_address} {folder}): {str(e)}")
+            return result
+
+        result['selected'] = True
+        for key in ('uidvalidity', 'uidnext'):
+            result[key] = status.get(key)
+        if known_uidvalidity is not None and result['uidvalidity'] is not None \
+                and result['uidvalidity'] != known_uidvalidity:
+            last_uid = 0
+            # 新しいUIDのメッセージより先に書き込み側へ伝え、古いUIDの位置を消させる
+            await _call(emit, {
+                CONTROL_KEY: 'checkpoint',
+                'folder': folder,
+                'last_uid': 0,
+                'uidvalidity': result['uidvalidity'],
+                'saved': 0,
+                'skipped': 0,
+            })
+
+        uids = await client.search_new_uids(last_uid)
+        first_failed_uid = None
+        position = 0
+        failures = 0
+
+        while position < len(uids):
+            batch = uids[position:position + controller.size]
+            position += len(batch)
+            batch_saved = 0
+            batch_skipped = 0
+            batch_started = time.time()
+            received_uids = set()
+            try:
+                headers = await client.fetch_headers(batch)
+                received_uids.update(header['uid'] for header in headers)
+                # 既存判定はDBに問い合わせるため、イベントループを止めないよう別スレッドで行う
+                claimed = await loop.run_in_executor(
+                    None, message_index.claim_new, [header['message_id'] for header in headers]
+                )
+                new_uids = []
+                for header in headers:
+                    if not header['message_id']:
+                        result['processed'] += 1
+                    elif header['message_id'] in claimed:
+                        claimed.discard(header['message_id'])
+                        new_uids.append(header['uid'])
+                    else:
+                        batch_skipped += 1
+                        result['skipped_bytes'] += header['size']
+                        result['processed'] += 1
+
+                received_uids.difference_update(new_uids)
+                async for item in client.fetch_message_parts(new_uids, preview_bytes):
+                    received_uids.add(item['uid'])
+                    item['folder'] = folder
+                    item['imap_account'] = client.email_address
+                    item['imap_folder'] = folder
+                    item['is_sent'] = is_sent
+                    await _call(emit, item)
+                    batch_saved += 1
+                    result['processed'] += 1
+
+            except (OSError, asyncio.TimeoutError, AsyncIMAPError, ConnectionError) as e:
+                error_kind = classify_error(e) or ('timeout' if isinstance(e, asyncio.TimeoutError) else None)
+                app_logger.error(f"バッチ取得エラー ({client.email_address} {folder}): {str(e)}")
+                controller.record_failure(error_kind)
+                missing_uids = [uid for uid in batch if uid not in received_uids]
+                if missing_uids and (first_failed_uid is None or missing_uids[0] < first_failed_uid):
+                    first_failed_uid = missing_uids[0]
+                failures += 1
+                await asyncio.sleep(min(RETRY_DELAY * (2 ** (failures - 1)), MAX_BACKOFF_TIME))
+                if error_kind == 'throttle' and client.connected:
+                    continue
+                # 接続が壊れている場合は張り直して同じフォルダーを選択し直す
+                if not await client.connect():
+                    break
+                try:
+                    await client.select(folder)
+                except AsyncIMAPError:
+                    break
+                continue
+
+            failures = 0
+            controller.record_success(time.time() - batch_started)
+            result['saved'] += batch_saved
+            result['skipped'] += batch_skipped
+            if first_failed_uid is None:
+                await _call(emit, {
+                    CONTROL_KEY: 'checkpoint',
+                    'folder': folder,
+                    'last_uid': max(batch),
+                    'uidvalidity': result['uidvalidity'],
+                    'saved': batch_saved,
+                    'skipped': batch_skipped,
+                })
+
+        synced_uids = [uid for uid in uids if first_failed_uid is None or uid < first_failed_uid]
+        if synced_uids:
+            result['last_uid'] = max(synced_uids)
+        result['rate_control'] = controller.get_stats()
+        return result
+
+    async def sync_account(self, email_address: str, password: str, imap_server: str,
+                           message_index: ExistingMessageIndex, emit: Emit,
+                           plans: Optional[List[tuple]] = None,
+                           checkpoints: Optional[Dict[str, Tuple[int, Optional[int]]]] = None,
+                           sent_folder: Optional[str] = None, preview_bytes: Optional[int] = None,
+                           port: int = IMAP_SSL_PORT, use_ssl: bool = True) -> List[Dict[str, Any]]:
+        """(フォルダー, last_uid, uidvalidity) の計画に従ってアカウントを同期する
+
+        plansを省略した場合は、スレッド版と同じくINBOXとLISTで見つけた送信済みフォルダーを
+        checkpoints（{フォルダー: (last_uid, uidvalidity)}）の位置から同期する。
+        接続はサーバーのセマフォを取得してから張り、同期が終わるまで保持する。
+        """
+        server = imap_server.lower()
+        async with self._semaphore(server):
+            self.active[server] = self.active.get(server, 0) + 1
+            self.peak[server] = max(self.peak.get(server, 0), self.active[server])
+            client = AsyncIMAPClient(email_address, password, imap_server, port=port, use_ssl=use_ssl)
+            try:
+                if not await client.connect():
+                    raise ConnectionError(client.last_error or "IMAPサーバーへの接続に失敗しました")
+                if plans is None:
+                    sent_folder = sent_folder or await client.get_sent_folder()
+                    checkpoints = checkpoints or {}
+                    folders = ['INBOX'] + ([sent_folder] if sent_folder else [])
+                    plans = [(folder, *checkpoints.get(folder, (0, None))) for folder in folders]
+                controller = AIMDBatchController(INITIAL_BATCH_SIZE, MIN_BATCH_SIZE, MAX_BATCH_SIZE,
+                                                 BATCH_TARGET_LATENCY)
+                results = []
+                for folder, last_uid, uidvalidity in plans:
+                    results.append(await self.sync_folder(
+                        client, folder, last_uid, uidvalidity, message_index,
+                        folder == sent_folder, emit, preview_bytes, controller
+                    ))
+                return results
+            finally:
+                await client.logout()
+                self.active[server] -= 1
+
+    async def run(self, jobs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """複数アカウントを同時に同期し、{email: 結果のリスト or 例外} を返す
+
+        jobsの各要素は sync_account のキーワード引数。1アカウントの失敗は
+        他のアカウントに影響しない。
+        """
+        outcomes = await asyncio.gather(
+            *(self.sync_account(**job) for job in jobs), return_exceptions=True
+        )
+        results: Dict[str, Any] = {}
+        for job, outcome in zip(jobs, outcomes):
+            if isinstance(outcome, BaseException):
+                app_logger.error(f"非同期同期エラー ({job['email_address']}): {str(outcome)}")
+            results[job['email_address']] = outcome
+        return results
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """サーバーごとの同時接続数（現在・最大）と上限を返す"""
+        return {
+            server: {'active': self.active.get(server, 0), 'peak': self.peak.get(server, 0),
+                     'limit': self.server_limit(server)}
+            for server in self._semaphores
+        }
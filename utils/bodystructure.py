@@ -0,0 +1,168 @@
+import base64
+import binascii
+import quopri
+import re
+from email.header import decode_header
+from typing import Any, Dict, List, Optional
+
+# パート情報の辞書キー:
+#   section      : BODY[...] に指定するセクション番号 ("1", "2.1" など)
+#   content_type : "text/plain" など
+#   params       : Content-Typeのパラメーター（charset, name など）
+#   encoding     : Content-Transfer-Encoding（小文字）
+#   size         : エンコード後のサイズ（バイト）
+#   disposition  : "attachment" / "inline" / None
+#   filename     : ファイル名（RFC2047デコード済み）
+
+
+def _to_str(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+def _param_dict(values: Any) -> Dict[str, str]:
+    """("CHARSET" "UTF-8" "NAME" "a.pdf") 形式のリストを辞書にする"""
+    params: Dict[str, str] = {}
+    if not isinstance(values, list):
+        return params
+    for i in range(0, len(values) - 1, 2):
+        key = _to_str(values[i])
+        if key:
+            params[key.lower()] = _to_str(values[i + 1]) or ''
+    return params
+
+
+def _decode_filename(name: Optional[str]) -> Optional[str]:
+    if not name:
+        return None
+    try:
+        result = ''
+        for part, encoding in decode_header(name):
+            if isinstance(part, bytes):
+                result += part.decode(encoding or 'utf-8', errors='replace')
+            else:
+                result += part
+        return result
+    except Exception:
+        return name
+
+
+def _find_disposition(extension: List[Any]):
+    """拡張データから (disposition, params) を探す"""
+    for value in extension:
+        if isinstance(value, list) and value and isinstance(value[0], (str, bytes)) \
+                and (len(value) < 2 or value[1] is None or isinstance(value[1], list)):
+            disposition = _to_str(value[0])
+            if disposition and disposition.lower() in ('attachment', 'inline'):
+                return disposition.lower(), _param_dict(value[1] if len(value) > 1 else None)
+    return None, {}
+
+
+def _walk(structure: List[Any], section: str, parts: List[Dict[str, Any]]) -> None:
+    if structure and isinstance(structure[0], list):
+        # マルチパート: 子パートの後にサブタイプが続く
+        index = 1
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            _walk(child, f"{section}.{index}" if section else str(index), parts)
+            index += 1
+        return
+
+    main_type = (_to_str(structure[0]) or 'text').lower()
+    sub_type = (_to_str(structure[1]) or 'plain').lower()
+    params = _param_dict(structure[2] if len(structure) > 2 else None)
+    encoding = (_to_str(structure[5]) if len(structure) > 5 else None) or '7bit'
+    size = structure[6] if len(structure) > 6 and isinstance(structure[6], int) else 0
+
+    # text/* は行数、message/rfc822 はエンベロープ等が続いた後に拡張データがある
+    if main_type == 'text':
+        extension = structure[8:]
+    elif main_type == 'message' and sub_type == 'rfc822':
+        extension = structure[10:]
+    else:
+        extension = structure[7:]
+    disposition, disposition_params = _find_disposition(extension)
+
+    filename = disposition_params.get('filename') or params.get('name')
+    parts.append({
+        'section': section or '1',
+        'content_type': f"{main_type}/{sub_type}",
+        'params': params,
+        'encoding': encoding.lower(),
+        'size': size,
+        'disposition': disposition,
+        'filename': _decode_filename(filename),
+    })
+
+
+def parse_bodystructure(structure: Any) -> List[Dict[str, Any]]:
+    """BODYSTRUCTUREを葉パートのリストに展開する（message/rfc822の中身は展開しない）"""
+    parts: List[Dict[str, Any]] = []
+    if isinstance(structure, list) and structure:
+        _walk(structure, '', parts)
+    return parts
+
+
+def find_text_part(parts: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """本文として表示するパートを選ぶ（text/plain優先、なければtext/html）"""
+    for content_type in ('text/plain', 'text/html'):
+        for part in parts:
+            if part['content_type'] == content_type and part['disposition'] != 'attachment':
+                return part
+    return None
+
+
+def list_attachments(parts: List[Dict[str, Any]], text_part: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """本文以外のパートを添付ファイルのメタデータとして返す"""
+    attachments = []
+    for part in parts:
+        if text_part is not None and part['section'] == text_part['section']:
+            continue
+        is_text = part['content_type'].startswith('text/')
+        if part['disposition'] == 'attachment' or part['filename'] or not is_text:
+            attachments.append({
+                'filename': part['filename'],
+                'content_type': part['content_type'],
+                'size': part['size'],
+                'section': part['section'],
+            })
+    return attachments
+
+
+def decode_part(data: Optional[bytes], encoding: Optional[str], charset: Optional[str],
+                partial: bool = False) -> str:
+    """転送エンコーディングと文字コードを解除してテキストを返す
+
+    partial=True は BODY[n]<0.N> で先頭だけ取得したデータで、途中で切れた
+    base64の端数や末尾の不完全な文字を捨ててからデコードする。
+    """
+    if not data:
+        return ''
+    encoding = (encoding or '').lower()
+    try:
+        if encoding == 'base64':
+            if partial:
+                data = b''.join(data.split())
+                data = data[:len(data) - len(data) % 4]
+            data = base64.b64decode(data, validate=False)
+        elif encoding == 'quoted-printable':
+            if partial:
+                # 末尾で切れたソフト改行・エスケープ ("=", "=E") を除く
+                data = re.sub(rb'=[0-9A-Fa-f]?$', b'', data)
+            data = quopri.decodestring(data)
+    except (binascii.Error, ValueError):
+        pass
+
+    charset = charset or 'utf-8'
+    try:
+        return data.decode(charset)
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+    except UnicodeDecodeError:
+        if partial:
+            return data.decode(charset, errors='ignore')
+        return data.decode('utf-8', errors='replace')
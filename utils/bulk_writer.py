@@ -0,0 +1,183 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+
+from models import Contact, ContactStats, EmailAttachment, EmailMessage
+from utils.email_normalizer import normalize_email
+from utils.text_search import cjk_ngrams
+
+app_logger = logging.getLogger('mailchat')
+
+# 定数の定義
+INSERT_CHUNK_SIZE = 1000  # 1回のINSERTに含める最大行数（バインド変数の上限対策）
+
+# 既存メッセージを更新する場合に上書きする列
+UPDATE_COLUMNS = ('subject', 'body', 'body_tsv', 'search_ngrams', 'body_hash', 'body_preview', 'body_loaded', 'last_sync')
+# IMAP上の位置は、まだ記録されていない行だけ埋める（別フォルダーの同じメッセージで上書きしない）
+LOCATION_COLUMNS = ('imap_account', 'imap_folder', 'imap_uid', 'flags')
+
+
+def _chunks(rows: List[Dict[str, Any]], size: int = INSERT_CHUNK_SIZE) -> Iterable[List[Dict[str, Any]]]:
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def upsert_contacts(session, addresses: Iterable[Optional[str]]) -> Dict[str, int]:
+    """アドレスの連絡先をまとめて作成し、{元のアドレス: contact.id} を返す
+
+    Contact.find_or_create と同じ正規化を行い、既存の連絡先はそのまま使う。
+    """
+    normalized_by_address: Dict[str, str] = {}
+    rows: Dict[str, Dict[str, Any]] = {}
+    now = datetime.utcnow()
+    for address in set(filter(None, addresses)):
+        try:
+            normalized, display_name, original = normalize_email(address)
+        except Exception as e:
+            app_logger.warning(f"連絡先の正規化に失敗しました {address}: {str(e)}")
+            continue
+        if not normalized:
+            continue
+        normalized_by_address[address] = normalized
+        rows.setdefault(normalized, {
+            'email': original or address,
+            'display_name': display_name or original or address,
+            'normalized_email': normalized,
+            'created_at': now,
+            'updated_at': now,
+        })
+
+    if not rows:
+        return {}
+
+    for chunk in _chunks(list(rows.values())):
+        session.execute(
+            insert(Contact.__table__)
+            .values(chunk)
+            .on_conflict_do_nothing(index_elements=['normalized_email'])
+        )
+
+    ids = dict(session.execute(
+        select(Contact.normalized_email, Contact.id)
+        .where(Contact.normalized_email.in_(list(rows)))
+    ).all())
+    return {
+        address: ids[normalized]
+        for address, normalized in normalized_by_address.items()
+        if normalized in ids
+    }
+
+
+def _message_row(parsed_msg: Dict[str, Any], contact_ids: Dict[str, int], now: datetime) -> Dict[str, Any]:
+    body = parsed_msg.get('body')
+    body_loaded = parsed_msg.get('body_loaded', True)
+    if body_loaded:
+        body_hash = parsed_msg.get('body_hash') or EmailMessage.create_body_hash(body)
+    else:
+        # 先頭部分だけのハッシュは重複判定に使えないため、本文取得時に計算する
+        body_hash = None
+    return {
+        'message_id': parsed_msg['message_id'],
+        'from_address': parsed_msg.get('from'),
+        'to_address': parsed_msg.get('to'),
+        'from_contact_id': contact_ids.get(parsed_msg.get('from')),
+        'to_contact_id': contact_ids.get(parsed_msg.get('to')),
+        'subject': parsed_msg.get('subject'),
+        'body': body,
+        # 全文検索用のtsvectorはINSERTの中でPostgreSQLに計算させる
+        'body_tsv': EmailMessage.search_vector(parsed_msg.get('subject'), body,
+                                               parsed_msg.get('from'), parsed_msg.get('to')),
+        # CJKはtsvectorでは単語に分かれないため、bigramをNFKC正規化してから保存する
+        'search_ngrams': cjk_ngrams(parsed_msg.get('subject'), body, parsed_msg.get('from'), parsed_msg.get('to')),
+        'body_hash': body_hash,
+        'body_preview': parsed_msg.get('body_preview') or EmailMessage.create_body_preview(body),
+        'body_loaded': body_loaded,
+        'date': parsed_msg.get('date'),
+        'is_sent': parsed_msg.get('is_sent', False),
+        'folder': parsed_msg.get('folder', ''),
+        'imap_uid': parsed_msg.get('uid'),
+        'imap_account': parsed_msg.get('imap_account'),
+        'imap_folder': parsed_msg.get('imap_folder') or parsed_msg.get('folder'),
+        'flags': parsed_msg.get('flags'),
+        'gm_msgid': parsed_msg.get('gm_msgid'),
+        'gm_thrid': parsed_msg.get('gm_thrid'),
+        'last_sync': now,
+    }
+
+
+def write_messages(session, parsed_messages: List[Dict[str, Any]], update_existing: bool = False) -> Dict[str, int]:
+    """パース済みメッセージを複数行INSERTでまとめて保存する
+
+    連絡先ID・本文ハッシュ・プレビューと、サイドバーの連絡先集計も同じ処理で更新する。
+    message_idが既に存在する行は、update_existing=Falseなら無視し、
+    Trueなら件名・本文などを上書きし、IMAP上の位置が未記録なら埋める。
+
+    Returns:
+        dict: {'inserted': 新規件数, 'updated': 更新件数, 'skipped': 無視した件数}
+    """
+    # 同じバッチ内の重複は先に来たものを採用する
+    unique: Dict[str, Dict[str, Any]] = {}
+    for parsed_msg in parsed_messages:
+        if parsed_msg and parsed_msg.get('message_id'):
+            unique.setdefault(parsed_msg['message_id'], parsed_msg)
+    stats = {'inserted': 0, 'updated': 0, 'skipped': len(parsed_messages) - len(unique)}
+    if not unique:
+        return stats
+
+    contact_ids = upsert_contacts(
+        session,
+        [m.get('from') for m in unique.values()] + [m.get('to') for m in unique.values()]
+    )
+
+    now = datetime.utcnow()
+    rows = [_message_row(parsed_msg, contact_ids, now) for parsed_msg in unique.values()]
+    inserted_ids: Dict[str, int] = {}
+    table = EmailMessage.__table__
+
+    for chunk in _chunks(rows):
+        stmt = insert(table).values(chunk)
+        if update_existing:
+            # xmax = 0 の行はこのINSERTで新規作成された行
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['message_id'],
+                set_=dict(
+                    {column: stmt.excluded[column] for column in UPDATE_COLUMNS},
+                    **{column: func.coalesce(table.c[column], stmt.excluded[column]) for column in LOCATION_COLUMNS}
+                )
+            ).returning(table.c.id, table.c.message_id, literal_column('(xmax = 0)'))
+            for message_pk, message_id, created in session.execute(stmt):
+                if created:
+                    inserted_ids[message_id] = message_pk
+                else:
+                    stats['updated'] += 1
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=['message_id'])\
+                .returning(table.c.id, table.c.message_id)
+            inserted_ids.update({message_id: message_pk for message_pk, message_id in session.execute(stmt)})
+
+    stats['inserted'] = len(inserted_ids)
+    if not update_existing:
+        stats['skipped'] += len(rows) - len(inserted_ids)
+
+    # サイドバーの連絡先集計は新規メッセージの分だけ足し込む
+    ContactStats.apply(session, ContactStats.summarize(
+        (row['from_address'], row['to_address'], row['is_sent'], row['date'], row['subject'])
+        for row in rows
+        if row['message_id'] in inserted_ids
+    ))
+
+    # 添付ファイルのメタデータは新規メッセージの分だけ追加する
+    attachment_rows = [
+        dict(attachment, email_message_id=inserted_ids[message_id])
+        for message_id, parsed_msg in unique.items()
+        if message_id in inserted_ids
+        for attachment in parsed_msg.get('attachments') or []
+    ]
+    for chunk in _chunks(attachment_rows):
+        session.execute(insert(EmailAttachment.__table__).values(chunk))
+
+    app_logger.debug(f"一括保存: {stats}")
+    return stats
@@ -0,0 +1,244 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from email_handler import EmailHandler, ConnectionState, MAX_CONNECTION_AGE
+
+app_logger = logging.getLogger('mailchat')
+
+# 定数の定義
+POOL_MAX_CONNECTIONS_PER_ACCOUNT = 3
+POOL_ACQUIRE_TIMEOUT = 30  # 接続が空くまでの最大待機時間（秒）
+POOL_REQUEST_ACQUIRE_TIMEOUT = 5  # リクエスト処理中に接続が空くのを待つ最大時間（秒）
+
+# サーバーごとの同時接続数の上限（Gmailは同時接続15までに制限している）
+MAX_CONNECTIONS_PER_SERVER = {
+    'imap.gmail.com': 15,
+}
+DEFAULT_MAX_CONNECTIONS_PER_SERVER = 10
+
+PoolKey = Tuple[str, str]
+
+
+class PoolTimeoutError(TimeoutError):
+    """接続プールの空きを待つ間にタイムアウトした（IMAP通信のタイムアウトとは区別する）"""
+
+
+def _pool_key(email_address: str, imap_server: str) -> PoolKey:
+    """プールのキー。ホスト名は大文字小文字を区別しないので小文字にそろえる"""
+    return email_address, imap_server.strip().lower()
+
+
+class IMAPConnectionPool:
+    """(アカウント, サーバー)ごとに認証済みのEmailHandlerを使い回す接続プール"""
+
+    def __init__(self, max_per_account: int = POOL_MAX_CONNECTIONS_PER_ACCOUNT,
+                 max_age: float = MAX_CONNECTION_AGE,
+                 acquire_timeout: float = POOL_ACQUIRE_TIMEOUT,
+                 server_limits: Optional[Dict[str, int]] = None,
+                 default_server_limit: int = DEFAULT_MAX_CONNECTIONS_PER_SERVER):
+        self.max_per_account = max_per_account
+        self.server_limits = dict(MAX_CONNECTIONS_PER_SERVER if server_limits is None else server_limits)
+        self.default_server_limit = default_server_limit
+        self.max_age = max_age
+        self.acquire_timeout = acquire_timeout
+        self._condition = threading.Condition()
+        self._idle: Dict[PoolKey, List[EmailHandler]] = {}
+        self._in_use: Dict[PoolKey, int] = {}
+        self._metrics = {
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'recycled': 0,
+            'health_check_failures': 0,
+        }
+
+    def configure(self, server_limits: Optional[Dict[str, int]] = None,
+                  default_server_limit: Optional[int] = None) -> None:
+        """サーバーごとの同時接続数の上限を変更する（指定したサーバーだけ上書き）"""
+        with self._condition:
+            if server_limits:
+                self.server_limits.update({server.lower(): limit for server, limit in server_limits.items()})
+            if default_server_limit is not None:
+                self.default_server_limit = default_server_limit
+            self._condition.notify_all()
+
+    def _is_healthy(self, handler: EmailHandler) -> bool:
+        """接続年齢とNOOPで再利用できるかを確認する"""
+        if not handler.connection or handler.current_state == ConnectionState.ERROR:
+            return False
+        if time.time() - handler.last_reconnect_time > self.max_age:
+            with self._condition:
+                self._metrics['recycled'] += 1
+            return False
+        try:
+            status, _ = handler.connection.noop()
+        except Exception as e:
+            app_logger.debug(f"Pooled connection health check failed: {str(e)}")
+            status = None
+        if status != 'OK':
+            with self._condition:
+                self._metrics['health_check_failures'] += 1
+            return False
+        return True
+
+    def _total(self, key: PoolKey) -> int:
+        return self._in_use.get(key, 0) + len(self._idle.get(key, []))
+
+    def server_limit(self, imap_server: str) -> int:
+        """サーバーに対して同時に張れる接続数の上限"""
+        return self.server_limits.get(imap_server.lower(), self.default_server_limit)
+
+    def _server_total(self, imap_server: str) -> int:
+        """サーバーへの接続数（imap_server は _pool_key で正規化済みのホスト名）"""
+        keys = set(self._in_use) | set(self._idle)
+        return sum(self._total(key) for key in keys if key[1] == imap_server)
+
+    def acquire(self, email_address: str, password: str, imap_server: str,
+                timeout: Optional[float] = None, imap_port: Optional[int] = None,
+                use_ssl: bool = True) -> EmailHandler:
+        """認証済みの接続を取得する。上限に達している場合は空くまで待つ
+
+        imap_port/use_ssl は新しく接続を作る場合にだけ使う。
+        """
+        key = _pool_key(email_address, imap_server)
+        imap_server = key[1]
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        waited = False
+
+        while True:
+            candidate = None
+            create = False
+            with self._condition:
+                idle = self._idle.get(key, [])
+                # パスワードが変わった接続は使わない
+                for stale in [h for h in idle if h.password != password]:
+                    idle.remove(stale)
+                    stale.disconnect()
+
+                if idle:
+                    candidate = idle.pop()
+                elif self._total(key) < self.max_per_account \
+                        and self._server_total(imap_server) >= self.server_limit(imap_server) \
+                        and self._evict_idle(imap_server, exclude=key):
+                    # サーバー上限に達していても他アカウントの待機接続を閉じれば空きができる
+                    continue
+                elif self._total(key) < self.max_per_account \
+                        and self._server_total(imap_server) < self.server_limit(imap_server):
+                    create = True
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._metrics['timeouts'] += 1
+                        raise PoolTimeoutError(f"IMAP接続プールの待機がタイムアウトしました: {email_address}")
+                    if not waited:
+                        self._metrics['waits'] += 1
+                        waited = True
+                    start = time.time()
+                    self._condition.wait(remaining)
+                    self._metrics['wait_time'] += time.time() - start
+                    continue
+                self._in_use[key] = self._in_use.get(key, 0) + 1
+
+            if candidate is not None:
+                if self._is_healthy(candidate):
+                    with self._condition:
+                        self._metrics['hits'] += 1
+                    return candidate
+                candidate.disconnect()
+                self._discard_slot(key)
+                continue
+
+            if create:
+                with self._condition:
+                    self._metrics['misses'] += 1
+                handler = EmailHandler(email_address, password, imap_server, imap_port=imap_port, use_ssl=use_ssl)
+                try:
+                    if not handler.connect():
+                        raise ConnectionError(handler.last_error or "IMAPサーバーへの接続に失敗しました")
+                except Exception:
+                    handler.disconnect()
+                    self._discard_slot(key)
+                    raise
+                return handler
+
+    def _evict_idle(self, imap_server: str, exclude: PoolKey) -> bool:
+        """同じサーバーの他アカウントの待機接続を1つ閉じる（ロック取得済みで呼ぶ）"""
+        for key, handlers in self._idle.items():
+            if key != exclude and key[1] == imap_server and handlers:
+                handlers.pop(0).disconnect()
+                self._metrics['recycled'] += 1
+                return True
+        return False
+
+    def _discard_slot(self, key: PoolKey) -> None:
+        with self._condition:
+            self._in_use[key] = max(self._in_use.get(key, 0) - 1, 0)
+            self._condition.notify_all()
+
+    def release(self, handler: EmailHandler, discard: bool = False) -> None:
+        """接続をプールに返却する。壊れている接続は破棄する"""
+        key = _pool_key(handler.email_address, handler.imap_server)
+        reusable = not discard and handler.connection is not None \
+            and handler.current_state != ConnectionState.ERROR
+        if not reusable:
+            handler.disconnect()
+        with self._condition:
+            self._in_use[key] = max(self._in_use.get(key, 0) - 1, 0)
+            if reusable:
+                self._idle.setdefault(key, []).append(handler)
+            self._condition.notify_all()
+
+    @contextmanager
+    def connection(self, email_address: str, password: str, imap_server: str,
+                   timeout: Optional[float] = None, imap_port: Optional[int] = None, use_ssl: bool = True):
+        """with文で接続を借りる。例外時は接続を破棄する"""
+        handler = self.acquire(email_address, password, imap_server, timeout=timeout,
+                               imap_port=imap_port, use_ssl=use_ssl)
+        try:
+            yield handler
+        except Exception:
+            self.release(handler, discard=True)
+            raise
+        else:
+            self.release(handler)
+
+    def get_metrics(self) -> Dict[str, object]:
+        """プールのヒット/ミス/待機などの統計を返す"""
+        with self._condition:
+            metrics = dict(self._metrics)
+            requests = metrics['hits'] + metrics['misses']
+            metrics['hit_rate'] = metrics['hits'] / requests if requests else 0.0
+            metrics['in_use'] = sum(self._in_use.values())
+            metrics['idle'] = sum(len(handlers) for handlers in self._idle.values())
+            return metrics
+
+    def close_all(self) -> None:
+        """待機中の接続をすべて切断する"""
+        with self._condition:
+            handlers = [h for idle in self._idle.values() for h in idle]
+            self._idle.clear()
+        for handler in handlers:
+            handler.disconnect()
+
+
+def parse_server_limits(value: Optional[str]) -> Dict[str, int]:
+    """'imap.gmail.com=15,outlook.office365.com=8' 形式の設定を辞書にする"""
+    limits: Dict[str, int] = {}
+    for entry in (value or '').split(','):
+        server, sep, limit = entry.strip().partition('=')
+        if not sep:
+            continue
+        try:
+            limits[server.strip().lower()] = int(limit)
+        except ValueError:
+            app_logger.warning(f"接続数の上限設定を無視しました: {entry}")
+    return limits
+
+
+connection_pool = IMAPConnectionPool()
@@ -0,0 +1,68 @@
+"""
+IMAPから集めた連絡先（FROM/TO）のアカウント別キャッシュ
+
+フォルダーごとに取り込み済みの最大UIDを覚えておき、次回はそれより
+新しいUIDのヘッダーだけを取得する。UIDVALIDITYかSINCEの期間が
+変わった場合は作り直す。
+"""
+import threading
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# IMAPの日付はロケールに依存しない英語の月名で書く（例: 1-Dec-2023）
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def imap_date(value: date) -> str:
+    """SEARCH SINCE 用の日付文字列"""
+    return f'{value.day}-{_MONTHS[value.month - 1]}-{value.year}'
+
+
+class ContactCache:
+    """1アカウント・1フォルダー分の連絡先と、取り込み済みの最大UID"""
+
+    def __init__(self, uidvalidity: Optional[int], since: date):
+        self.uidvalidity = uidvalidity
+        self.since = since
+        self.last_uid = 0
+        self.addresses: Dict[str, int] = {}  # アドレス → 最後に見たUID
+        self.lock = threading.Lock()
+
+    def matches(self, uidvalidity: Optional[int], since: date) -> bool:
+        return self.uidvalidity == uidvalidity and self.since == since
+
+    def add(self, uid: int, addresses: Iterable[str]) -> None:
+        for address in addresses:
+            if address and uid > self.addresses.get(address, 0):
+                self.addresses[address] = uid
+        self.last_uid = max(self.last_uid, uid)
+
+    def top(self, limit: int, search_query: Optional[str] = None) -> List[str]:
+        """最近やり取りした順にlimit件選び、名前順で返す"""
+        query = (search_query or '').lower()
+        matched = [(uid, address) for address, uid in self.addresses.items()
+                   if not query or query in address.lower()]
+        matched.sort(reverse=True)
+        return sorted(address for _, address in matched[:limit])
+
+
+_caches: Dict[Tuple[str, str, str], ContactCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_contact_cache(email_address: str, imap_server: str, folder: str,
+                      uidvalidity: Optional[int], since: date) -> ContactCache:
+    """アカウント・フォルダーのキャッシュを返す（前提が変わっていれば作り直す）"""
+    key = (email_address, imap_server, folder)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None or not cache.matches(uidvalidity, since):
+            cache = _caches[key] = ContactCache(uidvalidity, since)
+        return cache
+
+
+def clear_contact_cache(email_address: Optional[str] = None) -> None:
+    """キャッシュを破棄する（email_addressを省略すると全アカウント）"""
+    with _caches_lock:
+        for key in [key for key in _caches if email_address in (None, key[0])]:
+            del _caches[key]
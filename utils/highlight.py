@@ -0,0 +1,199 @@
+"""
+検索語のハイライトとスニペット生成
+
+検索語をNFKC正規化・casefoldしてAho-Corasickのオートマトンにまとめ、
+本文を1回走査するだけで全検索語の出現位置を求める。走査は正規化後の文字列で
+行い、各文字が元の文字列のどこから来たかを保持して元の位置に戻す
+（半角カナや全角英数字があっても、ハイライトは元の本文のまま付く）。
+"""
+import unicodedata
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from markupsafe import Markup, escape
+
+from utils.text_search import normalize_query
+
+SNIPPET_RADIUS = 60  # スニペットで一致箇所の前後に残す文字数
+SNIPPET_FRAGMENTS = 3  # スニペットに含める断片の最大数
+SNIPPET_ELLIPSIS = '…'
+SNIPPET_SOURCE_LENGTH = 1000  # 検索結果の一覧でスニペット用にDBから読む本文の最大文字数
+
+# 直前の文字と合わせてNFKC正規化する文字（結合文字と、半角・全角の濁点・半濁点）
+_VOICED_MARKS = frozenset('゙゚ﾞﾟ')
+
+Span = Tuple[int, int]
+
+
+def _fold(text: str) -> str:
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def _folded_chars(text: str) -> Iterator[Tuple[str, int, int]]:
+    """正規化後の1文字ずつを (文字, 元の開始位置, 元の終了位置) で返す
+
+    結合文字は直前の文字とまとめて正規化するため、元の位置はそのまとまりの範囲になる。
+    """
+    if text.isascii():
+        for position, char in enumerate(text.lower()):
+            yield char, position, position + 1
+        return
+
+    start = 0
+    length = len(text)
+    while start < length:
+        end = start + 1
+        while end < length and (unicodedata.combining(text[end]) or text[end] in _VOICED_MARKS):
+            end += 1
+        for char in _fold(text[start:end]):
+            yield char, start, end
+        start = end
+
+
+def highlight_terms(search_query: Optional[str]) -> List[str]:
+    """検索欄の文字列からハイライトする語を取り出す（"フレーズ" はまとめ、-除外語とorは除く）"""
+    query = normalize_query(search_query)
+    terms = []
+    for index, part in enumerate(query.split('"')):
+        if index % 2:
+            # 引用符の内側はフレーズとして1語にする
+            if part.strip():
+                terms.append(part.strip())
+            continue
+        terms.extend(word for word in part.split() if not word.startswith('-') and word.lower() != 'or')
+    return terms
+
+
+class TermMatcher:
+    """複数の検索語を1回の走査で探すAho-Corasickのオートマトン"""
+
+    def __init__(self, terms: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # そのノードで終わる最長の検索語の長さ（失敗リンク先の分を含む）
+        self._longest: List[int] = [0]
+        for term in {_fold(term) for term in terms if term and term.strip()}:
+            self._add(term)
+        self.max_length = max(self._longest)
+        self._link()
+
+    def __bool__(self) -> bool:
+        return self.max_length > 0
+
+    def _add(self, term: str) -> None:
+        node = 0
+        for char in term:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._longest.append(0)
+            node = next_node
+        self._longest[node] = max(self._longest[node], len(term))
+
+    def _link(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._longest[child] = max(self._longest[child], self._longest[self._fail[child]])
+                queue.append(child)
+
+    def spans(self, text: str) -> Iterator[Span]:
+        """一致箇所を元の文字列の (開始, 終了) で先頭から順に返す
+
+        重なる・隣接する一致は1つにまとめる。これ以上広がらないと確定した
+        範囲から順に返すので、必要な数だけ読んで走査を打ち切れる。
+        """
+        if not self or not text:
+            return
+        node = 0
+        window: deque = deque(maxlen=self.max_length)  # 直近の正規化後の文字の元の開始位置
+        pending: List[List[int]] = []
+        for index, (char, start, end) in enumerate(_folded_chars(text)):
+            window.append(start)
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+
+            length = self._longest[node]
+            if length:
+                match_start, match_end = window[-length], end
+                while pending and pending[-1][1] >= match_start:
+                    previous_start, previous_end = pending.pop()
+                    match_start = min(match_start, previous_start)
+                    match_end = max(match_end, previous_end)
+                pending.append([match_start, match_end])
+
+            # これから見つかる一致は window の先頭より前からは始まらない
+            while pending and len(window) == self.max_length and pending[0][1] < window[0]:
+                yield tuple(pending.pop(0))
+        for span in pending:
+            yield tuple(span)
+
+
+def _render(text: str, start: int, end: int, spans: Iterable[Span]) -> Markup:
+    """text[start:end] をエスケープし、spansの範囲を<mark>で囲む"""
+    parts = []
+    position = start
+    for span_start, span_end in spans:
+        span_start, span_end = max(span_start, start), min(span_end, end)
+        if span_start >= span_end:
+            continue
+        parts.append(escape(text[position:span_start]))
+        parts.append(Markup('<mark class="search-highlight">%s</mark>') % text[span_start:span_end])
+        position = span_end
+    parts.append(escape(text[position:end]))
+    return Markup('').join(parts)
+
+
+def highlight(text: Optional[str], search_query: Optional[str]) -> Markup:
+    """検索語をすべて<mark>で囲んだHTMLを返す（本文はエスケープする）"""
+    text = str(text or '')
+    matcher = TermMatcher(highlight_terms(search_query))
+    return _render(text, 0, len(text), matcher.spans(text))
+
+
+def snippet(text: Optional[str], search_query: Optional[str], radius: int = SNIPPET_RADIUS,
+            fragments: int = SNIPPET_FRAGMENTS, head_truncated: bool = False,
+            tail_truncated: bool = False) -> Markup:
+    """一致箇所の前後radius文字だけを切り出し、ハイライトしたHTMLを返す
+
+    断片がfragments個そろった時点で本文の走査をやめる。
+    一致がなければ本文の先頭を返す。textが本文の一部を切り出したもの
+    （EmailMessage.snippet_options）の場合は、切れている側を head_truncated / tail_truncated で渡す。
+    """
+    text = str(text or '')
+    windows: List[List] = []  # [開始, 終了, その範囲の一致箇所]
+    for span_start, span_end in TermMatcher(highlight_terms(search_query)).spans(text):
+        window_start, window_end = max(0, span_start - radius), min(len(text), span_end + radius)
+        if windows and window_start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], window_end)
+            windows[-1][2].append((span_start, span_end))
+            continue
+        if len(windows) == fragments:
+            break
+        windows.append([window_start, window_end, [(span_start, span_end)]])
+
+    if not windows:
+        head = text[:radius * 2]
+        return (SNIPPET_ELLIPSIS if head_truncated else '') + escape(head) \
+            + (SNIPPET_ELLIPSIS if tail_truncated or len(text) > len(head) else '')
+
+    parts = []
+    for window_start, window_end, spans in windows:
+        fragment = _render(text, window_start, window_end, spans)
+        if window_start > 0 or head_truncated:
+            fragment = SNIPPET_ELLIPSIS + fragment
+        parts.append(fragment)
+    result = Markup(' ').join(parts)
+    if windows[-1][1] < len(text) or tail_truncated:
+        result += SNIPPET_ELLIPSIS
+    return result
@@ -0,0 +1,251 @@
+import imaplib
+import logging
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+app_logger = logging.getLogger('mailchat')
+
+# FETCH応答の1レコードの先頭 ("12 (UID 34 ...")
+_RECORD_START = re.compile(rb'^(\d+) \(')
+# 行末のリテラル指定 ("{1234}")
+_LITERAL_MARKER = re.compile(rb'\{(\d+)\}$')
+# BODY[HEADER.FIELDS (FROM)]<0.100> のようなセクション付きアトムも1トークンとして扱う
+_TOKEN = re.compile(
+    rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    rb'|(?P<atom>[^\s()"\[\]]+(?:\[[^\]]*\](?:<[\d.]+>)?)?))'
+)
+
+FetchChunk = Union[bytes, Tuple[bytes, bytes]]
+
+# 送信済みとして同期するフォルダー名（スレッド版・非同期版で同じ規則で探す）
+SENT_FOLDER_NAMES = ('[Gmail]/送信済みメール', '[Gmail]/Sent Mail')
+
+
+def compress_uid_set(uids: Iterable[int]) -> str:
+    """UIDのリストを "1:5,8,10:12" 形式のシーケンスセットに圧縮する"""
+    ordered = sorted(set(int(uid) for uid in uids))
+    if not ordered:
+        return ''
+
+    ranges = []
+    start = prev = ordered[0]
+    for uid in ordered[1:]:
+        if uid == prev + 1:
+            prev = uid
+            continue
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = uid
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ','.join(ranges)
+
+
+def find_sent_folder(folder_names: Iterable[str]) -> Optional[str]:
+    """LISTで得たフォルダー名から送信済みフォルダーを探す"""
+    for folder_name in folder_names:
+        if any(sent in folder_name for sent in SENT_FOLDER_NAMES):
+            return folder_name.strip('"')
+    return None
+
+
+def _tokenize(text: bytes, tokens: List[Tuple[str, Any]]) -> None:
+    pos = 0
+    length = len(text)
+    while pos < length:
+        if text[pos:pos + 1].isspace():
+            pos += 1
+            continue
+        match = _TOKEN.match(text, pos)
+        if not match or match.end() == pos:
+            raise ValueError(f"FETCH応答を解析できません: {text[pos:pos + 40]!r}")
+        pos = match.end()
+        if match.group('open'):
+            tokens.append(('(', None))
+        elif match.group('close'):
+            tokens.append((')', None))
+        elif match.group('quoted') is not None:
+            value = re.sub(rb'\\(.)', rb'\1', match.group('quoted'))
+            tokens.append(('STR', value.decode('utf-8', errors='replace')))
+        else:
+            atom = match.group('atom').decode('ascii', errors='replace')
+            if atom.upper() == 'NIL':
+                tokens.append(('STR', None))
+            elif atom.isdigit():
+                tokens.append(('STR', int(atom)))
+            else:
+                tokens.append(('ATOM', atom))
+
+
+def _build(tokens: List[Tuple[str, Any]], index: int) -> Tuple[Any, int]:
+    kind, value = tokens[index]
+    if kind == '(':
+        items = []
+        index += 1
+        while tokens[index][0] != ')':
+            item, index = _build(tokens, index)
+            items.append(item)
+        return items, index + 1
+    if kind == ')':
+        raise ValueError("FETCH応答の括弧が一致しません")
+    return value, index + 1
+
+
+def parse_imap_list(chunks: Sequence[FetchChunk]) -> List[Any]:
+    """IMAPのS式（リテラルを含む）をPythonのリストに変換する"""
+    tokens: List[Tuple[str, Any]] = []
+    for chunk in chunks:
+        if isinstance(chunk, tuple):
+            text, literal = chunk
+            text = _LITERAL_MARKER.sub(b'', text.rstrip())
+            _tokenize(text, tokens)
+            tokens.append(('LIT', literal))
+        else:
+            _tokenize(chunk, tokens)
+
+    values = []
+    index = 0
+    while index < len(tokens):
+        value, index = _build(tokens, index)
+        values.append(value)
+    return values
+
+
+def _record_from_values(values: List[Any]) -> Dict[str, Any]:
+    if len(values) < 2 or not isinstance(values[1], list):
+        raise ValueError(f"不正なFETCHレコード: {values!r}")
+
+    record: Dict[str, Any] = {'SEQ': values[0]}
+    attributes = values[1]
+    for i in range(0, len(attributes) - 1, 2):
+        record[str(attributes[i]).upper()] = attributes[i + 1]
+    return record
+
+
+def parse_fetch_response(data: Sequence[FetchChunk]) -> Iterator[Dict[str, Any]]:
+    """imaplibのFETCH応答（bytesとタプルの混在リスト）をレコード単位で返す
+
+    各レコードは {'SEQ': 1, 'UID': 5, 'RFC822': b'...'} のような辞書で、
+    キーは大文字のFETCH項目名になる。
+    """
+    current: List[FetchChunk] = []
+    for chunk in data:
+        if chunk is None:
+            continue
+        head = chunk[0] if isinstance(chunk, tuple) else chunk
+        if _RECORD_START.match(head) and current:
+            yield _record_from_values(parse_imap_list(current))
+            current = []
+        current.append(chunk)
+    if current:
+        yield _record_from_values(parse_imap_list(current))
+
+
+def find_fetch_item(record: Dict[str, Any], prefix: str) -> Any:
+    """プレフィックスに一致するFETCH項目を返す（BODY[HEADER.FIELDS (...)] など）"""
+    prefix = prefix.upper()
+    for key, value in record.items():
+        if key.startswith(prefix):
+            return value
+    return None
+
+
+def _drain(connection: imaplib.IMAP4, tag: bytes) -> None:
+    """途中で読み捨てられたコマンドの残りの応答を消費する"""
+    try:
+        while connection.tagged_commands.get(tag) is None:
+            connection._get_response()
+        del connection.tagged_commands[tag]
+        connection.untagged_responses.pop('FETCH', None)
+    except Exception as e:
+        # 接続自体が壊れている場合は呼び出し側の再接続処理に任せる
+        app_logger.warning(f"FETCH応答の破棄に失敗しました: {str(e)}")
+
+
+def stream_uid_fetch(connection: imaplib.IMAP4, uids: Iterable[int], items: str) -> Iterator[Dict[str, Any]]:
+    """1回の UID FETCH でバッチ全体を取得し、届いた順にレコードを返す
+
+    imaplibの通常の fetch() は完了応答まで全データを溜め込むが、
+    ここでは応答を1件読むたびに解析済みのレコードを返す。
+    """
+    uid_set = compress_uid_set(uids)
+    if not uid_set:
+        return
+
+    tag = connection._command('UID', 'FETCH', uid_set, items)
+    completed = False
+    try:
+        while True:
+            pending = connection.untagged_responses.pop('FETCH', None)
+            if pending:
+                yield from parse_fetch_response(pending)
+
+            result = connection.tagged_commands.get(tag)
+            if result is not None:
+                del connection.tagged_commands[tag]
+                completed = True
+                status, data = result
+                if status != 'OK':
+                    raise connection.error(f"UID FETCH failed: {status} {data}")
+                return
+
+            connection._check_bye()
+            connection._get_response()
+    finally:
+        if not completed:
+            _drain(connection, tag)
+
+
+# IDLEはimaplibの公開APIにないため内部メソッドで送受信する（使えない版ではNOOPでポーリングする）
+_IDLE_INTERNALS = ('_command', '_get_response', '_get_line', '_command_complete')
+
+
+def supports_raw_idle(conn: imaplib.IMAP4) -> bool:
+    """IdleCommand が使う imaplib の内部APIがこの接続にあるか"""
+    return (all(callable(getattr(conn, name, None)) for name in _IDLE_INTERNALS)
+            and isinstance(getattr(conn, 'tagged_commands', None), dict))
+
+
+class IdleCommand:
+    """imaplibの内部APIでIDLEコマンドを開始・終了する
+
+    内部APIの使用はこのクラスに閉じ込める。途中で接続が切れた場合（imaplib.IMAP4.abort やソケットのエラー）は
+    ConnectionError にして、呼び出し元が接続を捨てて再接続できるようにする。
+    """
+
+    def __init__(self, conn: imaplib.IMAP4):
+        self.conn = conn
+        self.tag = None
+
+    def start(self) -> None:
+        """IDLEを送り、継続応答（+ idling）を待つ"""
+        try:
+            self.tag = self.conn._command('IDLE')
+            while self.conn._get_response() is not None:
+                if self.conn.tagged_commands.get(self.tag):
+                    typ, data = self.conn.tagged_commands.pop(self.tag)
+                    self.tag = None
+                    raise self.conn.error(f"IDLE failed: {typ} {data}")
+        except (imaplib.IMAP4.abort, OSError) as e:
+            self.tag = None
+            raise ConnectionError(f"IDLEの開始中に接続が切れました: {e}") from e
+
+    def read_line(self) -> bytes:
+        """IDLE中に届いた応答を1行読む"""
+        try:
+            return self.conn._get_line()
+        except (imaplib.IMAP4.abort, OSError) as e:
+            # 切断済みの接続にはDONEを送らない
+            self.tag = None
+            raise ConnectionError(f"IDLE中に接続が切れました: {e}") from e
+
+    def done(self) -> None:
+        """DONEを送ってIDLEの完了応答を待つ（開始していなければ何もしない）"""
+        if self.tag is None:
+            return
+        tag, self.tag = self.tag, None
+        try:
+            self.conn.send(b'DONE\r\n')
+            typ, data = self.conn._command_complete('IDLE', tag)
+        except (imaplib.IMAP4.abort, OSError) as e:
+            raise ConnectionError(f"IDLEの終了中に接続が切れました: {e}") from e
+        if typ != 'OK':
+            app_logger.warning(f"IDLE終了時の応答が不正です: {typ} {data}")
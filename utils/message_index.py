@@ -0,0 +1,63 @@
+import logging
+import threading
+from typing import Callable, Iterable, Optional, Set
+
+app_logger = logging.getLogger('mailchat')
+
+
+class ExistingMessageIndex:
+    """「このMessage-IDは保存済みか」をバッチ単位で判定する
+
+    保存済みかどうかはバッチごとにDBへ問い合わせ、今回の同期で取得すると
+    決めたIDだけをメモリに持つ。メモリと問い合わせのコストは新着の件数に
+    比例し、テーブル全体の件数には依存しない。複数スレッドから呼び出せる。
+    """
+
+    def __init__(self, lookup: Callable[[Iterable[str]], Set[str]]):
+        """
+        Args:
+            lookup: Message-IDのリストを受け取り、保存済みのIDの集合を返す関数
+        """
+        self._lookup = lookup
+        self._claimed: Set[str] = set()
+        self._lock = threading.Lock()
+        self.lookups = 0
+
+    @classmethod
+    def from_session(cls, session, gmail: bool = False) -> 'ExistingMessageIndex':
+        """セッションのエンジンを使う索引を作る（スレッドごとに別の接続で問い合わせる）
+
+        gmail=True の場合はMessage-IDではなくX-GM-MSGID（文字列）で判定する。
+        """
+        from models import EmailMessage
+
+        engine = session.get_bind()
+        existing = EmailMessage.existing_gm_msgids if gmail else EmailMessage.existing_message_ids
+
+        def lookup(message_ids):
+            with engine.connect() as connection:
+                return existing(connection, message_ids)
+
+        return cls(lookup)
+
+    def claim_new(self, message_ids: Iterable[Optional[str]]) -> Set[str]:
+        """未保存かつ今回まだ誰も取得していないIDを返し、取得済みとして記録する"""
+        candidates = {message_id for message_id in message_ids if message_id}
+        with self._lock:
+            candidates -= self._claimed
+        if not candidates:
+            return set()
+
+        existing = self._lookup(list(candidates))
+        self.lookups += 1
+
+        with self._lock:
+            # 問い合わせ中に他のフォルダーが取得したIDは除く
+            new_ids = candidates - existing - self._claimed
+            self._claimed.update(new_ids)
+        return new_ids
+
+    def release(self, message_ids: Iterable[Optional[str]]) -> None:
+        """取得できなかったIDの記録を取り消す（取り直しで再び新規として扱う）"""
+        with self._lock:
+            self._claimed.difference_update(message_id for message_id in message_ids if message_id)
@@ -0,0 +1,156 @@
+"""
+キーセット（シーク）方式のページネーション
+
+OFFSETは読み飛ばす行数に比例して遅くなるため、前ページ最後の行の
+ソートキー（メッセージなら (日付, ID)）をカーソルとして渡し、インデックスの続きから読む。
+件数はページごとに数えず、必要な場合だけ正確に数えるか、実行計画の見積もりを使う。
+"""
+import base64
+import json
+import logging
+from datetime import datetime
+from typing import Any, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Float, and_, cast, false, or_
+
+app_logger = logging.getLogger('mailchat')
+
+Cursor = Tuple[Optional[datetime], int]
+MESSAGE_CURSOR_TYPES = (datetime, int)
+RANKED_CURSOR_TYPES = (float, datetime, int)
+
+
+def encode_cursor(*values: Any) -> str:
+    """ソートキーの値をURLに載せられる文字列にする（日時はISO形式にする）"""
+    payload = json.dumps(
+        [{'dt': value.isoformat()} if isinstance(value, datetime) else value for value in values],
+        separators=(',', ':'), ensure_ascii=False
+    )
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def _decode_value(value: Any, expected: type) -> Any:
+    if value is None:
+        return None
+    if expected is datetime:
+        return datetime.fromisoformat(value['dt'])
+    if expected is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, expected) or isinstance(value, bool):
+        raise TypeError(f"unexpected cursor value: {value!r}")
+    return value
+
+
+def decode_cursor(value: Optional[str], types: Sequence[type] = MESSAGE_CURSOR_TYPES) -> Optional[tuple]:
+    """encode_cursorの逆。typesと数・型が合わない値はNone（先頭ページ）として扱う"""
+    if not value:
+        return None
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != len(types):
+            return None
+        return tuple(_decode_value(item, expected) for item, expected in zip(values, types))
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def sort_order(columns: Sequence[Any], descending: bool = False, nulls_last: Optional[bool] = None) -> List[Any]:
+    """after_keyと対になる並び順
+
+    nulls_lastがNoneならPostgreSQLの既定（昇順はNULLが最後、降順は最初）に任せ、
+    (列...) の複合インデックスをそのまま前後どちらからでも辿れるようにする。
+    """
+    order = []
+    for column in columns:
+        clause = column.desc() if descending else column.asc()
+        if nulls_last is not None:
+            clause = clause.nullslast() if nulls_last else clause.nullsfirst()
+        order.append(clause)
+    return order
+
+
+def after_key(columns: Sequence[Any], values: Optional[Sequence[Any]], descending: bool = False,
+              nulls_last: Optional[bool] = None):
+    """sort_orderの並びで、ソートキーが values の行より後ろにある行の条件を返す"""
+    if values is None:
+        return None
+    if nulls_last is None:
+        nulls_last = not descending
+    conditions = []
+    same = []
+    for column, value in zip(columns, values):
+        if value is None:
+            # NULLより後ろにあるのは、NULLが先頭に並ぶ場合のNULLでない行だけ
+            beyond = None if nulls_last else column.isnot(None)
+            equal = column.is_(None)
+        else:
+            beyond = column < value if descending else column > value
+            if nulls_last:
+                beyond = or_(beyond, column.is_(None))
+            equal = column == value
+        if beyond is not None:
+            conditions.append(and_(*same, beyond))
+        same.append(equal)
+    return or_(*conditions) if conditions else false()
+
+
+def newest_first(date_column, id_column) -> List[Any]:
+    """メッセージの並び順（日付の新しい順、日付なしは最後）"""
+    return [date_column.desc().nullslast(), id_column.desc()]
+
+
+def before_cursor(date_column, id_column, cursor: Optional[Cursor]):
+    """newest_firstの並びでカーソルより後ろにある行の条件を返す"""
+    return after_key([date_column, id_column], cursor, descending=True, nulls_last=True)
+
+
+def page_of(rows: Sequence[Any], limit: int, key=lambda row: (row.date, row.id)) -> Tuple[List[Any], Optional[str]]:
+    """limit+1件取得した結果をページと次のカーソルに分ける"""
+    page = list(rows[:limit])
+    if len(rows) <= limit or not page:
+        return page, None
+    return page, encode_cursor(*key(page[-1]))
+
+
+def ranked_page(query, rank, date_column, id_column, cursor: Optional[str] = None,
+                limit: int = 20) -> Tuple[List[Any], Optional[str]]:
+    """(rank, 日付, ID) の降順で1ページ分を読む（検索の関連度順）
+
+    ts_rankはreal（float4）を返すが、カーソルから戻した値はfloat8として比較されるため
+    （0.1::real = 0.1 は偽）、rankは選択・比較とも倍精度にそろえる。
+    そうしないと同じrankの行がページ境界で一致せず、読み飛ばしや重複が起きる。
+    """
+    rank = cast(rank, Float(precision=53))
+    columns = [rank, date_column, id_column]
+    keyset = after_key(columns, decode_cursor(cursor, RANKED_CURSOR_TYPES), descending=True, nulls_last=True)
+    if keyset is not None:
+        query = query.filter(keyset)
+    rows = query.add_columns(rank.label('rank'))\
+        .order_by(*sort_order(columns, descending=True, nulls_last=True))\
+        .limit(limit + 1)\
+        .all()
+    page, next_cursor = page_of(
+        rows, limit, key=lambda row: (row.rank, getattr(row[0], date_column.key), getattr(row[0], id_column.key))
+    )
+    return [row[0] for row in page], next_cursor
+
+
+def estimate_count(session, query) -> Optional[int]:
+    """クエリの件数をPostgreSQLの実行計画の見積もりで返す（取得できなければNone）
+
+    count()のように該当行を全部読まないため、ページごとの件数表示に使う。
+    """
+    try:
+        compiled = query.statement.compile(dialect=session.get_bind().dialect)
+        # 失敗してもトランザクション全体を中断させないようセーブポイント内で実行する
+        with session.begin_nested():
+            plan = session.connection()\
+                .exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled.string}", compiled.params)\
+                .scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    except Exception as e:
+        app_logger.warning(f"件数の見積もりに失敗しました: {str(e)}")
+        return None
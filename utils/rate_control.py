@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+app_logger = logging.getLogger('mailchat')
+
+# 定数の定義
+DEFAULT_COMMAND_RATE = 10.0  # サーバーごとのIMAPコマンド数/秒の初期値
+MAX_COMMAND_RATE = 50.0
+MIN_COMMAND_RATE = 0.05  # 連続して失敗した場合は約20秒に1回まで落とす
+RATE_INCREASE = 1.0  # 成功ごとに増やすコマンド数/秒（加算増加）
+RATE_DECREASE = 0.5  # 失敗時に掛ける係数（乗算減少）
+BUCKET_CAPACITY = 5  # 連続して発行できるコマンド数
+
+# タイムアウト以外でサーバーが負荷を理由に拒否したことを示す応答
+THROTTLE_MARKERS = (
+    'throttl', 'too many', 'try again later', 'rate limit', '[limit]',
+    '[overquota]', '[unavailable]', 'server busy', 'bandwidth',
+)
+TIMEOUT_MARKERS = ('timed out', 'timeout', 'read operation timed out')
+
+
+def classify_error(error: Exception) -> Optional[str]:
+    """エラーを 'timeout' / 'throttle' / None に分類する"""
+    text = str(error).lower()
+    if any(marker in text for marker in THROTTLE_MARKERS):
+        return 'throttle'
+    if isinstance(error, TimeoutError) or any(marker in text for marker in TIMEOUT_MARKERS):
+        return 'timeout'
+    return None
+
+
+class AIMDBatchController:
+    """応答時間に応じてFETCHのバッチサイズを加算増加・乗算減少させる
+
+    目標時間内にバッチが返ってくる間は少しずつ大きくし、タイムアウトや
+    スロットリング、目標を大きく超える応答があれば半分にする。
+    """
+
+    def __init__(self, initial: int, min_size: int, max_size: int,
+                 target_latency: float = 5.0, increase: int = 10, decrease: float = 0.5):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self._size = float(max(min_size, min(initial, max_size)))
+        self._lock = threading.Lock()
+        self.last_latency: Optional[float] = None
+        self.successes = 0
+        self.failures = 0
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return int(self._size)
+
+    def record_success(self, elapsed: float) -> None:
+        """バッチが成功した場合に所要時間を記録する"""
+        with self._lock:
+            self.last_latency = elapsed
+            self.successes += 1
+            if elapsed > self.target_latency * 2:
+                # 遅すぎる応答は輻輳とみなす
+                self._size = max(self.min_size, self._size * self.decrease)
+            elif elapsed <= self.target_latency:
+                self._size = min(self.max_size, self._size + self.increase)
+
+    def record_failure(self, kind: Optional[str] = None) -> None:
+        """タイムアウト・スロットリングなどで失敗した場合に縮小する"""
+        with self._lock:
+            self.failures += 1
+            self._size = max(self.min_size, self._size * self.decrease)
+        app_logger.debug(f"バッチサイズを縮小しました ({kind}): {self.size}")
+
+    def get_stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                'batch_size': int(self._size),
+                'last_latency': round(self.last_latency, 3) if self.last_latency is not None else None,
+                'successes': self.successes,
+                'failures': self.failures,
+            }
+
+
+class TokenBucket:
+    """サーバーごとのIMAPコマンド発行レートを制御するトークンバケット
+
+    IMAPコマンド（UID FETCH）の発行ペースだけを制御する。コマンドが
+    タイムアウト・スロットリングで失敗するとレートを乗算で下げ、成功すると
+    加算で戻す。接続レベルの再試行の待機には使わない。
+    """
+
+    def __init__(self, rate: float = DEFAULT_COMMAND_RATE, capacity: float = BUCKET_CAPACITY,
+                 min_rate: float = MIN_COMMAND_RATE, max_rate: float = MAX_COMMAND_RATE):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0
+        self.throttled = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1.0, timeout: Optional[float] = None) -> bool:
+        """トークンが貯まるまで待ってから消費する。timeout内に取れなければFalse"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+            with self._lock:
+                self.waited += wait
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def on_failure(self) -> None:
+        """失敗時はレートを下げ、貯まっているトークンも捨てる（次のコマンドは待たされる）"""
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            self._tokens = min(self._tokens, 0.0)
+            self.throttled += 1
+
+    def get_stats(self) -> Dict[str, object]:
+        with self._lock:
+            self._refill()
+            return {
+                'rate': round(self.rate, 3),
+                'tokens': round(self._tokens, 3),
+                'waited': round(self.waited, 3),
+                'throttled': self.throttled,
+            }
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_server_bucket(imap_server: str) -> TokenBucket:
+    """サーバーごとに共有されるトークンバケットを返す"""
+    key = (imap_server or '').lower()
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket()
+        return bucket
+
+
+def get_all_stats() -> Dict[str, Dict[str, object]]:
+    """全サーバーのレート制御の状態を返す"""
+    with _buckets_lock:
+        buckets = dict(_buckets)
+    return {server: bucket.get_stats() for server, bucket in buckets.items()}
@@ -0,0 +1,293 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+app_logger = logging.getLogger('mailchat')
+
+# 定数の定義
+PARSE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))  # MIMEパース用のプロセス数
+PARSE_CHUNK_SIZE = 20  # 1回のプロセス間受け渡しでまとめる件数
+QUEUE_SIZE = 200  # ステージ間キューの上限（満杯になると上流のステージが待つ）
+WRITE_BATCH_SIZE = 100  # 1回の書き込みでまとめる件数
+POLL_INTERVAL = 0.1  # キュー待ちで停止要求を確認する間隔（秒）
+# IDLEやフォルダー同期のスレッド・SSL接続を持つプロセスからforkすると、
+# 他スレッドが保持していたロックを子が引き継いでデッドロックしうるため使わない
+PARSE_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# このキーを持つ項目（チェックポイントなど）はパースせず、順序を保ったまま書き込み側へ渡す
+CONTROL_KEY = 'control'
+# Message-IDのないGmailのメッセージに付けるID（X-GM-MSGIDはアカウント内で一意）
+GMAIL_MESSAGE_ID_FORMAT = '<{}@x-gm-msgid.invalid>'
+
+_DONE = object()
+
+# ワーカープロセスごとのパーサー（EmailHandlerは接続せずパース処理だけに使う）
+_parsers: Dict[str, Any] = {}
+
+
+class PipelineAborted(Exception):
+    """下流のステージが失敗したためパイプラインが停止した"""
+
+
+def parse_raw_items(email_address: str, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ワーカープロセスで未パースのメッセージをまとめてパースする
+
+    ProcessPoolExecutorに渡すため、モジュールレベルの関数にしている。
+    """
+    from email_handler import EmailHandler
+
+    parser = _parsers.get(email_address)
+    if parser is None:
+        parser = _parsers[email_address] = EmailHandler(email_address, '', '')
+
+    results = []
+    for item in items:
+        if CONTROL_KEY in item:
+            results.append(item)
+            continue
+        parsed_msg = parser.parse_fetched_message(
+            item['header'], item['text'], item['text_part'], item['attachments'], item.get('partial', False)
+        )
+        if parsed_msg and not parsed_msg['message_id'] and item.get('gm_msgid'):
+            # Message-IDのないGmailのメッセージはX-GM-MSGIDから一意なIDを作る
+            parsed_msg['message_id'] = GMAIL_MESSAGE_ID_FORMAT.format(item['gm_msgid'])
+        if parsed_msg and parsed_msg['message_id']:
+            parsed_msg['folder'] = item.get('folder', '')
+            parsed_msg['uid'] = item['uid']
+            parsed_msg['is_sent'] = item.get('is_sent', False)
+            for key in ('gm_msgid', 'gm_thrid', 'imap_account', 'imap_folder', 'flags'):
+                if item.get(key) is not None:
+                    parsed_msg[key] = item[key]
+            results.append(parsed_msg)
+    return results
+
+
+def _count_messages(items: List[Dict[str, Any]]) -> int:
+    return sum(1 for item in items if CONTROL_KEY not in item)
+
+
+class StageCounter:
+    """ステージごとの処理件数・稼働時間・待ち時間を集計する"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.busy_time = 0.0  # 実際に処理していた時間
+        self.blocked_time = 0.0  # 下流のキューが満杯で待った時間（バックプレッシャー）
+        self._lock = threading.Lock()
+
+    def add(self, items: int = 0, size: int = 0, busy: float = 0.0, blocked: float = 0.0) -> None:
+        with self._lock:
+            self.items += items
+            self.bytes += size
+            self.busy_time += busy
+            self.blocked_time += blocked
+
+    def to_dict(self, elapsed: float) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'items': self.items,
+                'bytes': self.bytes,
+                'busy_time': round(self.busy_time, 3),
+                'blocked_time': round(self.blocked_time, 3),
+                'items_per_sec': round(self.items / elapsed, 1) if elapsed > 0 else 0.0,
+            }
+
+
+class SyncPipeline:
+    """取得 → パース → 書き込み をキューでつないだ同期パイプライン
+
+    - 取得ステージ: producer(submit) を別スレッドで実行し、未パースのメッセージを投入する
+    - パースステージ: ProcessPoolExecutorでMIMEパース・文字コード変換・ハッシュ計算を行う
+    - 書き込みステージ: run() を呼んだスレッドで writer(batch) を呼ぶ（DBセッションをまたがない）
+
+    キューには上限があり、下流が詰まると上流のsubmit()が待つ。
+    CONTROL_KEYを持つ項目はパースせず、投入順を保ったまま writer のバッチに含めて渡す。
+    """
+
+    def __init__(self, email_address: str, parse_workers: int = PARSE_WORKERS,
+                 queue_size: int = QUEUE_SIZE, chunk_size: int = PARSE_CHUNK_SIZE,
+                 write_batch_size: int = WRITE_BATCH_SIZE):
+        self.email_address = email_address
+        self.parse_workers = parse_workers
+        self.chunk_size = chunk_size
+        self.write_batch_size = write_batch_size
+        self._raw_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        # パース済みはチャンク単位で流れるため、件数の上限をチャンク数に換算する
+        self._parsed_queue: queue.Queue = queue.Queue(maxsize=max(queue_size // chunk_size, 2))
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._producer_done = threading.Event()
+        self.counters = {
+            'fetch': StageCounter('fetch'),
+            'parse': StageCounter('parse'),
+            'write': StageCounter('write'),
+        }
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    def _put(self, target: queue.Queue, item: Any, counter: StageCounter) -> None:
+        """停止要求を確認しながらキューに入れる。満杯で待った時間を記録する"""
+        start = time.time()
+        while True:
+            if self._stop.is_set():
+                raise PipelineAborted("同期パイプラインは停止しています")
+            try:
+                target.put(item, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+        waited = time.time() - start
+        if waited > POLL_INTERVAL / 10:
+            counter.add(blocked=waited)
+
+    def submit(self, item: Dict[str, Any]) -> None:
+        """取得ステージから未パースのメッセージを投入する（スレッドセーフ）"""
+        if CONTROL_KEY not in item:
+            size = len(item.get('header') or b'') + len(item.get('text') or b'')
+            self.counters['fetch'].add(items=1, size=size)
+        self._put(self._raw_queue, item, self.counters['fetch'])
+
+    def _fail(self, error: BaseException) -> None:
+        if not isinstance(error, PipelineAborted):
+            self._errors.append(error)
+        self._stop.set()
+
+    def _run_producer(self, producer: Callable[[Callable[[Dict[str, Any]], None]], None]) -> None:
+        try:
+            producer(self.submit)
+        except BaseException as e:
+            app_logger.error(f"取得ステージでエラーが発生しました: {str(e)}")
+            self._fail(e)
+        finally:
+            self._producer_done.set()
+            try:
+                self._put(self._raw_queue, _DONE, self.counters['fetch'])
+            except PipelineAborted:
+                pass
+
+    def _parse_chunk(self, chunk: List[Dict[str, Any]]) -> Future:
+        """チャンクをパースする。少量の同期ではプロセスを起動せずにその場でパースする"""
+        if self._executor is None and self._producer_done.is_set() and len(chunk) < self.chunk_size:
+            future: Future = Future()
+            future.set_result(parse_raw_items(self.email_address, chunk))
+            return future
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.parse_workers,
+                mp_context=multiprocessing.get_context(PARSE_START_METHOD)
+            )
+        return self._executor.submit(parse_raw_items, self.email_address, chunk)
+
+    def _emit_parsed(self, future: Future, chunk_len: int, started: float) -> None:
+        parsed = future.result()
+        self.counters['parse'].add(items=chunk_len, busy=time.time() - started)
+        self._put(self._parsed_queue, parsed, self.counters['parse'])
+
+    def _run_parser(self) -> None:
+        in_flight: deque = deque()
+        max_in_flight = self.parse_workers * 2
+        chunk: List[Dict[str, Any]] = []
+        try:
+            finished = False
+            while not finished:
+                try:
+                    item = self._raw_queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if self._stop.is_set():
+                        raise PipelineAborted("同期パイプラインは停止しています")
+                    item = None
+                if item is _DONE:
+                    finished = True
+                elif item is not None:
+                    chunk.append(item)
+
+                # チャンクが溜まったか、取得が途切れたらパースに回す
+                if chunk and (len(chunk) >= self.chunk_size or item is None or finished):
+                    in_flight.append((self._parse_chunk(chunk), _count_messages(chunk), time.time()))
+                    chunk = []
+
+                # 処理中のチャンクが多すぎる場合は古いものから結果を待つ
+                while in_flight and (len(in_flight) >= max_in_flight or finished or in_flight[0][0].done()):
+                    self._emit_parsed(*in_flight.popleft())
+
+            self._put(self._parsed_queue, _DONE, self.counters['parse'])
+        except BaseException as e:
+            if not isinstance(e, PipelineAborted):
+                app_logger.error(f"パースステージでエラーが発生しました: {str(e)}")
+            self._fail(e)
+
+    def run(self, producer: Callable[[Callable[[Dict[str, Any]], None]], None],
+            writer: Callable[[List[Dict[str, Any]]], None]) -> Dict[str, Any]:
+        """パイプラインを実行し、すべて書き込み終わったらステージごとの統計を返す
+
+        Args:
+            producer: submit関数を受け取り、未パースのメッセージを投入する関数
+            writer: パース済みメッセージのバッチを保存する関数（呼び出しスレッドで実行）
+        """
+        self._started_at = time.time()
+        fetch_thread = threading.Thread(target=self._run_producer, args=(producer,),
+                                        name='sync-fetch', daemon=True)
+        parse_thread = threading.Thread(target=self._run_parser, name='sync-parse', daemon=True)
+        fetch_thread.start()
+        parse_thread.start()
+
+        batch: List[Dict[str, Any]] = []
+        batch_messages = 0
+        try:
+            while True:
+                try:
+                    parsed = self._parsed_queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if self._stop.is_set():
+                        break
+                    continue
+                if parsed is _DONE:
+                    break
+                batch.extend(parsed)
+                batch_messages += _count_messages(parsed)
+                if batch_messages >= self.write_batch_size:
+                    self._write(writer, batch)
+                    batch = []
+                    batch_messages = 0
+            # 取得やパースが途中で失敗しても、パース済みの分は保存しておく
+            if batch:
+                self._write(writer, batch)
+        except BaseException as e:
+            app_logger.error(f"書き込みステージでエラーが発生しました: {str(e)}")
+            self._fail(e)
+        finally:
+            fetch_thread.join()
+            parse_thread.join()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            self._finished_at = time.time()
+
+        stats = self.get_stats()
+        app_logger.info(f"同期パイプライン完了: {stats}")
+        if self._errors:
+            raise self._errors[0]
+        return stats
+
+    def _write(self, writer: Callable[[List[Dict[str, Any]]], None], batch: List[Dict[str, Any]]) -> None:
+        started = time.time()
+        writer(batch)
+        self.counters['write'].add(items=_count_messages(batch), busy=time.time() - started)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ステージごとのスループットとキューの状態を返す"""
+        end = self._finished_at or time.time()
+        elapsed = end - self._started_at if self._started_at else 0.0
+        stats: Dict[str, Any] = {name: counter.to_dict(elapsed) for name, counter in self.counters.items()}
+        stats['elapsed'] = round(elapsed, 3)
+        stats['raw_queue_depth'] = self._raw_queue.qsize()
+        stats['parsed_queue_depth'] = self._parsed_queue.qsize()
+        return stats
@@ -0,0 +1,84 @@
+"""
+メッセージ検索のクエリ解析
+
+検索欄の文字列をNFKC正規化し、body_tsv（PostgreSQLの全文検索）で
+引けるか、部分一致（トライグラムインデックスのILIKE）に回すかを決める。
+日本語などのCJKは単語に分かち書きされないため、取り込み時にbigramを作って
+search_ngrams（GINインデックス付きの配列）に保存し、部分一致の候補をそこから絞り込む。
+"""
+import re
+import unicodedata
+from typing import List
+
+# 単語の区切りに空白を使わない文字（ひらがな・カタカナ・漢字・ハングル）。
+# 全文検索のパーサーはこれらの連続を1語として扱うため、bigramの索引と部分一致で検索する
+_CJK = re.compile(r'[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯ｦ-ﾟ]')
+
+# 全文検索に回す文字（単語の文字、空白、websearch_to_tsqueryの構文 " と -）
+_FULL_TEXT_QUERY = re.compile(r'[\w\s"\'-]+')
+
+
+def normalize_query(query: str) -> str:
+    """検索文字列をNFKC正規化して前後の空白を除く（全角英数字は半角になる）"""
+    return unicodedata.normalize('NFKC', query or '').strip()
+
+
+def query_terms(query: str) -> List[str]:
+    """空白区切りの検索語（部分一致検索用）"""
+    return normalize_query(query).split()
+
+
+def has_cjk(text: str) -> bool:
+    return bool(_CJK.search(text or ''))
+
+
+def use_full_text(query: str) -> bool:
+    """body_tsvの全文検索で扱えるクエリか
+
+    CJKを含むものや、アドレス・ファイル名の一部（@ . / など）を含むものは
+    単語単位では一致しないため、部分一致で検索する。
+    """
+    query = normalize_query(query)
+    return bool(query) and not has_cjk(query) and bool(_FULL_TEXT_QUERY.fullmatch(query))
+
+
+def _cjk_runs(text: str) -> List[str]:
+    """NFKC正規化した文字列から、CJK文字の連続部分を取り出す"""
+    runs = []
+    current = []
+    for char in unicodedata.normalize('NFKC', text or ''):
+        if _CJK.match(char):
+            current.append(char)
+        elif current:
+            runs.append(''.join(current))
+            current = []
+    if current:
+        runs.append(''.join(current))
+    return runs
+
+
+def cjk_ngrams(*texts: str) -> List[str]:
+    """search_ngrams に保存するCJKのbigram（重複なし、ソート済み）
+
+    1文字だけのCJKの連続はその1文字を保存する。
+    CJK以外の部分は body_tsv の全文検索で扱うため含めない。
+    """
+    grams = set()
+    for text in texts:
+        for run in _cjk_runs(text):
+            if len(run) == 1:
+                grams.add(run)
+            else:
+                grams.update(run[i:i + 2] for i in range(len(run) - 1))
+    return sorted(grams)
+
+
+def query_ngrams(term: str) -> List[str]:
+    """検索語を含むメッセージが必ず持っているbigram
+
+    2文字以上のCJKの連続からだけ作る（1文字の語はインデックスでは絞り込めない）。
+    """
+    grams = set()
+    for run in _cjk_runs(term):
+        grams.update(run[i:i + 2] for i in range(len(run) - 1))
+    return sorted(grams)